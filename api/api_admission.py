@@ -0,0 +1,195 @@
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+"""
+Admission control of the API.
+
+Every endpoint class (inference, bulk, plots) gets an AdmissionController with a concurrency limit and a
+queue bound. Requests beyond the limit wait in the queue, requests beyond the queue bound are rejected
+right away (status code 429), requests that wait longer than their deadline are rejected as well
+(status code 503). Both rejections carry a Retry-After header, estimated from the recent service times.
+
+Configuration per endpoint class via env variables, e.g. for the class "inference":
+- ADMISSION_INFERENCE_CONCURRENCY: number of requests processed at the same time
+- ADMISSION_INFERENCE_QUEUE: number of requests waiting for a slot
+- ADMISSION_INFERENCE_TIMEOUT: deadline (seconds) of a request, including its waiting time.
+  Clients can shorten it with the request header X-Request-Timeout (seconds).
+
+Deadlines: work that nobody waits for anymore (deadline passed, client disconnected) is abandoned
+at the next stage boundary, see Admission.check(). A stage that already runs (e.g. one prediction
+including its logging) is not interrupted, such that the monitoring data stays consistent.
+"""
+
+# request header, with which clients can shorten their deadline
+TIMEOUT_HEADER = "X-Request-Timeout"
+
+class RequestAbandoned(Exception):
+    """
+    Raised by Admission.check(), when the deadline of a request has passed or the client has disconnected.
+    """
+
+class Admission:
+    """
+    Handle of an admitted request. Holds its deadline (time.monotonic() based).
+    """
+
+    def __init__(self, controller, request, deadline):
+        self.controller = controller
+        self.request = request
+        self.deadline = deadline
+
+    def remaining_seconds(self):
+        """
+        Returns the remaining time (seconds) until the deadline.
+        """
+        return self.deadline - time.monotonic()
+
+    def expired(self):
+        """
+        Returns True if the deadline has passed. Can be called from worker threads.
+        """
+        return self.remaining_seconds() <= 0
+
+    async def check(self):
+        """
+        Stage boundary: raises RequestAbandoned if the deadline has passed or the client has disconnected.
+        Has to be called after the request body has been read: the disconnect detection consumes 
+        pending messages of the request.
+        """
+        if self.expired():
+            raise RequestAbandoned("deadline exceeded")
+        if self.request is not None and await self.request.is_disconnected():
+            raise RequestAbandoned("client disconnected")
+
+class AdmissionController:
+    """
+    Concurrency limit and queue bound of one endpoint class. Is used from the event loop only.
+
+    Parameters
+    ----------
+    name : string
+        Name of the endpoint class (used in the counters and the env variable names).
+    max_concurrent : positive int
+        Maximum number of requests processed at the same time.
+    max_queued : int
+        Maximum number of requests waiting for a slot.
+    timeout : float
+        Deadline (seconds) of a request, including its waiting time.
+    """
+
+    def __init__(self, name, max_concurrent, max_queued, timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.queued = 0
+        # exponentially weighted mean of the service time (seconds), used for the Retry-After estimate
+        self.mean_service_seconds = 1.0
+        self.counters = {
+            "admitted": 0,
+            "completed": 0,
+            "rejected queue full": 0,
+            "rejected queue timeout": 0,
+            "abandoned deadline exceeded": 0,
+            "abandoned client disconnected": 0,
+            }
+
+    @classmethod
+    def from_env(cls, name, max_concurrent, max_queued, timeout):
+        """
+        Creates a controller, the given defaults are overridden by the env variables ADMISSION_[NAME]_CONCURRENCY,
+        ADMISSION_[NAME]_QUEUE and ADMISSION_[NAME]_TIMEOUT.
+        """
+        prefix = f"ADMISSION_{name.upper()}_"
+        return cls(
+            name=name,
+            max_concurrent=int(os.environ.get(prefix + "CONCURRENCY", max_concurrent)),
+            max_queued=int(os.environ.get(prefix + "QUEUE", max_queued)),
+            timeout=float(os.environ.get(prefix + "TIMEOUT", timeout)),
+            )
+
+    def retry_after_seconds(self):
+        """
+        Estimates the time (whole seconds) until the queue in front of a new request has been worked off.
+        """
+        return max(1, math.ceil(self.mean_service_seconds * (self.queued + 1) / self.max_concurrent))
+
+    def _reject(self, status_code, counter, detail):
+        self.counters[counter] += 1
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after_seconds())})
+
+    def _deadline(self, request):
+        timeout = self.timeout
+        if request is not None and TIMEOUT_HEADER in request.headers:
+            try:
+                timeout = min(timeout, float(request.headers[TIMEOUT_HEADER]))
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Header {TIMEOUT_HEADER} has to be a number of seconds.")
+        return time.monotonic() + timeout
+
+    @asynccontextmanager
+    async def admit(self, request=None):
+        """
+        Waits for a processing slot and yields an Admission. Rejects the request with status code 429, if the
+        queue is full, and with 503, if no slot gets free before the deadline. Work abandoned via
+        Admission.check() is answered with status code 503.
+
+        Parameters
+        ----------
+        request : fastapi.Request or None
+            The incoming request (deadline header, disconnect detection).
+        """
+        deadline = self._deadline(request)
+
+        # fast reject: all slots busy and queue full
+        if self._slots.locked() and self.queued >= self.max_queued:
+            self._reject(429, "rejected queue full", f"Too many {self.name} requests.")
+
+        self.queued += 1
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            await asyncio.wait_for(self._slots.acquire(), timeout=remaining)
+        except asyncio.TimeoutError:
+            self._reject(503, "rejected queue timeout", f"No free {self.name} slot within the request deadline.")
+        finally:
+            self.queued -= 1
+
+        self.active += 1
+        self.counters["admitted"] += 1
+        start = time.monotonic()
+        try:
+            admission = Admission(self, request, deadline)
+            if admission.expired():
+                raise RequestAbandoned("deadline exceeded")
+            yield admission
+            self.counters["completed"] += 1
+        except RequestAbandoned as e:
+            reason = str(e)
+            self._reject(503, f"abandoned {reason}", f"Request abandoned: {reason}.")
+        finally:
+            self.active -= 1
+            self.mean_service_seconds = 0.8 * self.mean_service_seconds + 0.2 * (time.monotonic() - start)
+            self._slots.release()
+
+    def stats(self):
+        """
+        Returns the current load and the shed-load counters as dictionary.
+        """
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max concurrent": self.max_concurrent,
+            "max queued": self.max_queued,
+            "timeout seconds": self.timeout,
+            "mean service seconds": round(self.mean_service_seconds, 3),
+            **self.counters,
+            }
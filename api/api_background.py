@@ -0,0 +1,92 @@
+import queue
+import threading
+import traceback
+
+"""
+Background work queue of the API.
+
+Used by the champion-first mode (env variable CHAMPION_FIRST=1, see api_server.py): the endpoint returns
+the champion's prediction right away, the challenger and baseline predictions, the logging and the
+check for a model switch are submitted to this queue.
+
+Guarantees:
+- bounded capacity: submit() blocks while the queue is full (backpressure instead of unbounded memory growth)
+- ordering: a single worker thread processes the jobs in submission order. Log counters are allocated
+  when a job is logged (see api_helpers.log_predictions_and_check_switch()), hence they are monotonic
+  in the csv-files and follow the order of the requests
+- shutdown drain: shutdown() processes all submitted jobs before the worker thread stops
+"""
+
+class BackgroundWorkQueue:
+    """
+    Bounded FIFO work queue, processed by a single worker thread.
+
+    Parameters
+    ----------
+    maxsize : positive int
+        Maximum number of pending jobs.
+    """
+
+    # marks the end of the queue
+    _STOP = object()
+
+    def __init__(self, maxsize):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self.processed_jobs = 0
+        self.failed_jobs = 0
+
+    def start(self):
+        """
+        Starts the worker thread.
+        """
+        self._thread = threading.Thread(target=self._work, name="background-work-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Submits function(*args, **kwargs) for background execution. Blocks while the queue is full.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            raise RuntimeError("Background work queue is not running.")
+        self._queue.put((function, args, kwargs))
+
+    def pending_jobs(self):
+        """
+        Returns the (approximate) number of jobs waiting in the queue.
+        """
+        return self._queue.qsize()
+
+    def shutdown(self, timeout=None):
+        """
+        Processes all submitted jobs, then stops the worker thread.
+
+        Parameters
+        ----------
+        timeout : float or None
+            Maximum time (seconds) to wait for the drain. None waits until all jobs are done.
+
+        Returns
+        -------
+        drained : boolean
+            True if all jobs were processed within the timeout.
+        """
+        if self._thread is None:
+            return True
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is self._STOP:
+                break
+            function, args, kwargs = job
+            try:
+                function(*args, **kwargs)
+                self.processed_jobs += 1
+            except Exception:
+                # a failing job must not stop the processing of the following ones
+                self.failed_jobs += 1
+                traceback.print_exc()
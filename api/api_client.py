@@ -3,6 +3,9 @@ from pathlib import Path
 from enum import Enum
 import random
 import pandas as pd
+import io
+import numpy as np
+from PIL import Image
 
 """
 This script serves to simulate frontend-backend interactions. 
@@ -19,6 +22,8 @@ More specific:
 USER MANUAL: 
 - simply specify the amount of samples (test images) that should be sent to the API
 - Do so by specifying the samples variable in the block "configure nr. of samples to generate".
+- set send_raw_tensors = True to decode the images here and send them as uint8 tensors (.npy) 
+  to the endpoint /upload_tensor (like a client that already holds decoded pixel arrays)
 HINT:
 - the mlflow server AND the FastAPI server have to be running during the execution of this script here!
 """
@@ -32,11 +37,15 @@ class Label(int, Enum):
 base_url = "http://127.0.0.1:8000"
 endpoint = "/upload_image"
 url_with_endpoint = base_url + endpoint
+url_tensor_endpoint = base_url + "/upload_tensor"
 
 ' ################################ configure nr. of samples to generate #############'
 # samples (prediction runs) to be generated
 n_samples = 300
 
+# send decoded pixel arrays instead of image files
+send_raw_tensors = False
+
 ' ################################ get images ########################################'
 # Get absolute path of the project dir
 project_folder = Path(__file__).resolve().parent.parent
@@ -83,7 +92,14 @@ for i, image_file in enumerate(selected_images):
         params = {"label": Label.NEGATIVE.value if data_class == "NORMAL" else Label.POSITIVE.value}
 
         # make API call
-        response = requests.post(url_with_endpoint, files=files, params=params)
+        if send_raw_tensors:
+            # decode image and send it as .npy tensor
+            buffer = io.BytesIO()
+            np.save(buffer, np.asarray(Image.open(img)))
+            params["file_name"] = image_file.name
+            response = requests.post(url_tensor_endpoint, data=buffer.getvalue(), params=params, headers={"Content-Type": "application/x-npy"})
+        else:
+            response = requests.post(url_with_endpoint, files=files, params=params)
         status_code = response.status_code
 
         # quick response logging
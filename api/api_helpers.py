@@ -1,20 +1,34 @@
 import numpy as np
-from tensorflow import keras
-import mlflow
 from PIL import Image
 import io
 import os
 from fastapi import HTTPException
-from mlflow import MlflowClient
 import csv
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import pandas as pd
-import seaborn as sns
 from pathlib import Path
 import random
+import threading
+import time
+import tempfile
+import traceback
+import zlib
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
 from datetime import datetime
 
+# NOTE: the ML stack (tensorflow/keras, mlflow) and the analytics/plotting stack (pandas, matplotlib, seaborn)
+# are imported lazily inside the functions that need them. Importing this module stays cheap, such that
+# workers that only serve plots or reviews start fast (and don't pay for tensorflow).
+
+MODEL_NAME = "Xray_classifier"
+ALIASES = ["champion", "challenger", "baseline"]
+MLFLOW_TRACKING_URI = "http://127.0.0.1:8080"
+PROJECT_FOLDER = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TRACKING_PATH = os.path.join(PROJECT_FOLDER, "unified_experiment/performance_tracking")
+
+# number of threads used by the TFLite interpreter for quantized model versions (see unified_experiment/quantization.py)
+TFLITE_NUM_THREADS = int(os.environ.get("TFLITE_NUM_THREADS", os.cpu_count()))
+
 ' ##############################################################################################'
 ' ######################### image preprocessing, model loading, prediction #####################'
 
@@ -51,6 +65,77 @@ def return_verified_image_as_numpy_arr(image_bytes):
     validated_image_as_numpy = np.asarray(validated_image)
     return validated_image_as_numpy
 
+# upper limit of the size of an uploaded raw tensor (see return_verified_tensor_as_numpy_arr())
+MAX_TENSOR_BYTES = int(os.environ.get("MAX_TENSOR_BYTES", 64 * 1024 * 1024))
+
+def return_verified_tensor_as_numpy_arr(tensor_bytes, content_type, shape_header = None, dtype_header = None):
+    '''
+    Verification and reformatting function for decoded pixel arrays (raw tensor upload).
+    The body is either a .npy file (content type "application/x-npy") or raw bytes 
+    (content type "application/octet-stream") with shape and dtype given by headers. 
+    The returned array is a read-only view of the body, the pixels are not copied.
+    
+    Parameters
+    ----------
+    
+    tensor_bytes: bytes
+        Request body.
+    content_type: string
+        "application/x-npy" or "application/octet-stream".
+    shape_header: string
+        Shape of a raw tensor, e.g. "1024,1024" (height, width[, channels]). Ignored for .npy files.
+    dtype_header: string
+        Data type of a raw tensor, has to be "uint8". Ignored for .npy files.
+        
+    Returns
+    -------
+    Validated image (uint8, height x width [x channels]) in numpy array format. 
+    '''
+    if len(tensor_bytes) > MAX_TENSOR_BYTES:
+        raise HTTPException(status_code=413, detail=f"Tensor exceeds {MAX_TENSOR_BYTES} bytes.")
+
+    try:
+        if content_type == "application/x-npy":
+            # parse the .npy header, then view the data section of the body (np.load would copy)
+            buffer = io.BytesIO(tensor_bytes)
+            version = np.lib.format.read_magic(buffer)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(buffer)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(buffer)
+            if dtype.hasobject:
+                raise ValueError("object arrays are not supported")
+            tensor = np.frombuffer(tensor_bytes, dtype=dtype, count=int(np.prod(shape)), offset=buffer.tell())
+            tensor = tensor.reshape(shape, order="F" if fortran_order else "C")
+        elif content_type == "application/octet-stream":
+            if shape_header is None or dtype_header is None:
+                raise ValueError("raw tensors need the headers X-Tensor-Shape and X-Tensor-Dtype")
+            shape = tuple(int(dim) for dim in shape_header.split(","))
+            tensor = np.frombuffer(tensor_bytes, dtype=np.dtype(dtype_header)).reshape(shape)
+        else:
+            raise HTTPException(status_code=415, detail="Tensor has to be sent as application/x-npy or application/octet-stream.")
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Uploaded body is not a valid tensor: {e}")
+
+    if tensor.dtype != np.uint8:
+        raise HTTPException(status_code=400, detail=f"Tensor has to be uint8, got {tensor.dtype}.")
+
+    # drop a single channel axis (view), resize_image() expects grayscale images as height x width
+    if tensor.ndim == 3 and tensor.shape[-1] == 1:
+        tensor = tensor[..., 0]
+
+    # validate against the signatures of the aliased models: grayscale, or as many channels as every model expects
+    signature_channels = {get_model_by_version(MODEL_NAME, model_version, model_tag)[1][-1] 
+                          for model_version, model_tag in set(get_alias_mapping().values())}
+    valid_shape = tensor.ndim == 2 or (tensor.ndim == 3 and signature_channels == {tensor.shape[-1]})
+    if not valid_shape or min(tensor.shape[:2]) == 0:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Tensor shape {tensor.shape} doesn't match the model signatures (height x width, channels: 1 or {sorted(signature_channels)}).",
+            )
+
+    return tensor
+
 def load_model_from_registry(model_name, alias):
     """
     Is used to load an mlflow model from its registry (i.e., to fetch the corresponding artifact).
@@ -72,12 +157,46 @@ def load_model_from_registry(model_name, alias):
         The models required input data type in element level.
     """
 
-    # start_loading = time.time()
-    print("Start loading model")
-    model = mlflow.pyfunc.load_model(model_uri=f"models:/{model_name}@{alias}")
-    # end_loading = time.time()
-    # print("loading time: ", end_loading - start_loading)
-    print(f"Model {model_name}@{alias} loaded")
+    model_version, model_tag = get_modelversion_and_tag(model_name=model_name, model_alias=alias)
+    
+    return load_model_version_from_registry(model_name, model_version, model_tag)
+
+def load_model_version_from_registry(model_name, model_version, model_tag):
+    """
+    Loads a specific version of a registered mlflow model. Unlike loading by alias, 
+    the result doesn't change when aliases are switched in the meantime.
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    model_version : int
+        The registered model's version number.
+    model_tag : string
+        Tag of the registered model's version. Quantized versions are tagged "tflite_..." 
+        and are served through the TFLite interpreter.
+        
+    Returns
+    -------
+    model: mlflow model
+    input_shape: tuple
+    input_type:
+        See load_model_from_registry().
+    """
+    import mlflow
+
+    mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
+    # use the local copy of the artifact, if it has been preloaded (see preload_model_artifacts())
+    model_uri = _local_model_paths.get((model_name, model_version), f"models:/{model_name}/{model_version}")
+
+    start_loading = time.time()
+    print(f"Start loading model {model_name} version {model_version}")
+    if model_tag.startswith("tflite"):
+        model = mlflow.pyfunc.load_model(model_uri=model_uri, model_config={"num_threads": TFLITE_NUM_THREADS})
+    else:
+        model = mlflow.pyfunc.load_model(model_uri=model_uri)
+    print(f"Model {model_name} version {model_version} loaded in {time.time() - start_loading:.2f} seconds")
+
     # extract signature
     signature = model.metadata.signature
     input_shape = signature.inputs.to_dict()[0]['tensor-spec']['shape'] 
@@ -151,7 +270,8 @@ def resize_image(
     ----------
     
     image: PIL image/numpy array
-        Image to be resized. Can only be in grayscale.
+        Image to be resized. Grayscale (height x width), or height x width x channels
+        with as many channels as the signature.
     signature_shape: tuple
         Shape of the ML classifier input.
     signature_dtype: data type
@@ -162,24 +282,32 @@ def resize_image(
     image_array: numpy array
         Reshaped numpy array with signature_dtype entries. 
     '''
-    # convert image to numpy array
+    # convert image to numpy array (no copy for numpy arrays)
     image_array = np.asarray(image)
-    image_array = image_array.reshape((*image_array.shape,1))
-    
-    # if ML model input has more than one channel, populate each channel with the same pixel values
-    if signature_shape[-1] > 1:
-        img_array_tuple = tuple([image_array for i in range(signature_shape[-1])])
-        image_array = np.concatenate(img_array_tuple, axis = -1)
+    if image_array.ndim == 2:
+        image_array = image_array.reshape((*image_array.shape,1))
+
+    # models with variable image size (see unified_experiment/export_serving_model.py) resize in their graph:
+    # only the batch axis is added (no copy for uint8 images)
+    if signature_shape[1] == -1 and signature_shape[2] == -1:
+        return image_array.reshape((1, *image_array.shape)).astype(signature_dtype, copy=False)
+
+    from tensorflow import keras
 
     # resizing according to signature_shape. Using helper function from keras
     resized_image = keras.ops.image.resize(
         image_array,
         size = (signature_shape[1], signature_shape[2]),
         interpolation="bilinear",
-        )
+        ).numpy()
+
+    # compatibility path for models with rgb input (current models take one channel and broadcast it in the graph):
+    # populate each channel with the same pixel values, after resizing (the resized channels would be identical)
+    if signature_shape[-1] > 1 and resized_image.shape[-1] == 1:
+        resized_image = np.repeat(resized_image, signature_shape[-1], axis = -1)
     
     # converting to numpy and retyping according to signature_type
-    image_array = resized_image.numpy().reshape(signature_shape)
+    image_array = resized_image.reshape(signature_shape)
     image_array = image_array.astype(signature_dtype)
 
     return image_array
@@ -237,6 +365,8 @@ def get_image_paths(n_samples):
     
     # filter out images that were already analysed
     if tracking_csv_path.exists(): 
+        import pandas as pd
+
         # import logging dataframe to get names of already analysed images
         df_performance = pd.read_csv(tracking_csv_path)
         analysed_images = set(df_performance["filename"])
@@ -255,7 +385,31 @@ def get_image_paths(n_samples):
         
     return selected_images
 
-def predict_log_switch(selected_image_paths):
+# read the data/test images of the bulk endpoint from the tensor store (see data/tensor_store.py)
+USE_TENSOR_STORE = os.environ.get("USE_TENSOR_STORE", "0") == "1"
+TENSOR_STORE_IMG_SIZE = int(os.environ.get("TENSOR_STORE_IMG_SIZE", 256))
+_test_tensor_store = {}
+
+def get_test_tensor_store():
+    """
+    Returns the (grayscale) tensor store of data/test, if enabled (env variable USE_TENSOR_STORE=1) 
+    and up to date. Returns None otherwise, then the bulk endpoint decodes the image files. 
+    The store is opened once per process (read-only memory map, shared between workers via the page cache).
+    """
+    if not USE_TENSOR_STORE:
+        return None
+    if "store" not in _test_tensor_store:
+        import sys
+        sys.path.append(PROJECT_FOLDER)
+        from data.tensor_store import load_tensor_store
+
+        store = load_tensor_store("test", TENSOR_STORE_IMG_SIZE, "grayscale", rebuild=False)
+        if store is None:
+            print("Tensor store of data/test is missing or outdated (run data/tensor_store.py), image files are decoded.")
+        _test_tensor_store["store"] = store
+    return _test_tensor_store["store"]
+
+def predict_log_switch(selected_image_paths, should_stop = None):
     """
     Function that takes several image paths as input and classifies the
     corresponding images, logs the results in csv form and optionally
@@ -266,90 +420,1140 @@ def predict_log_switch(selected_image_paths):
     ----------
     selected_images: list of Path objects
         List of image paths returned by the get_image_paths() function. 
+    should_stop: callable or None
+        Checked before each image, the remaining images are skipped when it returns True
+        (e.g. deadline of the request exceeded).
     
     Returns
     -------
-    None
+    n_classified: int
+        Number of classified images.
     """
-    # set tracking uri for mlflow
-    mlflow.set_tracking_uri("http://127.0.0.1:8080")
-
-    # set model name
-    model_name = "Xray_classifier"
-    
-    # load all three models and save the outputs for later use
-    models = []
-    input_shapes = []
-    input_types = []
-    aliases = ["champion", "challenger", "baseline"]
-    
-    for alias in aliases:
-        # get model and signature
-        model, input_shape, input_type  = load_model_from_registry(model_name = model_name, alias = alias)
-        # store the outputs 
-        models.append(model)
-        input_shapes.append(input_shape)
-        input_types.append(input_type)
-        
+    test_store = get_test_tensor_store()
     for i, image_file in enumerate(selected_image_paths):
+
+        if should_stop is not None and should_stop():
+            print(f"Stopped after {i} of {len(selected_image_paths)} predictions.")
+            return i
         
         # get class from parent folder name
         data_class = image_file.parent.name
         label = 0 if data_class == "NORMAL" else 1
         
-        api_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # make predictions and logging for each of the three models
-        for alias, model, input_shape, input_type in zip(aliases, models, input_shapes, input_types):
-            
-            # get model version and tag for logging
-            model_version, model_tag = get_modelversion_and_tag(model_name=model_name, model_alias=alias)
-            
-            # open image and resize it according to model signature
+        # image source: view into the tensor store (already decoded and resized), or the image file
+        def load_image(image_file=image_file):
+            stored_image = test_store.image(image_file.name) if test_store is not None else None
+            if stored_image is not None:
+                return stored_image
             with Image.open(image_file, "r") as img:
-                formatted_image = resize_image(image=img, signature_shape = input_shape, signature_dtype=input_type)
-            
-            # make prediction
-            y_pred = make_prediction(model, image_as_array=formatted_image)
+                return np.asarray(img)
+
+        # classify image with all three models (models are kept in the model cache, 
+        # a switch between challenger and champion is picked up automatically)
+        if REPLAY_PREDICTIONS:
+            # replay mode: the image is only loaded, if a prediction isn't in the replay tables
+            classify_and_log_image(img=functools.cache(load_image), label=label, file_name=image_file.name, checksum=zlib.crc32(image_file.read_bytes()))
+        else:
+            classify_and_log_image(img=load_image(), label=label, file_name=image_file.name)
+        
+        print(f"Prediction no. {i+1} of {len(selected_image_paths)} with class {data_class} done.")
+
+    return len(selected_image_paths)
+
+def classify_and_log_image(img, label, file_name, checksum = None):
+    """
+    Classifies an image with the champion, challenger and baseline models, logs the predictions 
+    (csv, optionally mlflow) and switches champion and challenger when needed.
+
+    Parameters
+    ----------
+    img : numpy array
+        Grayscale image, e.g. returned by return_verified_image_as_numpy_arr(). In replay mode 
+        also a callable returning the image (only called if a prediction can't be replayed).
+    label : int (0 or 1)
+        True label of the image.
+    file_name : string
+        Name of the image file (for logging).
+    checksum : int or None
+        CRC32 of the image file (see replay_checksum()), enables the lookup in the replay tables.
+        
+    Returns
+    -------
+    y_pred_as_str : dictionary
+        Prediction value (as string) for each model alias, i.e. champion, challenger, baseline.
+    """
+    api_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # fix the alias -> model version mapping for the whole request (aliases might be switched meanwhile)
+    alias_mapping = get_alias_mapping()
+    
+    # predict with all three models: in one graph execution (fused ensemble), or one by one (and replay mode)
+    predictions = None
+    if FUSED_ENSEMBLE and not REPLAY_PREDICTIONS:
+        predictions = predict_with_fused_ensemble(img, alias_mapping)
+    if predictions is None:
+        predictions = {alias: predict_or_replay(img, *alias_mapping[alias], file_name=file_name, checksum=checksum) for alias in ALIASES}
+
+    # logging in csv-files (and optionally mlflow), check if switch should be made
+    log_predictions_and_check_switch(predictions, alias_mapping, label, file_name, api_timestamp)
+
+    # dictionary for API-output
+    y_pred_as_str = {f"prediction {alias}": str(y_pred) for alias, y_pred in predictions.items()}
+
+    return y_pred_as_str
+
+def predict_with_model_version(img, model_version, model_tag, model_name = MODEL_NAME):
+    """
+    Resizes an image according to the signature of a model version and returns the model's prediction.
+    The model is taken from the model cache.
+
+    Parameters
+    ----------
+    img : numpy array
+        Grayscale image.
+    model_version : int
+        Version number of registered mlflow model (registry model)
+    model_tag : string
+        Tag of registered model's version (registry model)
+    model_name : string
+        The registered model's name.
+        
+    Returns
+    -------
+    y_pred : float (0 <= y_pred <=1)
+        Prediction of the model.
+    """
+    model, input_shape, input_type = get_model_by_version(model_name, model_version, model_tag)
+
+    # resize image according to signature
+    formatted_image = resize_image(image=img, signature_shape = input_shape, signature_dtype=input_type)
+    
+    # make prediction
+    return make_prediction(model, image_as_array=formatted_image)
+
+def predict_or_replay(img, model_version, model_tag, file_name = None, checksum = None, model_name = MODEL_NAME):
+    """
+    Returns the prediction of a model version: looked up in the replay table, if replay mode is on and 
+    the image (file name and checksum) is in the table, computed by predict_with_model_version() otherwise.
+
+    Parameters
+    ----------
+    img : numpy array or callable
+        Grayscale image, or callable returning it.
+    model_version : int
+        Version number of registered mlflow model (registry model)
+    model_tag : string
+        Tag of registered model's version (registry model)
+    file_name : string or None
+        Name of the image file.
+    checksum : int or None
+        CRC32 of the image file.
+    model_name : string
+        The registered model's name.
+        
+    Returns
+    -------
+    y_pred : float (0 <= y_pred <=1)
+        Prediction of the model.
+    """
+    if REPLAY_PREDICTIONS and checksum is not None:
+        y_pred = get_replayed_prediction(model_name, model_version, file_name, checksum)
+        if y_pred is not None:
+            return y_pred
+
+    return predict_with_model_version(img() if callable(img) else img, model_version, model_tag, model_name)
+
+def log_predictions_and_check_switch(predictions, alias_mapping, label, file_name, timestamp):
+    """
+    Logs the predictions of one image for all aliases, then checks if champion and challenger 
+    should be switched (and switches them, if so). Everything happens under the tracking lock, 
+    such that concurrent requests (threads and worker processes) log consistent rows with 
+    a common, monotonic log_counter.
+
+    Parameters
+    ----------
+    predictions : dictionary
+        Prediction (float between 0 and 1) for each alias.
+    alias_mapping : dictionary
+        (model version, model tag) for each alias, as returned by get_alias_mapping().
+    label : int (0 or 1)
+        True label of the image.
+    file_name : string
+        Name of the image file.
+    timestamp : string
+        Contains time of API call.
+        
+    Returns
+    -------
+    log_counter : int
+        Log counter of the logged predictions.
+    """
+    with tracking_lock():
+        
+        # one log counter for the predictions of all aliases
+        log_counter = allocate_log_counter()
+
+        for alias, y_pred in predictions.items():
+            model_version, model_tag = alias_mapping[alias]
             accuracy_pred = int(label == np.around(y_pred))
-            
+
             # logging and precalculations in csv-file
             logged_csv_data = save_performance_data_csv(alias = alias, 
-                                                       timestamp = api_timestamp, 
-                                                       y_true = label, 
-                                                       y_pred = y_pred, 
-                                                       accuracy=accuracy_pred, 
-                                                       file_name=image_file.name, 
-                                                       model_version=model_version, 
-                                                       model_tag=model_tag)
+                                                        timestamp = timestamp, 
+                                                        y_true = int(label), 
+                                                        y_pred = y_pred, 
+                                                        accuracy=accuracy_pred, 
+                                                        file_name=file_name, 
+                                                        model_version=model_version, 
+                                                        model_tag=model_tag,
+                                                        log_counter=log_counter)
 
             # switch off mlflow tracking (if needed)
             mlflow_tracking = False 
             if mlflow_tracking:
                 # logging in mlflow performance runs, if switched on
                 save_performance_data_mlflow(log_counter = logged_csv_data["log_counter"], 
-                                                alias = alias, 
-                                                timestamp = logged_csv_data["timestamp"], 
-                                                y_true = label, 
-                                                y_pred = y_pred, 
-                                                accuracy = accuracy_pred, 
-                                                file_name = logged_csv_data["filename"], 
-                                                model_version = model_version, 
-                                                model_tag = model_tag)
-
-        # check if switch should be made
-        if check_challenger_takeover(last_n_predictions = 20, window = 50):
+                                             alias = alias, 
+                                             timestamp = logged_csv_data["timestamp"], 
+                                             y_true = label, 
+                                             y_pred = y_pred, 
+                                             accuracy = accuracy_pred, 
+                                             file_name = logged_csv_data["filename"], 
+                                             model_version = model_version, 
+                                             model_tag = model_tag)
+        
+        print(f"Currently at run with log_counter number {log_counter}.")
+        # check if switch should be made. Not for predictions made with an outdated alias mapping (requests taken before 
+        # a switch, e.g. queued champion-first completions): they would fill the window with the pre-switch models 
+        # and repeat the comparison that triggered the switch, i.e. switch the models straight back.
+        if alias_mapping != read_alias_mapping():
+            print("Predictions were made with an outdated alias mapping, no switch check.")
+        elif check_challenger_takeover(last_n_predictions = 20, window = 50):
             switch_champion_and_challenger()
-            # swap the challenger and champion aliases
-            # instead of loading the models again
-            aliases[0], aliases[1] = aliases[1], aliases[0]
+
+    return log_counter
+
+def complete_champion_first_request(img, label, file_name, timestamp, alias_mapping, known_predictions, checksum = None):
+    """
+    Second half of a champion-first or cascade request (see api_background.py): predicts with the 
+    aliases that haven't been predicted yet, then logs all three predictions and checks for a model switch.
+    Uses the alias mapping of the original request, i.e. the model versions that were aliased 
+    when the request came in.
+
+    Parameters
+    ----------
+    img : numpy array
+        Grayscale image.
+    label : int (0 or 1)
+        True label of the image.
+    file_name : string
+        Name of the image file.
+    timestamp : string
+        Contains time of API call.
+    alias_mapping : dictionary
+        (model version, model tag) for each alias, as returned by get_alias_mapping().
+    known_predictions : dictionary
+        Predictions per alias made for the response already (champion, or the models of the cascade, 
+        see predict_with_cascade()).
+    checksum : int or None
+        See classify_and_log_image().
         
-        print(f"Prediction no. {i+1} of {len(selected_image_paths)} with class {data_class} done.")
+    Returns
+    -------
+    None
+    """
+    # logged in the order of ALIASES, as in classify_and_log_image()
+    predictions = {}
+    for alias in ALIASES:
+        if alias in known_predictions:
+            predictions[alias] = known_predictions[alias]
+        else:
+            predictions[alias] = predict_or_replay(img, *alias_mapping[alias], file_name=file_name, checksum=checksum)
+
+    log_predictions_and_check_switch(predictions, alias_mapping, label, file_name, timestamp)
+
+' ##############################################################################################'
+' ######################### model cache, warm-up and readiness #################################'
+
+# loaded models, keyed by (model name, version). Aliases can be switched, versions can't.
+# Ordered from least to most recently used (LRU eviction, see _enforce_model_cache_budget()).
+_model_cache = OrderedDict()
+# footprint (bytes) and weight precision per cached model
+_model_cache_info = {}
+# guards the model cache dictionary (held only briefly, never while a model is loading)
+_model_cache_lock = threading.Lock()
+# one lock per model version, such that concurrent requests don't load the same model twice
+# while requests for other (cached) versions are served without waiting
+_model_loading_locks = {}
+# set as soon as all aliased models are loaded and warmed up
+_models_ready = threading.Event()
+_warm_up_status = {"state": "not started", "models": {}, "error": None}
+
+# interval (seconds) in which the alias files are checked for changes made by other processes
+ALIAS_POLL_SECONDS = float(os.environ.get("ALIAS_POLL_SECONDS", 2))
+# time (seconds) a model version is kept in memory after it lost its last alias
+MODEL_EVICTION_GRACE_SECONDS = float(os.environ.get("MODEL_EVICTION_GRACE_SECONDS", 60))
+
+# memory budget (MB) of the model cache. Least recently used models are evicted when it is exceeded.
+MODEL_CACHE_BUDGET_MB = float(os.environ.get("MODEL_CACHE_BUDGET_MB", 4096))
+# hold all models except the champion with float16 weights (half the memory, keras models only)
+FLOAT16_NON_CHAMPION = os.environ.get("FLOAT16_NON_CHAMPION", "0") == "1"
+
+# alias mapping served to the requests, swapped as a whole after the referenced models are warm.
+# None as long as the models haven't been warmed up (the alias files are read on every request then).
+_served_alias_mapping = None
+# serializes alias refreshes (watcher thread and explicit refreshes)
+_alias_refresh_lock = threading.Lock()
+# wakes up the alias watcher right away (set after an in-process switch)
+_alias_change_event = threading.Event()
+_alias_watcher_thread = None
+
+def get_model(model_name, alias):
+    """
+    Returns the model currently associated with an alias. Models are loaded from the 
+    registry only once per version and are kept in memory afterwards.
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    alias : string
+        The registered model's alias.
+        
+    Returns
+    -------
+    model: mlflow model
+    input_shape: tuple
+    input_type:
+        See load_model_from_registry().
+    model_version : int
+        Version number of registered mlflow model (registry model)
+    model_tag : string
+        Tag of registered model's version (registry model)
+    """
+    alias_mapping = get_alias_mapping(model_name)
+    if alias in alias_mapping:
+        model_version, model_tag = alias_mapping[alias]
+    else:
+        model_version, model_tag = get_modelversion_and_tag(model_name=model_name, model_alias=alias)
+    model, input_shape, input_type = get_model_by_version(model_name, model_version, model_tag)
+
+    return model, input_shape, input_type, model_version, model_tag
+
+def get_model_by_version(model_name, model_version, model_tag, precision = None):
+    """
+    Returns a model version from the model cache. Loads it from the registry on the first call.
+    With FLOAT16_NON_CHAMPION=1, versions that aren't the champion are held with float16 weights.
+    Loading a model can evict the least recently used ones (memory budget MODEL_CACHE_BUDGET_MB).
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    model_version : int
+        The registered model's version number.
+    model_tag : string
+        Tag of the registered model's version.
+    precision : {None, "float32", "float16"}
+        Weight precision, if the model has to be loaded. None: float16 for non-champions 
+        with FLOAT16_NON_CHAMPION=1, float32 otherwise.
+        
+    Returns
+    -------
+    model: mlflow model
+    input_shape: tuple
+    input_type:
+        See load_model_from_registry().
+    """
+    key = (model_name, model_version)
+
+    with _model_cache_lock:
+        if key in _model_cache:
+            _model_cache.move_to_end(key)
+            return _model_cache[key]
+        loading_lock = _model_loading_locks.setdefault(key, threading.Lock())
+
+    with loading_lock:
+        # another thread might have loaded the model in the meantime
+        with _model_cache_lock:
+            if key in _model_cache:
+                _model_cache.move_to_end(key)
+                return _model_cache[key]
+        loaded_model = load_model_version_from_registry(model_name, model_version, model_tag)
+        if precision is None:
+            precision = "float16" if FLOAT16_NON_CHAMPION and model_version != _champion_version(model_name) else "float32"
+        if precision == "float16" and not _cast_weights_to_float16(loaded_model[0]):
+            precision = "float32"
+        _add_to_model_cache(key, loaded_model, precision)
+        return loaded_model
+
+def _champion_version(model_name):
+    """
+    Returns the version number the champion alias is served with.
+    """
+    alias_mapping = get_alias_mapping(model_name)
+    if "champion" in alias_mapping:
+        return alias_mapping["champion"][0]
+    return get_modelversion_and_tag(model_name=model_name, model_alias="champion")[0]
+
+def _add_to_model_cache(key, loaded_model, precision):
+    """
+    Inserts (or replaces) a model in the model cache, records its footprint and enforces the memory budget.
+    """
+    footprint = _model_footprint_bytes(loaded_model[0])
+    with _model_cache_lock:
+        _model_cache[key] = loaded_model
+        _model_cache.move_to_end(key)
+        _model_cache_info[key] = {"bytes": footprint, "precision": precision}
+        _enforce_model_cache_budget(protected_key=key)
+
+def _keras_model_of(model):
+    """
+    Returns the keras model inside an mlflow pyfunc model, None for other flavors (e.g. TFLite).
+    """
+    from tensorflow import keras
+
+    keras_model = getattr(model._model_impl, "model", None)
+    return keras_model if isinstance(keras_model, keras.Model) else None
+
+def _model_footprint_bytes(model):
+    """
+    Estimates the memory footprint of a model: size of the weights for keras models,
+    size of the artifact files otherwise (e.g. .tflite flatbuffer).
+    """
+    keras_model = _keras_model_of(model)
+    if keras_model is not None:
+        return int(sum(np.prod(weight.shape) * np.dtype(weight.dtype).itemsize for weight in keras_model.weights))
+
+    artifacts = getattr(getattr(model._model_impl, "context", None), "artifacts", None) or {}
+    footprint = 0
+    for path in artifacts.values():
+        if os.path.isdir(path):
+            footprint += sum(file.stat().st_size for file in Path(path).rglob("*") if file.is_file())
+        elif os.path.isfile(path):
+            footprint += os.path.getsize(path)
+    return footprint
+
+def _cast_weights_to_float16(model):
+    """
+    Replaces the keras model inside an mlflow pyfunc model by a float16 clone (weights and computation, 
+    nested models such as the transfer learning base included). Inputs keep their types, the outputs 
+    are cast back to float32. Returns False for models that can't be cast (non-keras flavors).
+    """
+    from tensorflow import keras
+
+    keras_model = _keras_model_of(model)
+    if keras_model is None:
+        return False
+
+    def clone_layer_as_float16(layer):
+        config = layer.get_config()
+        config["dtype"] = "float16"
+        return layer.__class__.from_config(config)
+
+    # recursive: the layers of nested models are cloned with clone_layer_as_float16() as well
+    float16_clone = keras.models.clone_model(keras_model, clone_function=clone_layer_as_float16, recursive=True)
+    float16_clone.set_weights([weight.astype(np.float16) for weight in keras_model.get_weights()])
+    outputs = keras.layers.Activation("linear", dtype="float32", name="output_float32")(float16_clone.outputs[0])
+    float16_model = keras.Model(inputs=float16_clone.inputs, outputs=outputs, name=keras_model.name)
+
+    # every weight has to be float16 (half the footprint), otherwise the float32 model is kept
+    float32_bytes = _model_footprint_bytes(model)
+    model._model_impl.model = float16_model
+    if 2 * _model_footprint_bytes(model) > float32_bytes:
+        model._model_impl.model = keras_model
+        print(f"Model {keras_model.name} can't be cast to float16 completely, it is kept with float32 weights.")
+        return False
+    return True
+
+def _enforce_model_cache_budget(protected_key):
+    """
+    Evicts least recently used models until the model cache fits into MODEL_CACHE_BUDGET_MB. Models without
+    alias are evicted first, the champion and protected_key (the model just loaded) are never evicted.
+    Has to be called under the model cache lock.
+    """
+    budget = MODEL_CACHE_BUDGET_MB * 1024 ** 2
+    used = sum(info["bytes"] for info in _model_cache_info.values())
+    if used <= budget:
+        return
+
+    # before the warm-up is done, the alias files are the reference
+    alias_mapping = _served_alias_mapping or read_alias_mapping()
+    aliased_versions = {model_version for model_version, _ in alias_mapping.values()}
+    champion_version = alias_mapping["champion"][0]
+    unaliased = [key for key in _model_cache if key[1] not in aliased_versions]
+    aliased = [key for key in _model_cache if key[1] in aliased_versions and key[1] != champion_version]
+    for key in unaliased + aliased:
+        if used <= budget:
+            break
+        if key == protected_key:
+            continue
+        used -= _model_cache_info.pop(key)["bytes"]
+        del _model_cache[key]
+        print(f"Evicted model {key[0]} version {key[1]} from the model cache (memory budget {MODEL_CACHE_BUDGET_MB} MB).")
+
+    if used > budget:
+        print(f"Model cache exceeds its memory budget: {used / 1024 ** 2:.1f} of {MODEL_CACHE_BUDGET_MB} MB used.")
+
+def set_model_precision(model_name, model_version, model_tag, precision):
+    """
+    Makes sure a cached model version is held with the given weight precision: casts a float32 model to 
+    float16 (in place), or reloads a float16 model with its original float32 weights (the cache entry 
+    is replaced, requests that already hold the float16 model finish with it).
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    model_version : int
+        The registered model's version number.
+    model_tag : string
+        Tag of the registered model's version.
+    precision : {"float32", "float16"}
+        
+    Returns
+    -------
+    None
+    """
+    key = (model_name, model_version)
+    with _model_cache_lock:
+        info = _model_cache_info.get(key)
+        cached_model = _model_cache.get(key)
+    if info is None or info["precision"] == precision:
+        return
+
+    if precision == "float16":
+        # the next predictions use the float16 clone
+        if _cast_weights_to_float16(cached_model[0]):
+            with _model_cache_lock:
+                info.update({"bytes": _model_footprint_bytes(cached_model[0]), "precision": "float16"})
+            print(f"Model {model_name} version {model_version} is now held with float16 weights.")
+        return
+
+    # build the replacement outside of the cache lock, the cached model keeps serving meanwhile
+    replacement = load_model_version_from_registry(model_name, model_version, model_tag)
+    warm_up_input = np.zeros((1, *replacement[1][1:]), dtype=replacement[2])
+    make_prediction(replacement[0], image_as_array=warm_up_input)
+    _add_to_model_cache(key, replacement, precision)
+    print(f"Model {model_name} version {model_version} is now held with {precision} weights.")
+
+def get_model_cache_status():
+    """
+    Returns the memory budget, the used memory and the cached models (least recently used first).
+
+    Returns
+    -------
+    status : dictionary
+    """
+    with _model_cache_lock:
+        models = [{"model": key[0], "version": key[1], "precision": _model_cache_info[key]["precision"], 
+                   "MB": round(_model_cache_info[key]["bytes"] / 1024 ** 2, 3)} for key in _model_cache]
+    return {
+        "budget MB": MODEL_CACHE_BUDGET_MB,
+        "used MB": round(sum(model["MB"] for model in models), 3),
+        "float16 non-champion": FLOAT16_NON_CHAMPION,
+        "models": models,
+        }
+
+def read_alias_mapping(model_name = MODEL_NAME, aliases = ALIASES):
+    """
+    Reads the current mapping from aliases to model versions (and tags) from the registry.
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    aliases : list of strings
+        
+    Returns
+    -------
+    alias_mapping : dictionary
+        (model version, model tag) for each alias.
+    """
+    return {alias: get_modelversion_and_tag(model_name=model_name, model_alias=alias) for alias in aliases}
+
+def get_alias_mapping(model_name = MODEL_NAME, aliases = ALIASES):
+    """
+    Returns the alias mapping the requests are served with. Once the models are warmed up, this is the
+    mapping held in memory: after an alias change it is only swapped (as a whole) when all newly referenced 
+    versions are loaded, see refresh_alias_mapping(). Requests take one snapshot of the mapping and 
+    finish on these versions, even if the aliases are switched in the meantime.
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    aliases : list of strings
+        
+    Returns
+    -------
+    alias_mapping : dictionary
+        (model version, model tag) for each alias.
+    """
+    served_alias_mapping = _served_alias_mapping
+    if served_alias_mapping is None or model_name != MODEL_NAME or set(aliases) != set(served_alias_mapping):
+        return read_alias_mapping(model_name, aliases)
+    return served_alias_mapping
+
+# local copies of model artifacts (see preload_model_artifacts()), keyed by (model name, version)
+_local_model_paths = {}
+# folders of the local copies, removed by remove_preloaded_model_artifacts()
+_preload_dirs = []
+
+def preload_model_artifacts(model_name = MODEL_NAME, aliases = ALIASES):
+    """
+    Downloads the artifacts of the aliased model versions into a local folder. Is meant to be run in 
+    the master process of a multi-worker setup (see gunicorn_conf.py): the workers inherit the local 
+    paths after fork and load their models from there (shared OS page cache, no registry roundtrip).
+    
+    Note: the tensorflow runtime isn't fork-safe (a model used or even loaded before the fork 
+    deadlocks in the workers), thus the models themselves are loaded after the fork.
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    aliases : list of strings
+        
+    Returns
+    -------
+    None
+    """
+    import mlflow
+
+    mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
+    preload_dir = tempfile.mkdtemp(prefix="xray_models_")
+    _preload_dirs.append(preload_dir)
+    for model_version, _ in read_alias_mapping(model_name, aliases).values():
+        if (model_name, model_version) in _local_model_paths:
+            continue
+        local_path = mlflow.artifacts.download_artifacts(
+            artifact_uri=f"models:/{model_name}/{model_version}",
+            dst_path=os.path.join(preload_dir, f"{model_name}_version-{model_version}"),
+            )
+        _local_model_paths[(model_name, model_version)] = local_path
+        print(f"Preloaded artifact of model {model_name} version {model_version} into {local_path}")
+
+def remove_preloaded_model_artifacts():
+    """
+    Removes the local copies of preload_model_artifacts(). Is meant to be run when the master process 
+    exits (see gunicorn_conf.py), i.e. after all workers have stopped.
+    """
+    import shutil
+
+    while _preload_dirs:
+        preload_dir = _preload_dirs.pop()
+        shutil.rmtree(preload_dir, ignore_errors=True)
+        print(f"Removed preloaded model artifacts in {preload_dir}")
+    _local_model_paths.clear()
+
+def warm_up_model_version(model_name, model_version, model_tag, precision = None):
+    """
+    Loads a model version into the model cache and runs one dummy prediction (builds the prediction graph).
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    model_version : int
+        The registered model's version number.
+    model_tag : string
+        Tag of the registered model's version.
+    precision : {None, "float32", "float16"}
+        See get_model_by_version().
+        
+    Returns
+    -------
+    None
+    """
+    model, input_shape, input_type = get_model_by_version(model_name, model_version, model_tag, precision)
+    # variable image sizes (-1) are warmed up with the default image size
+    dummy_input = np.zeros((1, *[256 if dim == -1 else dim for dim in input_shape[1:]]), dtype=input_type)
+    make_prediction(model, image_as_array=dummy_input)
+
+def warm_up_models(model_name = MODEL_NAME, aliases = ALIASES):
+    """
+    Loads the models of all given aliases into the model cache and runs one dummy prediction 
+    per model (builds the prediction graphs). Afterwards, the requests are served with the 
+    in-memory alias mapping, which is kept up to date by the alias watcher thread 
+    (see refresh_alias_mapping()). Sets the readiness flag when done.
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    aliases : list of strings
+        The aliases to be warmed up.
+        
+    Returns
+    -------
+    None
+    """
+    global _served_alias_mapping, _alias_watcher_thread
+
+    _warm_up_status["state"] = "warming up"
+    start = time.time()
+    try:
+        alias_mapping = read_alias_mapping(model_name, aliases)
+        for model_version, model_tag in set(alias_mapping.values()):
+            warm_up_model_version(model_name, model_version, model_tag)
+        if FUSED_ENSEMBLE and model_name == MODEL_NAME:
+            _warm_up_status["fused ensemble"] = get_fused_ensemble(alias_mapping) is not None
+    except Exception as e:
+        _warm_up_status["state"] = "failed"
+        _warm_up_status["error"] = repr(e)
+        raise
+
+    _warm_up_status["models"] = {alias: {"version": version, "tag": tag} for alias, (version, tag) in alias_mapping.items()}
+    if model_name == MODEL_NAME and set(aliases) == set(ALIASES):
+        _served_alias_mapping = alias_mapping
+        _alias_watcher_thread = threading.Thread(target=_watch_alias_files, name="alias-watcher", daemon=True)
+        _alias_watcher_thread.start()
+
+    _warm_up_status["state"] = "ready"
+    _warm_up_status["warm up seconds"] = round(time.time() - start, 2)
+    _models_ready.set()
+    print(f"All models warmed up in {time.time() - start:.2f} seconds.")
+
+def refresh_alias_mapping():
+    """
+    Hot model swap. Reads the alias files and compares them with the served alias mapping. If an alias 
+    changed, the newly referenced model versions are loaded and warmed up first (requests are still 
+    served with the old mapping meanwhile), then the served mapping is swapped in one assignment. 
+    Versions that lost their last alias are evicted from the model cache after a grace period 
+    (env variable MODEL_EVICTION_GRACE_SECONDS), such that in-flight requests can finish on them.
+
+    Parameters
+    ----------
+    No parameters
+        
+    Returns
+    -------
+    swapped : boolean
+        True if the served alias mapping has been swapped.
+    """
+    global _served_alias_mapping
+
+    with _alias_refresh_lock:
+        old_alias_mapping = _served_alias_mapping
+        new_alias_mapping = read_alias_mapping()
+        if old_alias_mapping is None or new_alias_mapping == old_alias_mapping:
+            return False
+
+        # preload newly referenced versions (no-op for cached ones, e.g. after a champion/challenger swap)
+        start = time.time()
+        for model_version, model_tag in set(new_alias_mapping.values()):
+            precision = "float32" if (model_version, model_tag) == new_alias_mapping["champion"] else None
+            warm_up_model_version(MODEL_NAME, model_version, model_tag, precision)
+        # a promoted champion is served with its original weights
+        if FLOAT16_NON_CHAMPION:
+            set_model_precision(MODEL_NAME, *new_alias_mapping["champion"], precision="float32")
+        # the fused ensemble of the new mapping is built before the swap
+        if FUSED_ENSEMBLE:
+            get_fused_ensemble(new_alias_mapping)
+
+        # atomic swap: requests see either the complete old or the complete new mapping
+        _served_alias_mapping = new_alias_mapping
+        _warm_up_status["models"] = {alias: {"version": version, "tag": tag} for alias, (version, tag) in new_alias_mapping.items()}
+        print(f"Alias mapping swapped after {time.time() - start:.2f} seconds of preloading: {new_alias_mapping}")
+
+        # a demoted champion gives up its float32 weights
+        old_champion = old_alias_mapping["champion"]
+        if FLOAT16_NON_CHAMPION and old_champion != new_alias_mapping["champion"] and old_champion in new_alias_mapping.values():
+            set_model_precision(MODEL_NAME, *old_champion, precision="float16")
+            if FUSED_ENSEMBLE:
+                get_fused_ensemble(new_alias_mapping)
+
+        # schedule eviction of versions without alias
+        new_versions = {model_version for model_version, _ in new_alias_mapping.values()}
+        for model_version, _ in old_alias_mapping.values():
+            if model_version not in new_versions:
+                timer = threading.Timer(MODEL_EVICTION_GRACE_SECONDS, _evict_unaliased_model_version, args=(MODEL_NAME, model_version))
+                timer.daemon = True
+                timer.start()
+        return True
+
+def notify_alias_change():
+    """
+    Wakes up the alias watcher, such that an alias change is picked up right away (instead of 
+    after the next poll interval). Returns immediately, the preload runs in the watcher thread.
+    """
+    _alias_change_event.set()
+
+def _watch_alias_files():
+    """
+    Target of the alias watcher thread. Refreshes the alias mapping every ALIAS_POLL_SECONDS 
+    (alias changes of other worker processes) or as soon as notify_alias_change() is called.
+    """
+    while True:
+        _alias_change_event.wait(ALIAS_POLL_SECONDS)
+        _alias_change_event.clear()
+        try:
+            refresh_alias_mapping()
+        except Exception:
+            # the old mapping is kept, the next poll retries
+            traceback.print_exc()
+
+def _evict_unaliased_model_version(model_name, model_version):
+    """
+    Removes a model version from the model cache, unless it has been given an alias again in the meantime.
+    """
+    served_alias_mapping = _served_alias_mapping or {}
+    if model_version in {version for version, _ in served_alias_mapping.values()}:
+        return
+    with _model_cache_lock:
+        if _model_cache.pop((model_name, model_version), None) is not None:
+            _model_cache_info.pop((model_name, model_version), None)
+            print(f"Evicted model {model_name} version {model_version} from the model cache.")
+
+def get_readiness():
+    """
+    Returns whether the aliased models are warm, together with the warm-up status.
+
+    Returns
+    -------
+    ready : boolean
+    status : dictionary
+        State of the warm-up, warmed up model versions and tags per alias, error (if any).
+    """
+    return _models_ready.is_set(), dict(_warm_up_status)
+
+' ##############################################################################################'
+' ######################### fused ensemble (all aliases in one graph) ##########################'
+
+# predict all aliased keras models in one graph execution (env variable FUSED_ENSEMBLE=1), see predict_with_fused_ensemble()
+FUSED_ENSEMBLE = os.environ.get("FUSED_ENSEMBLE", "0") == "1"
+
+# fused ensembles (tf.function), keyed as in _fused_ensemble_branches(). The ensemble of the previous alias mapping is 
+# kept for requests that still hold it. Ensembles hold references to their keras models, i.e. evicted versions are 
+# freed once their ensemble is dropped.
+_fused_ensembles = OrderedDict()
+FUSED_ENSEMBLES_KEPT = 2
+_fused_ensemble_lock = threading.Lock()
+
+def _fused_ensemble_branches(model_name, alias_mapping):
+    """
+    Returns (keras model, input shape, input type) per aliased model version, taken from the model cache, 
+    together with the key of the ensemble. None, if a version isn't a keras model (e.g. TFLite).
+    """
+    branches = {}
+    for model_version, model_tag in sorted(set(alias_mapping.values())):
+        model, input_shape, input_type = get_model_by_version(model_name, model_version, model_tag)
+        keras_model = _keras_model_of(model)
+        if keras_model is None:
+            return None, None
+        branches[model_version] = (keras_model, tuple(input_shape), np.dtype(input_type))
+    # a rebuilt cache entry (e.g. other weight precision) is a new keras model
+    key = (model_name, tuple(sorted(alias_mapping.items())), tuple((version, id(branch[0])) for version, branch in branches.items()))
+    return branches, key
+
+def build_fused_ensemble(branches):
+    """
+    Builds one tf.function that takes a grayscale uint8 image (height x width x 1, any size) and returns the 
+    predictions of all branches (model versions). The preprocessing of resize_image() runs in the graph, once 
+    per input signature, and is shared by the branches with the same signature. The branches are independent 
+    ops of one graph, such that tensorflow can run them in parallel.
+
+    Parameters
+    ----------
+    branches : dictionary
+        (keras model, input shape, input type) per model version, see _fused_ensemble_branches().
+        
+    Returns
+    -------
+    predict_all : tf.function
+        Takes a uint8 tensor (height x width x 1), returns a float32 scalar tensor per model version.
+    """
+    import tensorflow as tf
+    from tensorflow import keras
+
+    def preprocess(image, input_shape, input_type):
+        # same steps as resize_image(): models with variable image size resize in their own graph
+        if input_shape[1] == -1 and input_shape[2] == -1:
+            formatted_image = image
+        else:
+            formatted_image = keras.ops.image.resize(image, size = (input_shape[1], input_shape[2]), interpolation="bilinear")
+            if input_shape[-1] > 1:
+                formatted_image = tf.repeat(formatted_image, input_shape[-1], axis = -1)
+        return tf.cast(formatted_image[tf.newaxis], input_type)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, None, 1), dtype=tf.uint8)])
+    def predict_all(image):
+        formatted_images = {}
+        predictions = {}
+        for model_version, (keras_model, input_shape, input_type) in branches.items():
+            signature = (input_shape[1:], input_type.name)
+            if signature not in formatted_images:
+                formatted_images[signature] = preprocess(image, input_shape, input_type)
+            prediction = keras_model(formatted_images[signature], training=False)
+            predictions[model_version] = tf.cast(tf.reshape(prediction, []), tf.float32)
+        return predictions
+
+    return predict_all
+
+def get_fused_ensemble(alias_mapping, model_name = MODEL_NAME):
+    """
+    Returns the fused ensemble of an alias mapping. A new ensemble is built (and traced) whenever the alias 
+    mapping or one of the cached models changes, e.g. after a champion/challenger switch.
+
+    Parameters
+    ----------
+    alias_mapping : dictionary
+        (model version, model tag) for each alias, as returned by get_alias_mapping().
+    model_name : string
+        The registered model's name.
+        
+    Returns
+    -------
+    predict_all : tf.function or None
+        See build_fused_ensemble(). None, if not all aliased models are keras models.
+    """
+    branches, key = _fused_ensemble_branches(model_name, alias_mapping)
+    if branches is None:
+        return None
+
+    with _fused_ensemble_lock:
+        if key not in _fused_ensembles:
+            start = time.time()
+            predict_all = build_fused_ensemble(branches)
+            # trace the graph before it is served
+            predict_all(np.zeros((256, 256, 1), dtype=np.uint8))
+            _fused_ensembles[key] = predict_all
+            while len(_fused_ensembles) > FUSED_ENSEMBLES_KEPT:
+                _fused_ensembles.popitem(last=False)
+            print(f"Fused ensemble of versions {sorted(branches)} built in {time.time() - start:.2f} seconds.")
+        _fused_ensembles.move_to_end(key)
+        return _fused_ensembles[key]
+
+def predict_with_fused_ensemble(img, alias_mapping, model_name = MODEL_NAME):
+    """
+    Predicts an image with the models of all aliases in one call of the fused ensemble.
+
+    Parameters
+    ----------
+    img : numpy array
+        Grayscale image.
+    alias_mapping : dictionary
+        (model version, model tag) for each alias, as returned by get_alias_mapping().
+    model_name : string
+        The registered model's name.
         
+    Returns
+    -------
+    predictions : dictionary or None
+        Prediction (float between 0 and 1) for each alias. None, if the image isn't a grayscale uint8 image 
+        or the models can't be fused, the models are called one by one then (predict_with_model_version()).
+    """
+    image_array = np.asarray(img)
+    if image_array.dtype != np.uint8 or not (image_array.ndim == 2 or (image_array.ndim == 3 and image_array.shape[-1] == 1)):
+        return None
+
+    predict_all = get_fused_ensemble(alias_mapping, model_name)
+    if predict_all is None:
+        return None
+
+    predictions = predict_all(image_array.reshape((*image_array.shape[:2], 1)))
+    return {alias: float(predictions[model_version]) for alias, (model_version, _) in alias_mapping.items()}
+
+' ##############################################################################################'
+' ######################### cascade inference (champion response) ##############################'
+
+# thresholds of the cascade, calibrated offline on data/test per (cheap version, heavy version), see calibrate_cascade.py
+CASCADE_THRESHOLDS_PATH = os.path.join(PROJECT_FOLDER, "data/cascade_thresholds.json")
+# the cheap model of the cascade (the own CNN), the heavy model is the champion
+CASCADE_CHEAP_ALIAS = "baseline"
+# fraction of the non-escalated cascade requests on which the champion runs in the background (its own score is
+# logged then, the served cheap score otherwise)
+CASCADE_CHAMPION_MONITORING_RATE = float(os.environ.get("CASCADE_CHAMPION_MONITORING_RATE", 0.1))
+
+# loaded calibrations: (file modification time, {"[cheap version]-[heavy version]": calibration})
+_cascade_calibrations = {"modification time": None, "calibrations": {}}
+# served cascade requests: total, escalated to the heavy model, uncalibrated (heavy model only),
+# heavy predictions (escalated, or predicted in the background for the monitoring sample)
+_cascade_counts = {"requests": 0, "escalated": 0, "uncalibrated": 0, "heavy predictions": 0}
+_cascade_lock = threading.Lock()
+
+def cascade_key(cheap_version, heavy_version):
+    """
+    Returns the key of a calibration in the thresholds file.
+    """
+    return f"{cheap_version}-{heavy_version}"
+
+def get_cascade_thresholds(cheap_version, heavy_version):
+    """
+    Returns the uncertainty band (low, high) of a cheap and a heavy model version. The thresholds file
+    is reloaded when it has been rewritten (calibrate_cascade.py).
+
+    Parameters
+    ----------
+    cheap_version : int
+        Version number of the cheap model.
+    heavy_version : int
+        Version number of the heavy model.
+        
+    Returns
+    -------
+    thresholds : tuple or None
+        (low, high), cheap scores strictly inside the band are escalated. None, if the pair isn't calibrated.
+    """
+    import json
+
+    modification_time = os.path.getmtime(CASCADE_THRESHOLDS_PATH) if os.path.exists(CASCADE_THRESHOLDS_PATH) else None
+    with _cascade_lock:
+        if _cascade_calibrations["modification time"] != modification_time:
+            calibrations = {}
+            if modification_time is not None:
+                with open(CASCADE_THRESHOLDS_PATH) as file:
+                    calibrations = json.load(file)
+            _cascade_calibrations["modification time"], _cascade_calibrations["calibrations"] = modification_time, calibrations
+        calibration = _cascade_calibrations["calibrations"].get(cascade_key(cheap_version, heavy_version))
+
+    if calibration is None:
+        return None
+    return calibration["low"], calibration["high"]
+
+def predict_with_cascade(img, alias_mapping, file_name = None, checksum = None):
+    """
+    Cascade for the champion response: the cheap model (CASCADE_CHEAP_ALIAS) predicts first, the champion only 
+    if the cheap score is inside the calibrated uncertainty band (or the pair of versions isn't calibrated).
+    Every request logs a champion row: the champion's own score if it ran (escalated, or non-escalated requests 
+    sampled with CASCADE_CHAMPION_MONITORING_RATE, predicted in the background), the served cheap score otherwise.
+
+    Parameters
+    ----------
+    img : numpy array
+        Grayscale image.
+    alias_mapping : dictionary
+        (model version, model tag) for each alias, as returned by get_alias_mapping().
+    file_name : string or None
+        See predict_or_replay().
+    checksum : int or None
+        See predict_or_replay().
+        
+    Returns
+    -------
+    y_pred : float (0 <= y_pred <=1)
+        Prediction of the cascade.
+    predictions : dictionary
+        Predictions per alias known already (logged by complete_champion_first_request(), the missing 
+        aliases are predicted in the background).
+    escalated : boolean
+        True if the champion's prediction is returned.
+    """
+    cheap_version, cheap_tag = alias_mapping[CASCADE_CHEAP_ALIAS]
+    heavy_version, heavy_tag = alias_mapping["champion"]
+    thresholds = get_cascade_thresholds(cheap_version, heavy_version)
+    predictions = {}
+    if thresholds is not None:
+        predictions[CASCADE_CHEAP_ALIAS] = predict_or_replay(img, cheap_version, cheap_tag, file_name=file_name, checksum=checksum)
+        low, high = thresholds
+        if not low < predictions[CASCADE_CHEAP_ALIAS] < high:
+            monitor_champion = random.random() < CASCADE_CHAMPION_MONITORING_RATE
+            if not monitor_champion:
+                # the champion row holds the served prediction
+                predictions["champion"] = predictions[CASCADE_CHEAP_ALIAS]
+            with _cascade_lock:
+                _cascade_counts["requests"] += 1
+                _cascade_counts["heavy predictions"] += monitor_champion
+            return predictions[CASCADE_CHEAP_ALIAS], predictions, False
+
+    predictions["champion"] = predict_or_replay(img, heavy_version, heavy_tag, file_name=file_name, checksum=checksum)
+    with _cascade_lock:
+        _cascade_counts["requests"] += 1
+        _cascade_counts["escalated"] += 1
+        _cascade_counts["uncalibrated"] += thresholds is None
+        _cascade_counts["heavy predictions"] += 1
+    return predictions["champion"], predictions, True
+
+def get_cascade_status():
+    """
+    Returns the thresholds of the served cheap/champion pair and the escalation counters of this worker.
+
+    Returns
+    -------
+    status : dictionary
+    """
+    alias_mapping = get_alias_mapping()
+    cheap_version, heavy_version = alias_mapping[CASCADE_CHEAP_ALIAS][0], alias_mapping["champion"][0]
+    with _cascade_lock:
+        counts = dict(_cascade_counts)
+    return {
+        "cheap version": cheap_version,
+        "heavy version": heavy_version,
+        "thresholds": get_cascade_thresholds(cheap_version, heavy_version),
+        **counts,
+        "champion monitoring rate": CASCADE_CHAMPION_MONITORING_RATE,
+        "escalation fraction": counts["escalated"] / counts["requests"] if counts["requests"] else None,
+        "heavy prediction fraction": counts["heavy predictions"] / counts["requests"] if counts["requests"] else None,
+        }
+
+' ##############################################################################################'
+' ######################### prediction replay (simulation traffic) #############################'
+
+# replay mode: predictions of data/test images are looked up in precomputed tables (see build_prediction_replay.py)
+REPLAY_PREDICTIONS = os.environ.get("REPLAY_PREDICTIONS", "0") == "1"
+REPLAY_PATH = os.path.join(PROJECT_FOLDER, "data/prediction_replay")
+
+# loaded replay tables, keyed by (model name, version): (file modification time, {file name: (checksum, prediction)})
+_replay_tables = {}
+_replay_tables_lock = threading.Lock()
+
+def replay_table_path(model_name, model_version):
+    """
+    Returns the path of the replay table of a model version.
+    """
+    return os.path.join(REPLAY_PATH, f"{model_name}_version-{model_version}.npz")
+
+def replay_checksum(image_bytes):
+    """
+    Returns the CRC32 of an uploaded image file in replay mode (None otherwise). Replayed predictions 
+    are only used if the checksum matches, i.e. for exactly the image file the table was built from.
+    """
+    return zlib.crc32(image_bytes) if REPLAY_PREDICTIONS else None
+
+def get_replayed_prediction(model_name, model_version, file_name, checksum):
+    """
+    Looks up the prediction of a model version for an image file in the replay table.
+
+    Parameters
+    ----------
+    model_name : string
+        The registered model's name.
+    model_version : int
+        The registered model's version number.
+    file_name : string
+        Name of the image file.
+    checksum : int
+        CRC32 of the image file.
+        
+    Returns
+    -------
+    y_pred : float or None
+        Prediction of the model, None if there is no (matching) entry.
+    """
+    path = replay_table_path(model_name, model_version)
+    modification_time = os.path.getmtime(path) if os.path.exists(path) else None
+
+    key = (model_name, model_version)
+    with _replay_tables_lock:
+        # (re)load the table, if it has been (re)built since it was loaded
+        if key not in _replay_tables or _replay_tables[key][0] != modification_time:
+            table = {}
+            if modification_time is not None:
+                with np.load(path) as data:
+                    table = dict(zip(data["filenames"].tolist(), zip(data["checksums"].tolist(), data["predictions"].tolist())))
+                print(f"Loaded replay table of model {model_name} version {model_version} ({len(table)} images).")
+            _replay_tables[key] = (modification_time, table)
+        entry = _replay_tables[key][1].get(file_name)
+
+    if entry is None or entry[0] != checksum:
+        return None
+    return entry[1]
+
 ' ##############################################################################################'
 ' ######################### logging of prediction data #########################################'
 
-def save_performance_data_csv(alias, timestamp, y_true, y_pred, accuracy, file_name, model_version, model_tag):
+def save_performance_data_csv(alias, timestamp, y_true, y_pred, accuracy, file_name, model_version, model_tag, log_counter = None):
     """
     Recieves data from a model's prediction to generate performance review. 
     Saves the retrieved data and some additional calculations in a csv-file under a specified path.
@@ -373,6 +1577,9 @@ def save_performance_data_csv(alias, timestamp, y_true, y_pred, accuracy, file_n
         Version number of mlflow registry model version
     model_tag : string
         Tag of mlflow registry model version
+    log_counter : int or None
+        Log counter of the prediction (see allocate_log_counter()). If None, the log counter 
+        of the last row in the csv-file is incremented.
 
     Returns
     -------
@@ -390,19 +1597,9 @@ def save_performance_data_csv(alias, timestamp, y_true, y_pred, accuracy, file_n
     os.makedirs(tracking_path, exist_ok=True)
     file_path = os.path.join(tracking_path, f'performance_data_{alias}.csv')
     
-    # initializing standard values for cumulative and global values
-    log_counter = 1
-    
     # Calculate consecutive values from last row's values and current values
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            rows = list(reader)
-            
-            if rows:
-                last_row = rows[-1]
-                # get values of last row to determine cumulations and global accuracy
-                log_counter = int(last_row['log_counter']) + 1
+    if log_counter is None:
+        log_counter = _read_last_log_counter(file_path) + 1
 
     # prepare data for output (formatting)
     data = {
@@ -435,6 +1632,75 @@ def save_performance_data_csv(alias, timestamp, y_true, y_pred, accuracy, file_n
 
     return data
 
+def _read_last_log_counter(file_path):
+    """
+    Returns the log counter of the last row of a csv-file of performance data (0 if there is no row).
+    """
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, 'r') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    return int(rows[-1]['log_counter']) if rows else 0
+
+@contextmanager
+def tracking_lock():
+    """
+    Context manager holding an exclusive lock on the performance tracking folder. Serializes the 
+    csv logging, the model switch and the log counter across threads and worker processes.
+    """
+    os.makedirs(TRACKING_PATH, exist_ok=True)
+    with open(os.path.join(TRACKING_PATH, ".lock"), "a+") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+            lock_file.seek(0)
+            # msvcrt gives up after 10 seconds, keep trying
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def allocate_log_counter():
+    """
+    Returns the next cluster-wide log counter. The last counter is persisted in the performance 
+    tracking folder, such that it is shared by all worker processes and monotonic across restarts.
+    Has to be called under tracking_lock().
+
+    Returns
+    -------
+    log_counter : int
+    """
+    counter_path = os.path.join(TRACKING_PATH, "log_counter.txt")
+    
+    if os.path.exists(counter_path):
+        with open(counter_path, 'r') as file:
+            last_log_counter = int(file.read().strip())
+    else:
+        # initialize from existing csv logs
+        last_log_counter = max(_read_last_log_counter(os.path.join(TRACKING_PATH, f'performance_data_{alias}.csv')) for alias in ALIASES)
+
+    log_counter = last_log_counter + 1
+
+    # write to a temp file first, such that the counter file is never left half-written
+    temp_path = counter_path + ".tmp"
+    with open(temp_path, 'w') as file:
+        file.write(str(log_counter))
+    os.replace(temp_path, counter_path)
+
+    return log_counter
+
 def save_performance_data_mlflow(log_counter, alias, timestamp, y_true, y_pred, accuracy, file_name, model_version, model_tag):
     """
     For a given alias, it stores the received logging data from model predicitons (runs) in a unique mlflow run of the corresponding experiment.
@@ -465,7 +1731,10 @@ def save_performance_data_mlflow(log_counter, alias, timestamp, y_true, y_pred,
     None
     """ 
     
+    import mlflow
+
     # set experiment name for model (logging performance for each model in separate experiment)
+    mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
     mlflow.set_experiment(f"performance {alias}")
 
     # logging of metrics
@@ -518,8 +1787,10 @@ def get_performance_indicators_mlflow(num_steps_short_term):
     
     '''
 
+    from mlflow import MlflowClient
+
     # setting the uri 
-    client = MlflowClient(tracking_uri="http://127.0.0.1:8080")
+    client = MlflowClient(tracking_uri=MLFLOW_TRACKING_URI)
         
     # get the three experiments: performance + (baseline, challenger, champion)
     print("getting experiment list")
@@ -681,6 +1952,9 @@ def generate_model_comparison_plot(window = 50, scaling =  "log_counter"):
         Figure comparing the performance of models.
     
     '''
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
     
     # get absolute path of the project dir
     project_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -810,6 +2084,9 @@ def generate_confusion_matrix_plot(last_n_predictions = 10):
         Figure of confusion matrix.
     
     '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # get data from csv performance report
     data = get_performance_indicators_csv(alias = "champion", last_n_predictions=last_n_predictions)
 
@@ -852,6 +2129,58 @@ def generate_confusion_matrix_plot(last_n_predictions = 10):
     
     return fig
 
+def figure_to_png_bytes(figure):
+    """
+    Renders a matplotlib figure as png and closes it.
+
+    Parameters
+    ----------
+    figure : matplotlib figure object
+        
+    Returns
+    -------
+    binary_image : bytes
+        Png image.
+    """
+    import matplotlib.pyplot as plt
+
+    # create an in-memory buffer to hold the figure
+    buffer = io.BytesIO()
+    
+    # save the plot in the buffer as a png
+    figure.savefig(buffer, format="png")
+    
+    # close the fig
+    plt.close(figure)
+    
+    # extract the binary image from the buffer
+    return buffer.getvalue()
+
+# pyplot's state machine isn't thread-safe, plots are generated one at a time
+_pyplot_lock = threading.Lock()
+
+def render_plot_as_png(generate_figure, *args, **kwargs):
+    """
+    Generates a figure with generate_figure(*args, **kwargs) and renders it as png. 
+    Can be called from worker threads (non-interactive backend, plot generation serialized).
+
+    Parameters
+    ----------
+    generate_figure : callable
+        Plot function returning a matplotlib figure, e.g. generate_confusion_matrix_plot.
+        
+    Returns
+    -------
+    binary_image : bytes
+        Png image.
+    """
+    import matplotlib
+
+    with _pyplot_lock:
+        matplotlib.use("Agg")
+        figure = generate_figure(*args, **kwargs)
+        return figure_to_png_bytes(figure)
+
 ' ##############################################################################################'
 ' ######################## model comparison and takeover (switch) functions ####################'
 
@@ -998,21 +2327,29 @@ def switch_champion_and_challenger():
         reader = csv.DictReader(csvfile)
         rows_chall = list(reader)
         rows_chall[-1]["model_switch"]="True"
-    with open(path_challenger_csv, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=rows_chall[0].keys())
-        writer.writeheader()
-        writer.writerows(rows_chall)
+    _write_csv_atomically(path_challenger_csv, rows_chall)
     # update champion csv-files of predictions: mark model switch
     with open(path_champion_csv, 'r') as csvfile:
         reader = csv.DictReader(csvfile)
         rows_champ = list(reader)
         rows_champ[-1]["model_switch"]="True"
-    with open(path_champion_csv, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=rows_champ[0].keys())
-        writer.writeheader()
-        writer.writerows(rows_champ)
+    _write_csv_atomically(path_champion_csv, rows_champ)
     print("challenger and champion have been switched")
 
+    # the served alias mapping is swapped in the background (hot model swap, see refresh_alias_mapping())
+    notify_alias_change()
+
+def _write_csv_atomically(file_path, rows):
+    """
+    Rewrites a csv-file via a temp file, such that readers never see a truncated file.
+    """
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=rows[0].keys())
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(temp_path, file_path)
+
 
 
 # if run locally (for tests)
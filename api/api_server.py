@@ -1,15 +1,16 @@
 import uvicorn
-import numpy as np
-from fastapi import FastAPI, UploadFile, File, Form, Query, Response
+from fastapi import FastAPI, UploadFile, File, Form, Query, Response, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from enum import Enum
-import mlflow
 import api_helpers as ah
-from datetime import datetime
+from api_background import BackgroundWorkQueue
+from api_admission import AdmissionController
 from fastapi.middleware.cors import CORSMiddleware # middleware. requirement for frontend-suitable endpoint
-import matplotlib.pyplot as plt
-import io
-from PIL import Image
+from contextlib import asynccontextmanager
+from datetime import datetime
+import os
+import threading
 
 
 """ 
@@ -17,6 +18,35 @@ run app by running "fastapi run FastAPIserver.py" in terminal.
 Go to localhost = 127.0.0.1. Add "/docs" to url to get to API-frontend and check endpoints!
 Works when called from any directory level in project folder. Best, start from subfolder "api". 
 Here the explicit call to be run from terminal: uvicorn api_server:app --host 0.0.0.0 --port 8000 (127.0.0.1 for local)
+
+Fast start: tensorflow, mlflow and the plotting libraries are only imported when needed. At startup, the aliased
+models are loaded and warmed up in a background thread, the endpoint /ready reports when this is done.
+Set the env variable WARM_UP_MODELS=0 for workers that only serve plots or performance reviews.
+
+Champion-first mode (env variable CHAMPION_FIRST=1): the prediction endpoints return the champion's prediction 
+right away. Challenger and baseline predictions, logging and the model switch check run on a bounded background 
+work queue (size: env variable BACKGROUND_QUEUE_SIZE), which is drained when the server shuts down.
+
+Admission control: every endpoint class (inference, bulk, plots and reviews) has a concurrency limit, a queue bound 
+and a request deadline (see api_admission.py), overload is rejected with status code 429/503 and a Retry-After header.
+The counters are served by the endpoint /admission_stats.
+
+Cascade mode (env variable CASCADE_INFERENCE=1): like champion-first mode, but the response comes from a cascade. The cheap
+baseline model predicts first, the champion only if the baseline's score is inside the uncertainty band calibrated by
+calibrate_cascade.py (see ah.predict_with_cascade()). All three aliases are logged in the background for every request.
+The champion row holds the champion's own score if it ran (escalated requests, and a sample of the others, env variable
+CASCADE_CHAMPION_MONITORING_RATE, default 0.1), the served baseline score otherwise. Escalation counters are served by
+the endpoint /cascade_stats.
+
+Replay mode (env variable REPLAY_PREDICTIONS=1): predictions of known data/test images (same file name and
+checksum) are looked up in tables built by build_prediction_replay.py, logging and model switch work as usual.
+
+Hot model swap: alias changes are picked up in the background, see ah.refresh_alias_mapping().
+
+Fused ensemble (env variable FUSED_ENSEMBLE=1): champion, challenger and baseline are predicted in one graph execution,
+see ah.predict_with_fused_ensemble().
+
+Multi-worker mode: gunicorn -c gunicorn_conf.py api_server:app (see gunicorn_conf.py)
 """
 
 
@@ -26,9 +56,75 @@ class Label(int, Enum):
     NEGATIVE = 0
     POSITIVE = 1
 
+' ################################################ serving mode  ################################'
+CHAMPION_FIRST = os.environ.get("CHAMPION_FIRST", "0") == "1"
+CASCADE_INFERENCE = os.environ.get("CASCADE_INFERENCE", "0") == "1"
+# the rest of a champion-first or cascade request runs on the background work queue
+BACKGROUND_COMPLETION = CHAMPION_FIRST or CASCADE_INFERENCE
+background_queue = BackgroundWorkQueue(maxsize=int(os.environ.get("BACKGROUND_QUEUE_SIZE", 100)))
+
+def classify_image(img, label, file_name, checksum = None):
+    """
+    Classifies an image with the aliased models, either all three models at once, in champion-first mode 
+    (only champion now, challenger and baseline in the background) or in cascade mode (baseline, and champion 
+    if the baseline is uncertain, now, the remaining models in the background).
+
+    Parameters
+    ----------
+    img : numpy array
+        Validated image.
+    label : int (0 or 1)
+        True label of the image.
+    file_name : string
+        Name of the uploaded file.
+    checksum : int or None
+        CRC32 of the uploaded file, used in replay mode (see ah.replay_checksum()).
+        
+    Returns
+    -------
+    y_pred_as_str : dictionary
+        Prediction values (as strings) per model alias.
+    """
+    if not BACKGROUND_COMPLETION:
+        return ah.classify_and_log_image(img=img, label=label, file_name=file_name, checksum=checksum)
+
+    api_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    alias_mapping = ah.get_alias_mapping()
+    if CASCADE_INFERENCE:
+        y_pred, predictions, escalated = ah.predict_with_cascade(img, alias_mapping, file_name=file_name, checksum=checksum)
+    else:
+        y_pred = ah.predict_or_replay(img, *alias_mapping["champion"], file_name=file_name, checksum=checksum)
+        predictions = {"champion": y_pred}
+    background_queue.submit(ah.complete_champion_first_request, img, label, file_name, api_timestamp, alias_mapping, predictions, checksum)
+
+    if CASCADE_INFERENCE:
+        return {"prediction champion": str(y_pred), "cascade escalated": str(escalated)}
+    return {"prediction champion": str(y_pred)}
+
+' ################################################ admission control  ##########################'
+# concurrency limit, queue bound and deadline (seconds) per endpoint class, overridable by env variables
+admission_controllers = {
+    "inference": AdmissionController.from_env("inference", max_concurrent=4, max_queued=16, timeout=30),
+    "bulk": AdmissionController.from_env("bulk", max_concurrent=1, max_queued=2, timeout=600),
+    "plots": AdmissionController.from_env("plots", max_concurrent=2, max_queued=8, timeout=60),
+}
+
 ' ################################################ creating app  ################################'
+# warm up models in the background, such that the server accepts requests right away
+@asynccontextmanager
+async def lifespan(app):
+    if os.environ.get("WARM_UP_MODELS", "1") == "1":
+        threading.Thread(target=ah.warm_up_models, name="model-warm-up", daemon=True).start()
+    if BACKGROUND_COMPLETION:
+        background_queue.start()
+    yield
+    # drain the background queue, such that no prediction gets lost in the monitoring data
+    if BACKGROUND_COMPLETION:
+        print(f"Draining background queue ({background_queue.pending_jobs()} pending jobs)...")
+        background_queue.shutdown()
+
 # make app
-app = FastAPI(title = "Deploying an ML Model for Pneumonia Detection")
+app = FastAPI(title = "Deploying an ML Model for Pneumonia Detection", lifespan = lifespan)
 
 " ################################ middleware block for frontend-suitable endpoint ###############"
 # CORS-Middleware. Required for communication with frontend
@@ -49,10 +145,45 @@ def home():
     """
     return "root of this API"
 
+' ################################################## readiness endpoint ##########################'
+@app.get("/ready")
+def ready():
+    """
+    Readiness probe. Returns status code 200 once the champion, challenger and baseline models 
+    are loaded and warmed up, and 503 before that. The response body contains the warm-up status.
+    """
+    is_ready, status = ah.get_readiness()
+    return JSONResponse(content=status, status_code=200 if is_ready else 503)
+
+' ################################################## model cache endpoint ########################'
+@app.get("/model_cache")
+def model_cache():
+    """
+    Returns memory budget, used memory and the cached model versions (with weight precision) of this worker.
+    """
+    return ah.get_model_cache_status()
+
+' ################################################## admission stats endpoint ####################'
+@app.get("/admission_stats")
+def admission_stats():
+    """
+    Returns load and shed-load counters (rejected and abandoned requests) per endpoint class.
+    """
+    return {name: controller.stats() for name, controller in admission_controllers.items()}
+
+' ################################################## cascade stats endpoint ######################'
+@app.get("/cascade_stats")
+def cascade_stats():
+    """
+    Returns the cascade thresholds of the served baseline/champion pair and the escalation counters of this worker.
+    """
+    return {"cascade inference": CASCADE_INFERENCE, **ah.get_cascade_status()}
+
 ' ############################### model serving/prediction endpoint ###############################'
 # endpoint for uploading image
 @app.post("/upload_image")
 async def upload_image_with_label( 
+    request: Request,
     label: Label,
     file: UploadFile = File(...)
 ):
@@ -81,67 +212,18 @@ async def upload_image_with_label(
         One for each model alias, i.e. champion, challenger, baseline.
     """
 
-    # read the uploaded file into memory as bytes
-    image_bytes = await file.read()
+    async with admission_controllers["inference"].admit(request) as admission:
+        # read the uploaded file into memory as bytes
+        image_bytes = await file.read()
 
-    # validate image and return as numpy
-    img = ah.return_verified_image_as_numpy_arr(image_bytes)
-
-    # set tracking uri for mlflow
-    mlflow.set_tracking_uri("http://127.0.0.1:8080")
-
-    # vessel for API-output
-    y_pred_as_str = {}
-    
-    model_name = "Xray_classifier"
-    api_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # ########################### load, predict, log metric for champion and challenger ################'
-    for  alias in ["champion", "challenger", "baseline"]:
-        
-        # get model and signature
-        model, input_shape, input_type  = ah.load_model_from_registry(model_name = model_name, alias = alias)
-        
-        # get model version and tag for logging
-        model_version, model_tag = ah.get_modelversion_and_tag(model_name=model_name, model_alias=alias)
+        # validate image and return as numpy
+        img = await run_in_threadpool(ah.return_verified_image_as_numpy_arr, image_bytes)
 
-        # resize image according to signature
-        formatted_image = ah.resize_image(image=img, signature_shape = input_shape, signature_dtype=input_type)
-        
-        # make prediction
-        y_pred = ah.make_prediction(model, image_as_array=formatted_image)
-        accuracy_pred = int(label == np.around(y_pred))
-
-        # logging and precalculations in csv-file
-        logged_csv_data = ah.save_performance_data_csv(alias = alias, 
-                                                       timestamp = api_timestamp, 
-                                                       y_true = label.value, 
-                                                       y_pred = y_pred, 
-                                                       accuracy=accuracy_pred, 
-                                                       file_name=file.filename, 
-                                                       model_version=model_version, 
-                                                       model_tag=model_tag)
-
-        # switch off mlflow tracking (if needed)
-        mlflow_tracking = False 
-        if mlflow_tracking:
-            # logging in mlflow performance runs, if switched on
-            ah.save_performance_data_mlflow(log_counter = logged_csv_data["log_counter"], 
-                                            alias = alias, 
-                                            timestamp = logged_csv_data["timestamp"], 
-                                            y_true = label, 
-                                            y_pred = y_pred, 
-                                            accuracy = accuracy_pred, 
-                                            file_name = logged_csv_data["filename"], 
-                                            model_version = model_version, 
-                                            model_tag = model_tag)
-
-        # update dictionary for API-output
-        y_pred_as_str.update({f"prediction {alias}": str(y_pred)})
-    
-    print(f"Currently at run with log_counter number {logged_csv_data['log_counter']}.")
-    # check if switch should be made
-    if ah.check_challenger_takeover(last_n_predictions = 20, window = 50):
-        ah.switch_champion_and_challenger()
+        # classify with champion, challenger and baseline, log and check for model switch
+        await admission.check()
+        y_pred_as_str = await run_in_threadpool(
+            classify_image, img=img, label=label.value, file_name=file.filename, checksum=ah.replay_checksum(image_bytes),
+            )
     
     return y_pred_as_str
 
@@ -151,6 +233,7 @@ async def upload_image_with_label(
 # endpoint for analysing more images
 @app.post("/predict_several_images")
 async def predict_several_images( 
+    request: Request,
     n_samples: int
 ):
     """
@@ -167,11 +250,15 @@ async def predict_several_images(
         String confirming that all images were succesfully classified.
     """
     
-    # get the image paths
-    selected_image_paths = ah.get_image_paths(n_samples)
-
-    # peform classification + logging + model switch when needed
-    ah.predict_log_switch(selected_image_paths)
+    async with admission_controllers["bulk"].admit(request) as admission:
+        # get the image paths
+        selected_image_paths = await run_in_threadpool(ah.get_image_paths, n_samples)
+
+        # peform classification + logging + model switch when needed, stop when the deadline is exceeded
+        n_classified = await run_in_threadpool(ah.predict_log_switch, selected_image_paths, should_stop=admission.expired)
+        if n_classified < len(selected_image_paths):
+            # answered as abandoned request (503)
+            await admission.check()
        
     # return "All predictions done."
     return JSONResponse(content={"message": "All predictions done."})
@@ -181,6 +268,7 @@ async def predict_several_images(
 # endpoint for uploading image
 @app.post("/upload_image_from_frontend")
 async def upload_image_and_integer_from_frontend( 
+    request: Request,
     label: int = Form(...),
     file: UploadFile = File(...)
 ):
@@ -205,67 +293,69 @@ async def upload_image_and_integer_from_frontend(
     label = Label(label)
     print("label: ", label, "type label: ", type(label))
 
-    # read the uploaded file into memory as bytes
-    image_bytes = await file.read()
+    async with admission_controllers["inference"].admit(request) as admission:
+        # read the uploaded file into memory as bytes
+        image_bytes = await file.read()
 
-    # validate image and return as numpy
-    img = ah.return_verified_image_as_numpy_arr(image_bytes)
+        # validate image and return as numpy
+        img = await run_in_threadpool(ah.return_verified_image_as_numpy_arr, image_bytes)
 
-    # set tracking uri for mlflow
-    mlflow.set_tracking_uri("http://127.0.0.1:8080")
+        # classify with champion, challenger and baseline, log and check for model switch
+        await admission.check()
+        y_pred_as_str = await run_in_threadpool(
+            classify_image, img=img, label=label.value, file_name=file.filename, checksum=ah.replay_checksum(image_bytes),
+            )
 
-    # vessel for API-output
-    y_pred_as_str = {}
-    
-    model_name = "Xray_classifier"
-    api_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # ########################### load, predict, log metric for champion and challenger ################'
-    for  alias in ["champion", "challenger", "baseline"]:
-        
-        # get model and signature
-        model, input_shape, input_type  = ah.load_model_from_registry(model_name = model_name, alias = alias)
-        
-        # get model version and tag for logging
-        model_version, model_tag = ah.get_modelversion_and_tag(model_name=model_name, model_alias=alias)
+    return y_pred_as_str
 
-        # resize image according to signature
-        formatted_image = ah.resize_image(image=img, signature_shape = input_shape, signature_dtype=input_type)
+' ############################### raw tensor serving/prediction endpoint ###############################'
+# endpoint for uploading decoded pixel arrays
+@app.post("/upload_tensor")
+async def upload_tensor_with_label(
+    request: Request,
+    label: Label,
+    file_name: str = "tensor",
+):
+    """
+    Lets clients that already hold decoded pixel arrays (e.g. a PACS gateway) upload them without 
+    encoding them as image file. The request body is a uint8 tensor (height x width [x channels]):
+    - a .npy file, content type "application/x-npy", or
+    - raw bytes, content type "application/octet-stream", with the headers X-Tensor-Shape 
+      (e.g. "1024,1024") and X-Tensor-Dtype ("uint8").
+
+    The tensor is validated against the model signatures and classified like an uploaded image, 
+    see endpoint "upload_image".
+
+    Parameters
+    ----------
+    label : object of class Label, see definition on top of this script
+        Hold as human level prediction of the image
+    file_name : string
+        Name under which the prediction is logged.
         
-                # make prediction
-        y_pred = ah.make_prediction(model, image_as_array=formatted_image)
-        accuracy_pred = int(label == np.around(y_pred))
-
-        # logging and precalculations in csv-file
-        logged_csv_data = ah.save_performance_data_csv(alias = alias, 
-                                                       timestamp = api_timestamp, 
-                                                       y_true = label.value, 
-                                                       y_pred = y_pred, 
-                                                       accuracy=accuracy_pred, 
-                                                       file_name=file.filename, 
-                                                       model_version=model_version, 
-                                                       model_tag=model_tag)
-
-        # switch off mlflow tracking (if needed)
-        mlflow_tracking = False 
-        if mlflow_tracking:
-            # logging in mlflow performance runs, if switched on
-            ah.save_performance_data_mlflow(log_counter = logged_csv_data["log_counter"], 
-                                            alias = alias, 
-                                            timestamp = logged_csv_data["timestamp"], 
-                                            y_true = label, 
-                                            y_pred = y_pred, 
-                                            accuracy = accuracy_pred, 
-                                            file_name = logged_csv_data["filename"], 
-                                            model_version = model_version, 
-                                            model_tag = model_tag)
-
-        # update dictionary for API-output
-        y_pred_as_str.update({f"prediction {alias}": str(y_pred)})
-    
-    print(f"Currently at run with log_counter number {logged_csv_data['log_counter']}.")
-    # check if switch should be made
-    if ah.check_challenger_takeover(last_n_predictions = 20, window = 50):
-        ah.switch_champion_and_challenger()
+    Returns
+    -------
+    y_pred_as_str : string containing dictionaries
+        Contains three nested dictionaries with prediction values and logging parameters. 
+        One for each model alias, i.e. champion, challenger, baseline.
+    """
+
+    async with admission_controllers["inference"].admit(request) as admission:
+        # read the request body into memory as bytes
+        tensor_bytes = await request.body()
+
+        # validate tensor and return as numpy (view of the body)
+        img = await run_in_threadpool(
+            ah.return_verified_tensor_as_numpy_arr, 
+            tensor_bytes, 
+            content_type=request.headers.get("content-type", "").split(";")[0].strip(),
+            shape_header=request.headers.get("X-Tensor-Shape"),
+            dtype_header=request.headers.get("X-Tensor-Dtype"),
+            )
+
+        # classify with champion, challenger and baseline, log and check for model switch
+        await admission.check()
+        y_pred_as_str = await run_in_threadpool(classify_image, img=img, label=label.value, file_name=file_name)
 
     return y_pred_as_str
 
@@ -273,6 +363,7 @@ async def upload_image_and_integer_from_frontend(
 # endpoint for uploading image
 @app.post("/get_performance_review_from_mlflow")
 async def get_performance_mlflow(
+    request: Request,
     last_n_predictions: int,
     ):
     """
@@ -292,7 +383,8 @@ async def get_performance_mlflow(
     """
 
     # gets the dictionary for all three models
-    performance_dict = ah.get_performance_indicators_mlflow(num_steps_short_term = last_n_predictions)
+    async with admission_controllers["plots"].admit(request):
+        performance_dict = await run_in_threadpool(ah.get_performance_indicators_mlflow, num_steps_short_term = last_n_predictions)
 
     return performance_dict
 
@@ -301,6 +393,7 @@ async def get_performance_mlflow(
 # endpoint for uploading image
 @app.post("/get_performance_review_from_csv")
 async def get_performance_csv(
+    request: Request,
     last_n_predictions: int,
     ):
     """
@@ -318,9 +411,10 @@ async def get_performance_csv(
         Contains three dictionaries with performance tracking values of champion, challenger, baseline.
     """
     # get results generated from csv
-    csv_perf_dict_champion = ah.get_performance_indicators_csv(alias = "champion", last_n_predictions=last_n_predictions)
-    csv_perf_dict_challenger = ah.get_performance_indicators_csv(alias = "challenger",last_n_predictions=last_n_predictions)
-    csv_perf_dict_baseline = ah.get_performance_indicators_csv(alias = "baseline", last_n_predictions=last_n_predictions)
+    async with admission_controllers["plots"].admit(request):
+        csv_perf_dict_champion = await run_in_threadpool(ah.get_performance_indicators_csv, alias = "champion", last_n_predictions=last_n_predictions)
+        csv_perf_dict_challenger = await run_in_threadpool(ah.get_performance_indicators_csv, alias = "challenger",last_n_predictions=last_n_predictions)
+        csv_perf_dict_baseline = await run_in_threadpool(ah.get_performance_indicators_csv, alias = "baseline", last_n_predictions=last_n_predictions)
     merged_csv_dict = {
     **csv_perf_dict_baseline,
     **csv_perf_dict_challenger,
@@ -333,7 +427,7 @@ async def get_performance_csv(
 ' ######################## plotting endpoint: performance curve and aliases #####################'
 # endpoint for plot generation
 @app.post("/get_comparsion_plot")
-async def plot_model_comparison(window: int = 50):
+async def plot_model_comparison(request: Request, window: int = 50):
     
     '''
     Endpoint that displays a plot showing the moving average accuracy
@@ -342,23 +436,9 @@ async def plot_model_comparison(window: int = 50):
     Plot also indicates, which underlying model is champion or challenger at which run number.
     '''
 
-    # create the figure
-    figure = ah.generate_model_comparison_plot(window, scaling =  "log_counter")
-
-    # create an in-memory buffer to hold the figure
-    buffer = io.BytesIO()
-    
-    # save the plot in the buffer as a png
-    plt.savefig(buffer, format="png")
-    
-    # close the fig
-    plt.close(figure)
-    
-    # move the file pointer back to the start of the buffer so it can be read
-    buffer.seek(0)
-    
-    # extract the binary image from the buffer
-    binary_image = buffer.getvalue()
+    async with admission_controllers["plots"].admit(request):
+        # create the figure and render it as png
+        binary_image = await run_in_threadpool(ah.render_plot_as_png, ah.generate_model_comparison_plot, window, scaling =  "log_counter")
     
     # send the binary image as a png response to the client
     return Response(binary_image, media_type="image/png")
@@ -366,29 +446,15 @@ async def plot_model_comparison(window: int = 50):
 ' ######################## plotting endpoint: confusion matrix #####################'
 # endpoint for plot generation
 @app.post("/get_confusion_matrix_plot")
-async def plot_confusion_matrix(window: int = 50):
+async def plot_confusion_matrix(request: Request, window: int = 50):
     
     '''
     Endpoint that displays a plot showing the confusion matrix of the champion model for the last n predictions.  
     '''
 
-    # create the figure
-    figure = ah.generate_confusion_matrix_plot(window)
-    
-    # create an in-memory buffer to hold the figure
-    buffer = io.BytesIO()
-    
-    # save the plot in the buffer as a png
-    plt.savefig(buffer, format="png")
-    
-    # close the fig
-    plt.close(figure)
-    
-    # move the file pointer back to the start of the buffer so it can be read
-    buffer.seek(0)
-    
-    # extract the binary image from the buffer
-    binary_image = buffer.getvalue()
+    async with admission_controllers["plots"].admit(request):
+        # create the figure and render it as png
+        binary_image = await run_in_threadpool(ah.render_plot_as_png, ah.generate_confusion_matrix_plot, window)
     
     # send the binary image as a png response to the client
     return Response(binary_image, media_type="image/png")
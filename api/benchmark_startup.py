@@ -0,0 +1,98 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+"""
+This script benchmarks the startup of the API process. It reports:
+- the import time of api_helpers and api_server (each in a fresh python interpreter)
+- the time until the server accepts requests (root endpoint answers)
+- the time until the models are warm (endpoint /ready answers with status code 200)
+- the latency of the first and the second prediction request
+
+The server is started twice: with model warm-up at startup (default) and without (WARM_UP_MODELS=0),
+in the latter case the first prediction request has to load the models.
+
+HINT:
+- the mlflow server has to be running, the FastAPI server must NOT be running (port 8000 is used here)
+- the prediction requests are logged in the performance tracking csv-files like any other request
+"""
+
+' ################################ configuration #####################################'
+n_import_repeats = 3
+port = 8000
+base_url = f"http://127.0.0.1:{port}"
+startup_timeout = 600
+
+api_folder = Path(__file__).resolve().parent
+test_image = api_folder.parent / "data" / "test" / "NORMAL" / "IM-0001-0001.jpeg"
+
+' ################################ helper functions ##################################'
+def measure_import_time(module_name):
+    """
+    Returns the mean time (seconds) to import a module in a fresh python interpreter.
+    """
+    command = f"import time; start = time.perf_counter(); import {module_name}; print(time.perf_counter() - start)"
+    durations = []
+    for _ in range(n_import_repeats):
+        output = subprocess.run([sys.executable, "-c", command], cwd=api_folder, capture_output=True, text=True, check=True)
+        durations.append(float(output.stdout.strip().splitlines()[-1]))
+    return sum(durations) / len(durations)
+
+def wait_for(url, expected_status, start):
+    """
+    Polls url until it answers with expected_status. Returns the time (seconds) elapsed since start.
+    """
+    while time.perf_counter() - start < startup_timeout:
+        try:
+            if requests.get(url, timeout=1).status_code == expected_status:
+                return time.perf_counter() - start
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f"{url} did not answer with status code {expected_status} within {startup_timeout} seconds")
+
+def post_prediction():
+    """
+    Sends the test image to the prediction endpoint. Returns the request latency in seconds.
+    """
+    with open(test_image, "rb") as img:
+        start = time.perf_counter()
+        response = requests.post(f"{base_url}/upload_image", files={"file": (test_image.name, img, "image/jpeg")}, params={"label": 0})
+        latency = time.perf_counter() - start
+    response.raise_for_status()
+    return latency
+
+def benchmark_server(warm_up):
+    """
+    Starts the API server, measures the startup and first request latencies, stops the server.
+    """
+    env = {"WARM_UP_MODELS": "1" if warm_up else "0"}
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api_server:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=api_folder, env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    try:
+        results = {"accepting requests": wait_for(f"{base_url}/", 200, start)}
+        if warm_up:
+            results["models warm"] = wait_for(f"{base_url}/ready", 200, start)
+        results["first request latency"] = post_prediction()
+        results["second request latency"] = post_prediction()
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+' ################################ run benchmark #####################################'
+if __name__ == "__main__":
+    print(f"import api_helpers: {measure_import_time('api_helpers'):.3f} s")
+    print(f"import api_server: {measure_import_time('api_server'):.3f} s")
+
+    for warm_up in [True, False]:
+        print(f"\nserver start with model warm-up = {warm_up}")
+        for key, value in benchmark_server(warm_up).items():
+            print(f"  {key}: {value:.3f} s")
@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import api_helpers as ah
+
+"""
+This script builds the replay tables of the API's replay mode (env variable REPLAY_PREDICTIONS=1).
+
+Every image of data/test is scored once by every given model version. The predictions are stored per
+model version as compact NumPy file (data/prediction_replay/Xray_classifier_version-[version].npz) with
+the columns filenames, checksums (CRC32 of the image file) and predictions (float32).
+In replay mode, /predict_several_images and the upload endpoints look the predictions up instead of
+running the models (only if file name AND checksum match). Logging and model switch work as usual.
+
+The images are scored in parallel: the image list is split into shards, every worker process loads
+the model version once per shard and scores it with the same preprocessing as the API (batch size 1,
+hence the replayed predictions equal the live ones).
+
+HINT:
+- the mlflow server has to be running
+- model versions are immutable, tables only have to be rebuilt for new versions or changed test images
+  (a changed image file doesn't match its checksum anymore and is scored live)
+"""
+
+' ################################ configuration #####################################'
+model_name = ah.MODEL_NAME
+# model versions to be scored, None = versions that are currently aliased
+model_versions = None
+
+n_workers = os.cpu_count()
+# tensorflow threads per worker process
+threads_per_worker = 1
+shards_per_version = n_workers
+
+test_folder = Path(ah.PROJECT_FOLDER) / "data" / "test"
+
+' ################################ helper functions ##################################'
+def init_worker(n_threads):
+    """
+    Limits the tensorflow threads of a worker process.
+    """
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+
+def score_shard(model_version, model_tag, image_paths):
+    """
+    Scores a shard of images with a model version. Returns file names, checksums and predictions.
+    """
+    model, input_shape, input_type = ah.load_model_version_from_registry(model_name, model_version, model_tag)
+    checksums = []
+    predictions = []
+    for image_path in image_paths:
+        image_bytes = image_path.read_bytes()
+        img = ah.return_verified_image_as_numpy_arr(image_bytes)
+        formatted_image = ah.resize_image(image=img, signature_shape=input_shape, signature_dtype=input_type)
+        checksums.append(zlib.crc32(image_bytes))
+        predictions.append(ah.make_prediction(model, image_as_array=formatted_image))
+    return [image_path.name for image_path in image_paths], checksums, predictions
+
+def get_model_tags(versions):
+    """
+    Returns {model version: model tag}. None takes the currently aliased versions.
+    """
+    alias_mapping = ah.read_alias_mapping(model_name)
+    if versions is None:
+        return dict(alias_mapping.values())
+
+    import mlflow
+    from mlflow import MlflowClient
+
+    mlflow.set_tracking_uri(ah.MLFLOW_TRACKING_URI)
+    client = MlflowClient()
+    return {version: next(iter(client.get_model_version(model_name, str(version)).tags), "") for version in versions}
+
+' ################################ build replay tables ###############################'
+if __name__ == "__main__":
+    image_paths = sorted(test_folder.glob("*/*"))
+    shards = [shard.tolist() for shard in np.array_split(np.array(image_paths, dtype=object), shards_per_version) if len(shard)]
+    versions = get_model_tags(model_versions)
+    print(f"Scoring {len(image_paths)} images with model versions {sorted(versions)} on {n_workers} worker processes.")
+
+    start = time.perf_counter()
+    # spawned (not forked) workers, tensorflow isn't fork-safe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=init_worker, initargs=(threads_per_worker,)) as executor:
+        futures = {version: [executor.submit(score_shard, version, tag, shard) for shard in shards] for version, tag in versions.items()}
+
+        os.makedirs(ah.REPLAY_PATH, exist_ok=True)
+        for version, version_futures in futures.items():
+            filenames, checksums, predictions = [], [], []
+            for future in version_futures:
+                shard_filenames, shard_checksums, shard_predictions = future.result()
+                filenames += shard_filenames
+                checksums += shard_checksums
+                predictions += shard_predictions
+
+            # write via temp file, a running API reloads the table when its modification time changes
+            table_path = ah.replay_table_path(model_name, version)
+            temp_path = table_path + ".tmp.npz"
+            np.savez(
+                temp_path,
+                filenames=np.array(filenames),
+                checksums=np.array(checksums, dtype=np.uint32),
+                predictions=np.array(predictions, dtype=np.float32),
+                )
+            os.replace(temp_path, table_path)
+            print(f"Replay table of version {version} written to {table_path} ({len(filenames)} images).")
+
+    print(f"Replay tables built in {time.perf_counter() - start:.1f} seconds.")
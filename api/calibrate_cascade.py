@@ -0,0 +1,184 @@
+import json
+import os
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+import api_helpers as ah
+
+"""
+This script calibrates the thresholds of the API's cascade mode (env variable CASCADE_INFERENCE=1).
+
+In cascade mode, the cheap model (baseline alias, the own CNN) predicts first and the heavy model (champion)
+only if the cheap score is inside an uncertainty band (low, high). The band is calibrated on data/test:
+the narrowest band (fewest escalated images) whose cascade accuracy is at most max_accuracy_loss below the
+accuracy of the heavy model alone.
+
+Report per accuracy loss of report_accuracy_losses:
+- thresholds, accuracy of the cascade
+- fraction of the images (traffic) that escalates to the heavy model
+- mean latency of the cascade: cheap latency + escalation fraction * heavy latency (single images, API preprocessing)
+
+The thresholds for max_accuracy_loss are written to data/cascade_thresholds.json (one entry per pair of versions),
+a running API reloads the file when it changes.
+
+HINT:
+- the mlflow server has to be running
+- predictions are taken from the replay tables where possible (see build_prediction_replay.py)
+"""
+
+' ################################ configuration #####################################'
+model_name = ah.MODEL_NAME
+# model versions of the cascade, None = versions that are currently aliased (baseline, champion)
+cheap_version = None
+heavy_version = None
+
+max_accuracy_loss = 0.01
+report_accuracy_losses = [0.0, 0.005, 0.01, 0.02, 0.05]
+
+# images for the latency measurement
+latency_samples = 50
+
+test_folder = Path(ah.PROJECT_FOLDER) / "data" / "test"
+
+' ################################ helper functions ##################################'
+def get_model_tag(version, alias):
+    """
+    Returns (model version, model tag). None takes the version of the alias.
+    """
+    if version is None:
+        return ah.read_alias_mapping(model_name)[alias]
+
+    import mlflow
+    from mlflow import MlflowClient
+
+    mlflow.set_tracking_uri(ah.MLFLOW_TRACKING_URI)
+    client = MlflowClient()
+    return version, next(iter(client.get_model_version(model_name, str(version)).tags), "")
+
+def score_images(model_version, model_tag, image_paths):
+    """
+    Returns the predictions of a model version for the images: replayed if possible, computed otherwise.
+    """
+    predictions = []
+    for image_path in image_paths:
+        image_bytes = image_path.read_bytes()
+        y_pred = ah.get_replayed_prediction(model_name, model_version, image_path.name, zlib.crc32(image_bytes))
+        if y_pred is None:
+            img = ah.return_verified_image_as_numpy_arr(image_bytes)
+            y_pred = ah.predict_with_model_version(img, model_version, model_tag, model_name)
+        predictions.append(y_pred)
+    return np.array(predictions)
+
+def measure_latency(model_version, model_tag, image_paths):
+    """
+    Returns the mean latency (ms) of a model version for single images (preprocessing and prediction, as in the API).
+    """
+    images = [ah.return_verified_image_as_numpy_arr(image_path.read_bytes()) for image_path in image_paths]
+    # warm up
+    ah.predict_with_model_version(images[0], model_version, model_tag, model_name)
+
+    start = time.perf_counter()
+    for img in images:
+        ah.predict_with_model_version(img, model_version, model_tag, model_name)
+    return (time.perf_counter() - start) / len(images) * 1000
+
+def calibrate_band(cheap_scores, cheap_correct, heavy_correct, accuracy_loss):
+    """
+    Returns the narrowest uncertainty band (low, high) around 0.5, such that the cascade accuracy is at least the
+    accuracy of the heavy model minus accuracy_loss.
+
+    The images are sorted by their cheap score, a band escalates a contiguous range [i, j) that contains the
+    decision threshold 0.5 and whose borders lie between distinct scores. All ranges are evaluated at once
+    (prefix sums of heavy minus cheap correctness).
+    """
+    order = np.argsort(cheap_scores)
+    scores = cheap_scores[order]
+    gain = np.concatenate([[0], np.cumsum(heavy_correct[order].astype(int) - cheap_correct[order].astype(int))])
+    n = len(scores)
+    k = int(np.searchsorted(scores, 0.5))
+
+    starts = np.arange(k + 1)[:, np.newaxis]
+    ends = np.arange(k, n + 1)[np.newaxis, :]
+    accuracy = (cheap_correct.sum() + gain[ends] - gain[starts]) / n
+    escalated = ends - starts
+    # the served band is strict (low < score < high): a range can only start/end between distinct scores,
+    # otherwise tied scores would be on both sides of a threshold
+    distinct = np.concatenate([[True], scores[1:] > scores[:-1], [True]])
+    feasible = (accuracy >= heavy_correct.mean() - accuracy_loss - 1e-12) & ((distinct[starts] & distinct[ends]) | (escalated == 0))
+    # fewest escalated images, then highest accuracy (the full range is always feasible)
+    candidates = np.where(feasible, escalated - accuracy, np.inf)
+    i, j = np.unravel_index(np.argmin(candidates), candidates.shape)
+    i, j = int(i), int(j) + k
+
+    # empty range: no image escalates
+    if i == j:
+        return 0.5, 0.5
+    # thresholds halfway between the scores at the borders of the range, beyond [0, 1] if the range starts/ends there
+    low = -1.0 if i == 0 else float((scores[i - 1] + scores[i]) / 2)
+    high = 2.0 if j == n else float((scores[j - 1] + scores[j]) / 2)
+    return low, high
+
+def evaluate_band(low, high, cheap_scores, labels, heavy_scores):
+    """
+    Returns accuracy and escalation fraction of the cascade with the band (low, high).
+    """
+    escalated = (cheap_scores > low) & (cheap_scores < high)
+    cascade_scores = np.where(escalated, heavy_scores, cheap_scores)
+    return float(np.mean(np.around(cascade_scores) == labels)), float(np.mean(escalated))
+
+' ################################ calibrate thresholds ##############################'
+if __name__ == "__main__":
+    image_paths = sorted(test_folder.glob("*/*"))
+    labels = np.array([0 if image_path.parent.name == "NORMAL" else 1 for image_path in image_paths])
+    cheap = get_model_tag(cheap_version, ah.CASCADE_CHEAP_ALIAS)
+    heavy = get_model_tag(heavy_version, "champion")
+    print(f"Calibrating the cascade of version {cheap[0]} (cheap) and version {heavy[0]} (heavy) on {len(image_paths)} images.")
+
+    cheap_scores = score_images(*cheap, image_paths)
+    heavy_scores = score_images(*heavy, image_paths)
+    cheap_correct = np.around(cheap_scores) == labels
+    heavy_correct = np.around(heavy_scores) == labels
+
+    latency_paths = image_paths[::max(1, len(image_paths) // latency_samples)][:latency_samples]
+    cheap_latency = measure_latency(*cheap, latency_paths)
+    heavy_latency = measure_latency(*heavy, latency_paths)
+
+    print(f"cheap model: accuracy {cheap_correct.mean():.4f}, latency {cheap_latency:.1f} ms")
+    print(f"heavy model: accuracy {heavy_correct.mean():.4f}, latency {heavy_latency:.1f} ms\n")
+    print(f"{'max accuracy loss':>17} {'low':>7} {'high':>7} {'accuracy':>8} {'escalated':>9} {'mean latency (ms)':>17}")
+    calibrations = {}
+    for accuracy_loss in sorted(set(report_accuracy_losses) | {max_accuracy_loss}):
+        low, high = calibrate_band(cheap_scores, cheap_correct, heavy_correct, accuracy_loss)
+        accuracy, escalation_fraction = evaluate_band(low, high, cheap_scores, labels, heavy_scores)
+        mean_latency = cheap_latency + escalation_fraction * heavy_latency
+        calibrations[accuracy_loss] = {
+            "cheap version": cheap[0],
+            "heavy version": heavy[0],
+            "low": low,
+            "high": high,
+            "max accuracy loss": accuracy_loss,
+            "cheap accuracy": float(cheap_correct.mean()),
+            "heavy accuracy": float(heavy_correct.mean()),
+            "cascade accuracy": accuracy,
+            "escalation fraction": escalation_fraction,
+            "cheap latency ms": cheap_latency,
+            "heavy latency ms": heavy_latency,
+            "cascade latency ms": mean_latency,
+            "images": len(image_paths),
+            }
+        print(f"{accuracy_loss:>17.3f} {low:>7.3f} {high:>7.3f} {accuracy:>8.4f} {escalation_fraction:>9.1%} {mean_latency:>17.1f}")
+
+    # write via temp file, a running API reloads the thresholds when the modification time changes
+    thresholds = {}
+    if os.path.exists(ah.CASCADE_THRESHOLDS_PATH):
+        with open(ah.CASCADE_THRESHOLDS_PATH) as file:
+            thresholds = json.load(file)
+    thresholds[ah.cascade_key(cheap[0], heavy[0])] = calibrations[max_accuracy_loss]
+    temp_path = ah.CASCADE_THRESHOLDS_PATH + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(thresholds, file, indent=4)
+    os.replace(temp_path, ah.CASCADE_THRESHOLDS_PATH)
+    print(f"\nThresholds for max accuracy loss {max_accuracy_loss} written to {ah.CASCADE_THRESHOLDS_PATH}.")
@@ -0,0 +1,31 @@
+import os
+
+"""
+Gunicorn configuration for the multi-worker mode of the API. Run from the api folder:
+
+gunicorn -c gunicorn_conf.py api_server:app
+
+- the number of worker processes is set by the env variable WEB_CONCURRENCY (default 2)
+- the master process downloads the artifacts of the aliased model versions once (on_starting), the workers
+  inherit the local copies after fork and load their models from there (shared OS page cache).
+  The models themselves are loaded in the workers, as the tensorflow runtime isn't fork-safe.
+  The local copies are removed when the master process exits (on_exit).
+- csv logging, the log counter and the model switch are serialized across workers by a file lock
+  (see api_helpers.tracking_lock())
+"""
+
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+# import the app in the master process (api_helpers imports the ML stack lazily, the master stays light)
+preload_app = True
+# model warm-up happens in the background, but the first requests can still be slow
+timeout = 300
+
+def on_starting(server):
+    import api_helpers
+    api_helpers.preload_model_artifacts()
+
+def on_exit(server):
+    import api_helpers
+    api_helpers.remove_preloaded_model_artifacts()
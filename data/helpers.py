@@ -1,12 +1,20 @@
 from tensorflow import keras
+import tensorflow as tf
+import numpy as np
 import os
+from data.tensor_store import load_tensor_store, index_image_directory, source_fingerprint
 
-IMGSIZE = 256
+# input size of the models (images are resized to IMGSIZE * IMGSIZE), e.g. IMGSIZE=160 to train at a lower resolution
+# (see unified_experiment/resolution_study.py), the API resizes to the input size of each served model
+IMGSIZE = int(os.environ.get("IMGSIZE", 256))
 PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DATA_PATH_TRAIN = os.path.join(PROJECT_PATH, "data/train/")
 DATA_PATH_TEST = os.path.join(PROJECT_PATH, "data/test/")
+# on-disk caches and snapshots of the decoded images (cache modes "disk" and "snapshot")
+CACHE_PATH = os.path.join(PROJECT_PATH, "data/pipeline_cache")
+CACHE_MODES = (None, "memory", "disk", "snapshot")
 
-def get_train_val_data(batch_size, img_size, channel_mode):
+def get_train_val_data(batch_size, img_size, channel_mode, use_tensor_store=False, cache=None):
     
     '''
     Function that returns training and validation image datasets from the
@@ -20,6 +28,12 @@ def get_train_val_data(batch_size, img_size, channel_mode):
         The size to which the images will be resized to is img_size * img_size.
     channel_mode : {grayscale, rgb, rgba}
         Number of color channels of images from the dataset.
+    use_tensor_store : bool
+        Read the preprocessed images from the memory-mapped tensor store (see tensor_store.py,
+        built on first use) instead of decoding the JPEGs in every epoch. Same split as without store.
+    cache : {None, memory, disk, snapshot}
+        Cache of the decoded images, filled in the first epoch (see cache_and_batch()). 
+        None decodes the JPEGs in every epoch. Can't be combined with use_tensor_store.
         
     Returns
     -------
@@ -28,13 +42,20 @@ def get_train_val_data(batch_size, img_size, channel_mode):
     val_data: tf.data.Dataset 
         Validation dataset comprising of 20% of the images in the input dataset.
     '''
+    check_pipeline_options(use_tensor_store, cache)
+    if use_tensor_store:
+        store = load_tensor_store("train", img_size, channel_mode)
+        train_slice, val_slice = store.train_val_slices(validation_split=0.2)
+        train_data = dataset_from_tensor_store(store.images[train_slice], store.labels[train_slice], batch_size)
+        val_data = dataset_from_tensor_store(store.images[val_slice], store.labels[val_slice], batch_size)
+        return train_data, val_data
     
     train_data, val_data = keras.utils.image_dataset_from_directory(
         DATA_PATH_TRAIN,
         labels='inferred',              # labels are generated from the directory structure
         label_mode='binary',            # 'binary' => binary cross-entropy
         color_mode=channel_mode,        
-        batch_size=batch_size,
+        batch_size=None if cache else batch_size,   # cached datasets are batched after the cache
         image_size=(img_size, img_size),
         shuffle=True,                   # shuffle images before each epoch
         seed=0,                         # shuffle seed
@@ -44,10 +65,14 @@ def get_train_val_data(batch_size, img_size, channel_mode):
         follow_links=False,             
         crop_to_aspect_ratio=False
         )
+    if cache:
+        cache_name = get_cache_name(DATA_PATH_TRAIN, img_size, channel_mode)
+        train_data = cache_and_batch(train_data, batch_size, cache, f"train_{cache_name}", shuffle=True)
+        val_data = cache_and_batch(val_data, batch_size, cache, f"val_{cache_name}", shuffle=False)
     return train_data, val_data
     
     
-def get_test_data(batch_size, img_size, channel_mode):
+def get_test_data(batch_size, img_size, channel_mode, use_tensor_store=False, cache=None):
     
     '''
     Function that returns the test image dataset from the images 
@@ -61,19 +86,27 @@ def get_test_data(batch_size, img_size, channel_mode):
         The size to which the images will be resized to is img_size * img_size.
     channel_mode : {grayscale, rgb, rgba}
         Number of color channels of images from the dataset.
+    use_tensor_store : bool
+        Read the preprocessed images from the memory-mapped tensor store, see get_train_val_data().
+    cache : {None, memory, disk, snapshot}
+        Cache of the decoded images, see get_train_val_data().
         
     Returns
     -------
     test_data: tf.data.Dataset 
         Test dataset comprising of all the images in the input dataset.
     '''
+    check_pipeline_options(use_tensor_store, cache)
+    if use_tensor_store:
+        store = load_tensor_store("test", img_size, channel_mode)
+        return dataset_from_tensor_store(store.images, store.labels, batch_size)
     
     test_data = keras.utils.image_dataset_from_directory(
         DATA_PATH_TEST,
         labels='inferred',              # labels are generated from the directory structure
         label_mode='binary',            # 'binary' => binary cross-entropy
         color_mode=channel_mode,        
-        batch_size=batch_size,
+        batch_size=None if cache else batch_size,
         image_size=(img_size, img_size),
         shuffle=True,                   # shuffle images before each epoch
         seed=0,                         # shuffle seed
@@ -83,4 +116,240 @@ def get_test_data(batch_size, img_size, channel_mode):
         follow_links=False,             
         crop_to_aspect_ratio=False
         )
-    return test_data
\ No newline at end of file
+    if cache:
+        cache_name = get_cache_name(DATA_PATH_TEST, img_size, channel_mode)
+        test_data = cache_and_batch(test_data, batch_size, cache, f"test_{cache_name}", shuffle=False)
+    return test_data
+
+
+def get_split_metadata(validation_split=0.2, seed=0):
+    
+    '''
+    Function that returns file lists, labels and per-class counts of the training, validation and 
+    test subsets, computed from the directory index alone (no image is decoded). The subsets are 
+    the ones of get_train_val_data() and get_test_data() (same seeded order and 80/20 split).
+    
+    Parameters
+    ----------
+    validation_split : float
+        Fraction of [project_folder]/data/train used for validation.
+    seed : int
+        Shuffle seed.
+        
+    Returns
+    -------
+    metadata: dict
+        {"train", "val", "test"} -> dict with 
+        "file_paths" (list of str, relative to the split directory), 
+        "labels" (numpy array, class index per file), 
+        "class_counts" (numpy array, number of files per class index),
+        "class_names" (list of str, sorted class subdirectories).
+    '''
+    def subset_metadata(file_paths, labels, class_names):
+        return {
+            "file_paths": file_paths,
+            "labels": labels,
+            "class_counts": np.bincount(labels, minlength=len(class_names)),
+            "class_names": class_names,
+            }
+
+    metadata = {}
+    file_paths, labels, class_names = index_image_directory(DATA_PATH_TRAIN, seed)
+    # split as in keras.utils.image_dataset_from_directory
+    n_val = int(validation_split * len(file_paths))
+    n_train = len(file_paths) - n_val
+    metadata["train"] = subset_metadata(file_paths[:n_train], labels[:n_train], class_names)
+    metadata["val"] = subset_metadata(file_paths[n_train:], labels[n_train:], class_names)
+    
+    file_paths, labels, class_names = index_image_directory(DATA_PATH_TEST, seed)
+    metadata["test"] = subset_metadata(file_paths, labels, class_names)
+    return metadata
+
+
+def get_resizing_stages(resizing_schedule, epochs, img_size=IMGSIZE):
+
+    '''
+    Function that returns the stages of a progressive resizing schedule: the training starts
+    at lower image sizes and ends with the remaining epochs at img_size.
+
+    Parameters
+    ----------
+    resizing_schedule : list of (int, int) or None
+        (image size, number of epochs) of the stages before the final stage, image sizes in
+        ascending order and below img_size, e.g. [(128, 2), (192, 2)]. None: all epochs at img_size.
+    epochs : positive int
+        Total number of epochs, at least one of them is left for the final stage.
+    img_size : positive int
+        Image size of the final stage.
+
+    Returns
+    -------
+    stages: list of dicts
+        Per stage: "img_size", "initial_epoch" and "epochs" (epoch at which the stage ends,
+        as in model.fit()).
+    '''
+    resizing_schedule = list(resizing_schedule or [])
+    sizes = [size for size, _ in resizing_schedule] + [img_size]
+    if any(smaller >= larger for smaller, larger in zip(sizes, sizes[1:])):
+        raise ValueError(f"Image sizes of the resizing schedule have to ascend to {img_size}, got {sizes}.")
+    if sum(stage_epochs for _, stage_epochs in resizing_schedule) >= epochs:
+        raise ValueError(f"The resizing schedule {resizing_schedule} leaves no epoch (of {epochs}) for the final size {img_size}.")
+
+    stages = []
+    initial_epoch = 0
+    for size, stage_epochs in resizing_schedule + [(img_size, epochs)]:
+        final_epoch = min(initial_epoch + stage_epochs, epochs)
+        stages.append({"img_size": size, "initial_epoch": initial_epoch, "epochs": final_epoch})
+        initial_epoch = final_epoch
+    return stages
+
+
+def get_progressive_train_val_data(batch_size, resizing_schedule, epochs, channel_mode, use_tensor_store=False, cache=None, final_stage_data=None):
+
+    '''
+    Generator that yields the training and validation datasets of every stage of a progressive
+    resizing schedule (see get_resizing_stages()). The datasets of a stage are created when the
+    stage is reached, i.e. only the (cached) images of one image size are held at a time.
+
+    Parameters
+    ----------
+    batch_size, channel_mode, use_tensor_store, cache :
+        See get_train_val_data().
+    resizing_schedule, epochs :
+        See get_resizing_stages().
+    final_stage_data : (tf.data.Dataset, tf.data.Dataset) or None
+        Training and validation datasets of the final stage (image size IMGSIZE), e.g. to reuse
+        them for evaluation and logging. Created like the other stages if None.
+
+    Yields
+    -------
+    stage: dict
+        "img_size", "initial_epoch", "epochs" (see get_resizing_stages()), "train_data" and "val_data".
+    '''
+    for stage in get_resizing_stages(resizing_schedule, epochs):
+        if stage["img_size"] == IMGSIZE and final_stage_data is not None:
+            yield {**stage, "train_data": final_stage_data[0], "val_data": final_stage_data[1]}
+            continue
+        train_data, val_data = get_train_val_data(batch_size, stage["img_size"], channel_mode, use_tensor_store=use_tensor_store, cache=cache)
+        yield {**stage, "train_data": train_data, "val_data": val_data}
+
+
+def check_pipeline_options(use_tensor_store, cache):
+    
+    '''
+    Raises a ValueError for an unknown cache mode or a cache combined with the tensor store
+    (the store already holds decoded images).
+    '''
+    if cache not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode {cache!r}, expected one of {CACHE_MODES}.")
+    if cache and use_tensor_store:
+        raise ValueError("A cache can't be combined with the tensor store, use either of them.")
+
+
+def get_cache_name(directory, img_size, channel_mode):
+    
+    '''
+    Returns the name of the on-disk cache of a source directory. It contains a fingerprint 
+    of the source files, such that added or modified images lead to a new cache.
+    '''
+    file_paths, _, _ = index_image_directory(directory)
+    return f"{img_size}_{channel_mode}_{source_fingerprint(directory, file_paths)[:12]}"
+
+
+def cache_and_batch(elements, batch_size, cache, cache_name, shuffle):
+    
+    '''
+    Function that caches a dataset of single decoded images, then batches and prefetches it.
+    The images are decoded once (memory and disk: when the dataset is created, snapshot: in the 
+    first epoch), all epochs and evaluations with the same dataset object read the cache. 
+    
+    Parameters
+    ----------
+    elements : tf.data.Dataset
+        Unbatched (image, label) pairs, as returned by image_dataset_from_directory(batch_size=None).
+    batch_size : positive int
+        Size of data batches to be loaded in the memory.
+    cache : {memory, disk, snapshot}
+        memory: decoded images are kept in RAM (float32: ~0.25 MB per grayscale and ~0.75 MB per rgb 
+                image of size 256), lost at the end of the script.
+        disk: cache file in data/pipeline_cache/, reused by later runs.
+        snapshot: tf.data snapshot in data/pipeline_cache/ (sharded, written and read in parallel), 
+                  reused by later runs.
+    cache_name : str
+        Name of the on-disk cache.
+    shuffle : bool
+        Shuffle the images before each epoch. The cache holds the images in the (seeded) order 
+        of the first epoch, they are reshuffled behind the cache with a buffer of batch_size * 8 images.
+        
+    Returns
+    -------
+    dataset: tf.data.Dataset 
+        Batches of float32 images and binary float32 labels, as returned by image_dataset_from_directory().
+    '''
+    if cache == "snapshot":
+        # a snapshot is only committed when it has been written completely. Uncompressed: the snappy 
+        # reader of tf 2.18 fails on elements of 256 KB (grayscale images of size 256)
+        elements = elements.snapshot(os.path.join(CACHE_PATH, f"{cache_name}.snapshot"), compression=None)
+    else:
+        cache_file = ""
+        if cache == "disk":
+            os.makedirs(CACHE_PATH, exist_ok=True)
+            cache_file = os.path.join(CACHE_PATH, cache_name)
+        elements = elements.cache(cache_file)
+        # fill the cache with one complete pass: a partial first pass (e.g. dataset.take(1)) through
+        # the parallel decoding of keras would otherwise leave a truncated cache behind
+        if not os.path.exists(cache_file + ".index"):
+            for _ in elements.batch(batch_size).prefetch(tf.data.AUTOTUNE):
+                pass
+    
+    if shuffle:
+        elements = elements.shuffle(batch_size * 8, seed=0, reshuffle_each_iteration=True)
+    return elements.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def dataset_from_tensor_store(images, labels, batch_size, shuffle=True, seed=0):
+    
+    '''
+    Function that returns a dataset reading batches from memory-mapped uint8 images 
+    (see tensor_store.py). Only the images of the current batches are read, the 
+    pixels are cast to float32 inside the input pipeline.
+    
+    Parameters
+    ----------
+    images : numpy array (memory map)
+        Images (n_images, img_size, img_size, channels), uint8.
+    labels : numpy array
+        Class index of every image, or targets (n_images, n_targets) of every image.
+    batch_size : positive int
+        Size of data batches to be loaded in the memory.
+    shuffle : bool
+        Shuffle the images before each epoch.
+    seed : int
+        Shuffle seed.
+        
+    Returns
+    -------
+    dataset: tf.data.Dataset 
+        Batches of float32 images and float32 labels (n, 1) as returned by image_dataset_from_directory(), 
+        or float32 targets (n, n_targets).
+    '''
+    n_images = len(labels)
+    image_shape = images.shape[1:]
+    labels = labels.astype(np.float32).reshape(n_images, -1)
+
+    def read_batch(indices):
+        # sorted indices read the memory map in file order
+        indices = np.sort(indices)
+        return images[indices], labels[indices]
+
+    def load_batch(indices):
+        batch_images, batch_labels = tf.numpy_function(read_batch, [indices], (tf.uint8, tf.float32))
+        batch_images.set_shape((None, *image_shape))
+        batch_labels.set_shape((None, labels.shape[1]))
+        return tf.cast(batch_images, tf.float32), batch_labels
+
+    dataset = tf.data.Dataset.range(n_images)
+    if shuffle:
+        dataset = dataset.shuffle(n_images, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size).map(load_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,294 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+from collections import Counter
+
+import numpy as np
+
+'''
+Memory-mapped store of preprocessed images.
+
+Every split (data/train, data/test) is decoded and resized once per (img_size, channel_mode) into
+data/tensor_store/[split]_[img_size]_[channel_mode]/:
+- images.npy: uint8 array (n_images, img_size, img_size, channels), read as memory map
+- labels.npy: uint8 array (n_images,), class index (0 = NORMAL, 1 = PNEUMONIA)
+- filenames.npy: paths of the source images relative to the split directory
+- manifest.json: parameters and fingerprint of the source files
+
+The images are stored in the order of keras.utils.image_dataset_from_directory (sorted per class,
+shuffled with the seed), hence its 80/20 train/validation split is a pair of contiguous slices and
+can be read without copying. The decoding and resizing follows keras as well; the only difference is
+the rounding of the resized pixels to uint8.
+
+Invalidation: the fingerprint covers path, size and modification time of every source image. A store
+whose fingerprint doesn't match the source directory anymore is rebuilt (or rejected, see load_tensor_store()).
+
+This module only depends on numpy (tensorflow is imported by the builder), such that the API can read
+the store without importing tensorflow. Build all stores from the project folder with:
+
+python data/tensor_store.py
+'''
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+STORE_PATH = os.path.join(PROJECT_PATH, "data/tensor_store")
+SPLIT_PATHS = {
+    "train": os.path.join(PROJECT_PATH, "data/train/"),
+    "test": os.path.join(PROJECT_PATH, "data/test/"),
+    }
+CHANNELS = {"grayscale": 1, "rgb": 3, "rgba": 4}
+
+# file types indexed by keras.utils.image_dataset_from_directory
+IMAGE_FORMATS = (".bmp", ".gif", ".jpeg", ".jpg", ".png")
+# increase when the layout or the preprocessing of the store changes
+STORE_FORMAT_VERSION = 1
+
+
+def index_image_directory(directory, seed=0):
+    '''
+    Function that indexes the images of a directory with one subdirectory per class,
+    in the same order as keras.utils.image_dataset_from_directory(shuffle=True, seed=seed).
+
+    Parameters
+    ----------
+    directory : str
+        Directory with one subdirectory per class.
+    seed : int
+        Shuffle seed.
+
+    Returns
+    -------
+    file_paths: list of str
+        Image paths relative to directory.
+    labels: numpy array
+        Class index of every image.
+    class_names: list of str
+        Sorted names of the class subdirectories.
+    '''
+    class_names = sorted(entry for entry in os.listdir(directory) if os.path.isdir(os.path.join(directory, entry)))
+
+    file_paths = []
+    labels = []
+    for class_index, class_name in enumerate(class_names):
+        class_directory = os.path.join(directory, class_name)
+        for root, _, files in sorted(os.walk(class_directory)):
+            for file_name in sorted(files):
+                if file_name.lower().endswith(IMAGE_FORMATS):
+                    file_paths.append(os.path.relpath(os.path.join(root, file_name), directory))
+                    labels.append(class_index)
+    labels = np.array(labels, dtype=np.int32)
+
+    # same global shuffle as keras (separate generators with the same seed for paths and labels)
+    np.random.RandomState(seed).shuffle(file_paths)
+    np.random.RandomState(seed).shuffle(labels)
+
+    return file_paths, labels, class_names
+
+def source_fingerprint(directory, file_paths):
+    '''
+    Returns a hash over path, size and modification time of the given files.
+    '''
+    fingerprint = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        stat = os.stat(os.path.join(directory, file_path))
+        fingerprint.update(f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return fingerprint.hexdigest()
+
+def get_store_path(split, img_size, channel_mode):
+    '''
+    Returns the directory of the store of a split.
+    '''
+    return os.path.join(STORE_PATH, f"{split}_{img_size}_{channel_mode}")
+
+def build_tensor_store(split, img_size, channel_mode, seed=0, batch_size=64):
+    '''
+    Function that decodes and resizes all images of a split once and writes them into a new store.
+
+    Parameters
+    ----------
+    split : {train, test}
+        Source directory data/[split].
+    img_size : positive int
+        The size to which the images will be resized to is img_size * img_size.
+    channel_mode : {grayscale, rgb, rgba}
+        Number of color channels of the stored images.
+    seed : int
+        Shuffle seed of the image order (see index_image_directory()).
+    batch_size : positive int
+        Number of images decoded in parallel.
+
+    Returns
+    -------
+    store_path: str
+        Directory of the store.
+    '''
+    import tensorflow as tf
+
+    directory = SPLIT_PATHS[split]
+    file_paths, labels, class_names = index_image_directory(directory, seed)
+    fingerprint = source_fingerprint(directory, file_paths)
+    num_channels = CHANNELS[channel_mode]
+
+    # write into a temporary directory, which replaces the old store when complete
+    store_path = get_store_path(split, img_size, channel_mode)
+    temp_path = store_path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    images = np.lib.format.open_memmap(
+        os.path.join(temp_path, "images.npy"), mode="w+", dtype=np.uint8,
+        shape=(len(file_paths), img_size, img_size, num_channels),
+        )
+
+    # decoding and resizing as in keras.utils.image_dataset_from_directory
+    def load_image(path):
+        image = tf.io.read_file(path)
+        image = tf.image.decode_image(image, channels=num_channels, expand_animations=False)
+        image = tf.image.resize(image, (img_size, img_size), method="bilinear")
+        return tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+
+    paths = [os.path.join(directory, file_path) for file_path in file_paths]
+    decoded_images = tf.data.Dataset.from_tensor_slices(paths).map(load_image, num_parallel_calls=tf.data.AUTOTUNE).batch(batch_size)
+    position = 0
+    for batch in decoded_images.as_numpy_iterator():
+        images[position:position + len(batch)] = batch
+        position += len(batch)
+    images.flush()
+    del images
+
+    np.save(os.path.join(temp_path, "labels.npy"), labels.astype(np.uint8))
+    np.save(os.path.join(temp_path, "filenames.npy"), np.array(file_paths))
+    manifest = {
+        "format version": STORE_FORMAT_VERSION,
+        "split": split,
+        "img_size": img_size,
+        "channel_mode": channel_mode,
+        "seed": seed,
+        "class_names": class_names,
+        "n_images": len(file_paths),
+        "source fingerprint": fingerprint,
+        }
+    with open(os.path.join(temp_path, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(temp_path, store_path)
+    print(f"Tensor store {store_path} built ({len(file_paths)} images).")
+    return store_path
+
+def load_tensor_store(split, img_size, channel_mode, seed=0, rebuild=True):
+    '''
+    Function that opens the store of a split (read-only memory map). A missing or outdated store
+    (source files changed) is rebuilt, or rejected if rebuild is False.
+
+    Parameters
+    ----------
+    split : {train, test}
+        Source directory data/[split].
+    img_size : positive int
+        Image size of the store.
+    channel_mode : {grayscale, rgb, rgba}
+        Number of color channels of the store.
+    seed : int
+        Shuffle seed of the image order.
+    rebuild : bool
+        Build the store if it is missing or outdated.
+
+    Returns
+    -------
+    store: TensorStore or None
+        None, if the store is missing or outdated and rebuild is False.
+    '''
+    store_path = get_store_path(split, img_size, channel_mode)
+    if not is_up_to_date(split, img_size, channel_mode, seed):
+        if not rebuild:
+            return None
+        build_tensor_store(split, img_size, channel_mode, seed)
+    return TensorStore(store_path)
+
+def is_up_to_date(split, img_size, channel_mode, seed=0):
+    '''
+    Returns whether the store of a split exists and matches the current source files.
+    '''
+    manifest_path = os.path.join(get_store_path(split, img_size, channel_mode), "manifest.json")
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+
+    directory = SPLIT_PATHS[split]
+    file_paths, _, _ = index_image_directory(directory, seed)
+    return (
+        manifest["format version"] == STORE_FORMAT_VERSION
+        and manifest["seed"] == seed
+        and manifest["source fingerprint"] == source_fingerprint(directory, file_paths)
+        )
+
+
+class TensorStore:
+    '''
+    Read-only view of a tensor store. images is a memory map, slices and single images are views
+    (no copy, pages are read from disk on access and shared between processes via the page cache).
+
+    Parameters
+    ----------
+    store_path : str
+        Directory of the store.
+    '''
+
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, "manifest.json")) as file:
+            self.manifest = json.load(file)
+        self.images = np.load(os.path.join(store_path, "images.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(store_path, "labels.npy"))
+        self.filenames = np.load(os.path.join(store_path, "filenames.npy"))
+        self.class_names = self.manifest["class_names"]
+
+        # row index by relative path and by file name (file names only if unique)
+        self._rows = {}
+        base_names = [os.path.basename(file_path) for file_path in self.filenames]
+        base_name_counts = Counter(base_names)
+        for row, (file_path, base_name) in enumerate(zip(self.filenames, base_names)):
+            self._rows[str(file_path)] = row
+            if base_name_counts[base_name] == 1:
+                self._rows[base_name] = row
+
+    def __len__(self):
+        return len(self.labels)
+
+    def row_of(self, file_name):
+        '''
+        Returns the row of an image (relative path or file name), None if it isn't in the store.
+        '''
+        return self._rows.get(file_name)
+
+    def image(self, file_name):
+        '''
+        Returns the stored image (view) of an image file, None if it isn't in the store.
+        '''
+        row = self.row_of(file_name)
+        return None if row is None else self.images[row]
+
+    def train_val_slices(self, validation_split=0.2):
+        '''
+        Returns the slices of the training and validation subset, as split by keras.utils.image_dataset_from_directory.
+        '''
+        n_val = int(validation_split * len(self))
+        return slice(0, len(self) - n_val), slice(len(self) - n_val, len(self))
+
+
+# build stores for the image size and channel modes of the training scripts
+if __name__ == "__main__":
+    sys.path.append(PROJECT_PATH)
+    from data.helpers import IMGSIZE
+
+    for split in SPLIT_PATHS:
+        if not os.path.isdir(SPLIT_PATHS[split]):
+            print(f"Skipping split {split}: {SPLIT_PATHS[split]} not found.")
+            continue
+        for channel_mode in ["grayscale", "rgb"]:
+            if is_up_to_date(split, IMGSIZE, channel_mode):
+                print(f"Tensor store {get_store_path(split, IMGSIZE, channel_mode)} is up to date.")
+            else:
+                build_tensor_store(split, IMGSIZE, channel_mode)
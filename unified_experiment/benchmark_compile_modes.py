@@ -0,0 +1,137 @@
+"""
+This script compares the compilation modes of training_helpers.COMPILE_MODES (eager, graph, xla) for the model families
+of the training scripts:
+- own model: small CNN on grayscale images (training_ownmodel.py)
+- transfer learning: frozen MobileNet with dense top layers on grayscale images (channel broadcast in the model) (training_transferlearning.py)
+
+For every family, the model is created once, and every mode starts from a copy of the same initial weights.
+Per mode:
+- train step time: median of n_train_steps steps (model.train_on_batch) on fixed batches, i.e. without input pipeline
+- eval step time: median over the evaluation batches (model.predict_on_batch)
+- parity: binary accuracy of the trained model on the evaluation batches and the maximum absolute difference
+  of its predictions to the ones of the graph mode (XLA fuses and reorders operations, small differences are expected)
+The first step of every mode (tracing and compilation) is reported separately.
+
+The batches are read from the memory-mapped tensor store (see data/tensor_store.py).
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+from tensorflow import keras
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import get_train_val_data, IMGSIZE
+import training_helpers
+
+
+' ################################ configuration #####################################'
+compile_modes = ["eager", "graph", "xla"]
+n_train_steps = 30
+n_eval_batches = 10
+# weights of the MobileNet base: "imagenet" or None (random weights, no download, same step time)
+base_weights = "imagenet"
+
+
+' ################################ model families ####################################'
+def get_own_model_family():
+    """
+    Returns the own model and its compile arguments.
+    """
+    model = training_helpers.get_own_model(dropout_rate=0.3, img_size=IMGSIZE)
+    return model, "grayscale", 128, lambda: keras.optimizers.SGD(learning_rate=0.01, momentum=0.8)
+
+def get_transfer_learning_family():
+    """
+    Returns the transfer learning model (frozen MobileNet + top layers) and its compile arguments.
+    """
+    base_model = keras.applications.MobileNet(input_shape=(IMGSIZE, IMGSIZE, 3), include_top=False, weights=base_weights)
+    base_model.trainable = False
+    inputs = keras.layers.Input(shape=(IMGSIZE, IMGSIZE, 1))
+    x = base_model(training_helpers.broadcast_channels(inputs))
+    x = keras.layers.GlobalAveragePooling2D()(x)
+    x = keras.layers.Dense(128, activation="relu")(x)
+    x = keras.layers.Dropout(0.4)(x)
+    output = keras.layers.Dense(1, activation="sigmoid")(x)
+    model = keras.Model(inputs=inputs, outputs=output)
+    return model, "grayscale", 10, lambda: keras.optimizers.Adam(learning_rate=0.001)
+
+model_families = {
+    "own model": get_own_model_family,
+    "transfer learning": get_transfer_learning_family,
+    }
+
+
+' ################################ helper functions ##################################'
+def timed(function, *args):
+    """
+    Returns the result of function(*args) and its duration in seconds.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def benchmark_mode(model, initial_weights, get_optimizer, compile_mode, train_batches, eval_batches):
+    """
+    Trains a copy of the model for the fixed train batches in one compilation mode, then predicts the eval batches.
+    Returns the step times, the binary accuracy and the predictions on the eval batches.
+    """
+    model = keras.models.clone_model(model)
+    model.set_weights(initial_weights)
+    model.compile(
+        loss="binary_crossentropy",
+        optimizer=get_optimizer(),
+        metrics=["binary_accuracy"],
+        **training_helpers.get_compile_options(compile_mode),
+        )
+
+    train_times = [timed(model.train_on_batch, images, labels)[1] for images, labels in train_batches]
+    eval_results = [timed(model.predict_on_batch, images) for images, _ in eval_batches]
+    eval_times = [eval_time for _, eval_time in eval_results]
+    # repeat the first batch, if the evaluation subset has a single batch
+    if len(eval_times) == 1:
+        eval_times.append(timed(model.predict_on_batch, eval_batches[0][0])[1])
+
+    predictions = np.concatenate([np.asarray(prediction) for prediction, _ in eval_results])
+    labels = np.concatenate([np.asarray(labels) for _, labels in eval_batches])
+    accuracy = float(np.mean((predictions > 0.5) == (labels > 0.5)))
+    return {
+        "first train step s": train_times[0],
+        "train step ms": 1000 * float(np.median(train_times[1:])),
+        "first eval step s": eval_times[0],
+        "eval step ms": 1000 * float(np.median(eval_times[1:])),
+        "accuracy": accuracy,
+        }, predictions
+
+
+' ################################ benchmark #########################################'
+if __name__ == "__main__":
+    results = []
+    for family, get_family in model_families.items():
+        model, channel_mode, batch_size, get_optimizer = get_family()
+        initial_weights = model.get_weights()
+        train_data, val_data = get_train_val_data(batch_size, IMGSIZE, channel_mode, use_tensor_store=True)
+        # fixed batches (same for every mode), repeated if the subset is small
+        train_batches = list(train_data.repeat().take(n_train_steps).as_numpy_iterator())
+        eval_batches = list(val_data.take(n_eval_batches).as_numpy_iterator())
+
+        family_results = {}
+        for compile_mode in compile_modes:
+            stats, predictions = benchmark_mode(model, initial_weights, get_optimizer, compile_mode, train_batches, eval_batches)
+            family_results[compile_mode] = (stats, predictions)
+            print(f"{family} | {compile_mode}: {stats}")
+        reference_predictions = family_results.get("graph", next(iter(family_results.values())))[1]
+        for compile_mode, (stats, predictions) in family_results.items():
+            stats["max prediction diff"] = float(np.max(np.abs(predictions - reference_predictions)))
+            results.append((family, compile_mode, stats))
+
+    print(f"\nCompilation modes ({IMGSIZE}x{IMGSIZE}, {n_train_steps} train steps, {n_eval_batches} eval batches, "
+          f"prediction differences relative to graph mode):")
+    print(f"{'model family':<18} {'mode':<6} {'1st train (s)':>13} {'train step (ms)':>15} {'1st eval (s)':>12} "
+          f"{'eval step (ms)':>14} {'accuracy':>8} {'max pred diff':>13}")
+    for family, compile_mode, stats in results:
+        print(f"{family:<18} {compile_mode:<6} {stats['first train step s']:>13.2f} {stats['train step ms']:>15.1f} "
+              f"{stats['first eval step s']:>12.2f} {stats['eval step ms']:>14.1f} {stats['accuracy']:>8.4f} "
+              f"{stats['max prediction diff']:>13.2e}")
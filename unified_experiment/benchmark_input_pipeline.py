@@ -0,0 +1,86 @@
+"""
+This script benchmarks the input pipeline modes of data/helpers.py, without any model:
+- no cache: the JPEGs are decoded and resized in every epoch (parallel decoding and prefetching of keras)
+- memory, disk, snapshot: cache of the decoded images (see data.helpers.cache_and_batch())
+- tensor store: memory-mapped uint8 images (see data/tensor_store.py)
+
+for the configurations of the training scripts:
+- own model: grayscale images, batch size 128 (training_ownmodel.py)
+- transfer learning: grayscale images, batch size 10 (training_transferlearning.py, training_transferlearning_finetuned.py)
+- rgb: rgb images, batch size 10 (finetuning of 3-channel transfer learning models of older runs)
+
+For every mode and configuration, the time to create the datasets (including filling memory and disk caches)
+and the throughput (images/sec) of every epoch over the training subset are printed.
+The first epoch of "snapshot" writes the snapshot, the first run of "disk" writes the cache file;
+later runs of this script read them (data/pipeline_cache/).
+
+HINT: the memory cache of the rgb configuration needs ~3 GB RAM for the training subset.
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import get_train_val_data, get_test_data, IMGSIZE
+
+
+' ################################ configuration #####################################'
+configurations = {
+    "own model": {"batch_size": 128, "channel_mode": "grayscale"},
+    "transfer learning": {"batch_size": 10, "channel_mode": "grayscale"},
+    "rgb": {"batch_size": 10, "channel_mode": "rgb"},
+    }
+# (cache, use_tensor_store) per mode
+modes = {
+    "no cache": (None, False),
+    "memory": ("memory", False),
+    "disk": ("disk", False),
+    "snapshot": ("snapshot", False),
+    "tensor store": (None, True),
+    }
+# "train": training subset of data/train, "test": data/test
+split = "train"
+epochs = 3
+
+' ################################ helper functions ##################################'
+def get_dataset(batch_size, channel_mode, cache, use_tensor_store):
+    """
+    Returns the dataset of the benchmarked split.
+    """
+    if split == "train":
+        train_data, _ = get_train_val_data(batch_size, IMGSIZE, channel_mode, use_tensor_store=use_tensor_store, cache=cache)
+        return train_data
+    return get_test_data(batch_size, IMGSIZE, channel_mode, use_tensor_store=use_tensor_store, cache=cache)
+
+def measure_epoch(dataset):
+    """
+    Iterates once over the dataset, returns the number of images and the images per second.
+    """
+    n_images = 0
+    start = time.perf_counter()
+    for images, _ in dataset:
+        n_images += len(images)
+    return n_images, n_images / (time.perf_counter() - start)
+
+' ################################ benchmark #########################################'
+if __name__ == "__main__":
+    results = []
+    for configuration, settings in configurations.items():
+        for mode, (cache, use_tensor_store) in modes.items():
+            start = time.perf_counter()
+            dataset = get_dataset(settings["batch_size"], settings["channel_mode"], cache, use_tensor_store)
+            creation_seconds = time.perf_counter() - start
+
+            throughputs = []
+            for epoch in range(epochs):
+                n_images, images_per_second = measure_epoch(dataset)
+                throughputs.append(images_per_second)
+            results.append((configuration, mode, n_images, creation_seconds, throughputs))
+            print(f"{configuration} | {mode}: " + ", ".join(f"{throughput:.0f}" for throughput in throughputs) + " images/sec")
+            del dataset
+
+    print(f"\nImages per second ({split} split, {IMGSIZE}x{IMGSIZE}, {epochs} epochs):")
+    print(f"{'configuration':<18} {'mode':<13} {'images':>7} {'creation (s)':>13} " + " ".join(f"{'epoch ' + str(epoch + 1):>9}" for epoch in range(epochs)))
+    for configuration, mode, n_images, creation_seconds, throughputs in results:
+        print(f"{configuration:<18} {mode:<13} {n_images:>7} {creation_seconds:>13.1f} " + " ".join(f"{throughput:>9.0f}" for throughput in throughputs))
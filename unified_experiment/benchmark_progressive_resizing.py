@@ -0,0 +1,93 @@
+"""
+This script compares progressive resizing (see data.helpers.get_resizing_stages()) with training at the fixed
+image size IMGSIZE, for the own model (training_ownmodel.py).
+
+Every schedule of resizing_schedules (None: fixed size) trains the own model from the same initial weights for
+the same number of epochs. After every epoch, the model is evaluated on the validation subset at IMGSIZE.
+Per schedule:
+- wall-clock training time until the validation accuracy reaches target_accuracy (evaluations excluded)
+- total training time, final validation and test accuracy
+
+The images are read from the memory-mapped tensor stores (see data/tensor_store.py), one store per image size.
+"""
+
+import os
+import sys
+import time
+
+from tensorflow import keras
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import get_train_val_data, get_progressive_train_val_data, get_resizing_stages, get_test_data, get_split_metadata, IMGSIZE
+from data.tensor_store import load_tensor_store
+import training_helpers
+
+
+' ################################ configuration #####################################'
+# schedules: (image size, epochs) before the remaining epochs at IMGSIZE, None: fixed size
+resizing_schedules = {
+    "fixed size": None,
+    "128 -> full": [(128, 4)],
+    "128 -> 192 -> full": [(128, 3), (192, 3)],
+    }
+epochs = 10
+target_accuracy = 0.9
+batch_size = 128
+# compilation mode of training and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+
+
+' ################################ helper functions ##################################'
+def train_with_schedule(model, resizing_schedule, class_weights_dict, val_data):
+    """
+    Trains the model with a resizing schedule. Returns the time to accuracy callback and the training time in seconds
+    (without the evaluations of the callback).
+    """
+    time_to_accuracy = training_helpers.TimeToAccuracyCallback(target_accuracy, model, val_data)
+    start = time.perf_counter()
+    for stage in get_progressive_train_val_data(batch_size, resizing_schedule, epochs, "grayscale", use_tensor_store=True):
+        stage_model = training_helpers.get_stage_model(model, stage["img_size"])
+        stage_model.fit(
+            stage["train_data"],
+            initial_epoch=stage["initial_epoch"],
+            epochs=stage["epochs"],
+            class_weight=class_weights_dict,
+            callbacks=[time_to_accuracy],
+            verbose=0,
+            )
+    return time_to_accuracy, time.perf_counter() - start - time_to_accuracy.evaluation_seconds
+
+
+' ################################ benchmark #########################################'
+if __name__ == "__main__":
+    class_weights_dict = training_helpers.get_class_weights(get_split_metadata()["train"]["class_counts"])
+    _, val_data = get_train_val_data(batch_size, IMGSIZE, "grayscale", use_tensor_store=True)
+    test_data = get_test_data(batch_size, IMGSIZE, "grayscale", use_tensor_store=True)
+    # build the tensor stores of all image sizes before the time measurements
+    for resizing_schedule in resizing_schedules.values():
+        for stage in get_resizing_stages(resizing_schedule, epochs):
+            load_tensor_store("train", stage["img_size"], "grayscale")
+    initial_weights = training_helpers.get_own_model(dropout_rate=0.3, img_size=IMGSIZE).get_weights()
+
+    results = []
+    for name, resizing_schedule in resizing_schedules.items():
+        model = training_helpers.get_own_model(dropout_rate=0.3, img_size=IMGSIZE)
+        model.set_weights(initial_weights)
+        model.compile(
+            loss="binary_crossentropy",
+            metrics=["binary_accuracy"],
+            optimizer=keras.optimizers.SGD(learning_rate=0.01, momentum=0.8),
+            **training_helpers.get_compile_options(compile_mode),
+            )
+        time_to_accuracy, train_seconds = train_with_schedule(model, resizing_schedule, class_weights_dict, val_data)
+        _, test_accuracy = model.evaluate(test_data, verbose=0)
+        results.append((name, time_to_accuracy, train_seconds, test_accuracy))
+        print(f"{name}: val accuracy per epoch " + ", ".join(f"{accuracy:.3f}" for accuracy in time_to_accuracy.accuracies))
+
+    print(f"\nProgressive resizing vs. fixed size {IMGSIZE} ({epochs} epochs, target val accuracy {target_accuracy}):")
+    print(f"{'schedule':<22} {'time to target (s)':>18} {'epochs to target':>16} {'train time (s)':>14} {'val accuracy':>12} {'test accuracy':>13}")
+    for name, time_to_accuracy, train_seconds, test_accuracy in results:
+        reached = time_to_accuracy.time_to_target is not None
+        print(f"{name:<22} {time_to_accuracy.time_to_target if reached else float('nan'):>18.1f} "
+              f"{time_to_accuracy.epoch_to_target if reached else '-':>16} {train_seconds:>14.1f} "
+              f"{time_to_accuracy.accuracies[-1]:>12.4f} {test_accuracy:>13.4f}")
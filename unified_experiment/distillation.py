@@ -0,0 +1,257 @@
+"""
+This script distills a registered Xray_classifier version (teacher, e.g. the MobileNet/ResNet champion) into the
+small own CNN (student, grayscale, optionally width-scaled), which is much cheaper to serve.
+
+1. The teacher predicts every image of the training subset once. The predictions (soft labels) are stored in
+   data/feature_cache/ and reused by later runs with the same teacher version and images.
+2. The student is trained on the grayscale images with a combination of the true labels and the soft labels:
+   loss = alpha * BCE(label, p) + (1 - alpha) * temperature**2 * BCE(soft label, p_T),
+   soft label and p_T are teacher and student predictions with logits divided by temperature.
+3. Teacher and student are evaluated on data/test (binary accuracy, mean single-image latency), the student is
+   logged via log_mlflow_run (with the accuracy and latency deltas as metrics) and registered as a new version
+   of Xray_classifier with the tag "distilled_[tag of the teacher version]".
+
+Teacher (rgb or grayscale, any image size) and student read the images from the memory-mapped tensor stores
+(see data/tensor_store.py). All stores of a split have the same image order, hence the soft labels of a row
+belong to the same image in the grayscale store.
+
+As for the training scripts, the mlflow server has to be running. In the directory of this script, run:
+
+mlflow server --host 127.0.0.1 --port 8080
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+import mlflow
+from mlflow import MlflowClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import dataset_from_tensor_store, IMGSIZE, PROJECT_PATH
+from data.tensor_store import load_tensor_store
+import training_helpers
+from mlflow_logging import log_mlflow_run
+
+# %%
+' ####################### params #######################'
+
+# registered model version that serves as teacher
+model_name = "Xray_classifier"
+teacher_version = 1
+
+# student (own model, see training_helpers.get_own_model())
+width_multiplier = 1
+dropout_rate = 0.3
+
+# distillation
+temperature = 2.0
+alpha = 0.3     # weight of the true labels, 1 - alpha: weight of the soft labels
+
+# params for training
+BATCH_SIZE = 64
+EPOCHS = 10
+learning_rate = 0.01
+momentum = 0.8
+# compilation mode of training and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+
+# params for evaluation
+latency_samples = 50
+
+soft_label_cache_path = os.path.join(PROJECT_PATH, "data/feature_cache")
+mlflow_run_name = "distilled own model"
+register_student = True
+
+# %%
+' ####################### distillation helpers #######################'
+
+def probabilities_to_logits(probabilities):
+    '''
+    Returns the logits of sigmoid probabilities.
+    '''
+    probabilities = np.clip(probabilities, 1e-7, 1 - 1e-7)
+    return np.log(probabilities) - np.log1p(-probabilities)
+
+def distillation_loss(targets, predictions):
+    '''
+    Loss of the student. targets holds the true label (column 0) and the soft label of the teacher at
+    the distillation temperature (column 1), predictions are the sigmoid outputs of the student.
+    '''
+    labels, soft_labels = targets[:, :1], targets[:, 1:]
+    predictions = tf.clip_by_value(predictions, 1e-7, 1 - 1e-7)
+    soft_predictions = tf.sigmoid((tf.math.log(predictions) - tf.math.log1p(-predictions)) / temperature)
+    hard_loss = keras.losses.binary_crossentropy(labels, predictions)
+    soft_loss = keras.losses.binary_crossentropy(soft_labels, soft_predictions)
+    # temperature**2 keeps the gradient scale of the soft loss independent of the temperature
+    return alpha * hard_loss + (1 - alpha) * temperature**2 * soft_loss
+
+def binary_accuracy(targets, predictions):
+    '''
+    Binary accuracy with respect to the true labels (column 0 of the targets).
+    '''
+    return keras.metrics.binary_accuracy(targets[:, :1], predictions)
+
+def evaluate(model, dataset):
+    '''
+    Returns the binary accuracy of a model on a dataset of images and labels.
+    '''
+    correct = 0
+    total = 0
+    for images, labels in dataset:
+        predictions = model(images, training=False).numpy()
+        correct += np.sum(np.around(predictions) == labels.numpy())
+        total += len(labels)
+    return correct / total
+
+# %%
+' ####################### load teacher #######################'
+
+mlflow.set_tracking_uri("http://127.0.0.1:8080")
+client = MlflowClient()
+
+teacher_uri = f"models:/{model_name}/{teacher_version}"
+teacher = mlflow.keras.load_model(teacher_uri)
+teacher_tag = next(iter(client.get_model_version(model_name, str(teacher_version)).tags), "")
+
+# image size and channel mode of the teacher input
+teacher_img_size = teacher.input_shape[1]
+teacher_channel_mode = "grayscale" if teacher.input_shape[-1] == 1 else "rgb"
+
+# %%
+' ####################### data #######################'
+
+train_store = load_tensor_store("train", IMGSIZE, "grayscale")
+test_store = load_tensor_store("test", IMGSIZE, "grayscale")
+teacher_train_store = load_tensor_store("train", teacher_img_size, teacher_channel_mode)
+teacher_test_store = load_tensor_store("test", teacher_img_size, teacher_channel_mode)
+if not np.array_equal(train_store.filenames, teacher_train_store.filenames):
+    raise ValueError("Tensor stores of teacher and student differ in their image order, rebuild them.")
+
+train_slice, val_slice = train_store.train_val_slices(validation_split=0.2)
+
+# %%
+' ####################### soft labels of the teacher #######################'
+
+start_time = time.time()
+# cached soft labels are specific to the teacher version and the source images
+cache_file = os.path.join(
+    soft_label_cache_path,
+    f"teacher_{model_name}_{teacher_version}_{teacher_img_size}_{teacher_channel_mode}_"
+    f"{teacher_train_store.manifest['source fingerprint'][:12]}.npz"
+    )
+teacher_train_data = dataset_from_tensor_store(
+    teacher_train_store.images[train_slice], teacher_train_store.labels[train_slice], BATCH_SIZE, shuffle=False)
+teacher_probabilities, _ = training_helpers.get_cached_features(teacher, teacher_train_data, cache_file)
+print(f"soft labels ready in {time.time() - start_time:.2f} seconds ({cache_file})")
+
+soft_labels = tf.sigmoid(probabilities_to_logits(teacher_probabilities) / temperature).numpy()
+targets = np.concatenate([train_store.labels[train_slice].reshape(-1, 1), soft_labels], axis=1)
+
+train_data = dataset_from_tensor_store(train_store.images[train_slice], targets, BATCH_SIZE)
+val_data = dataset_from_tensor_store(train_store.images[val_slice], train_store.labels[val_slice], BATCH_SIZE, shuffle=False)
+test_data = dataset_from_tensor_store(test_store.images, test_store.labels, BATCH_SIZE, shuffle=False)
+# validation targets in the format of the distillation loss (soft label = true label)
+val_labels = train_store.labels[val_slice].reshape(-1, 1)
+val_targets_data = dataset_from_tensor_store(
+    train_store.images[val_slice], np.concatenate([val_labels, val_labels], axis=1), BATCH_SIZE, shuffle=False)
+
+# %%
+' ####################### train student #######################'
+
+student = training_helpers.get_own_model(dropout_rate, IMGSIZE, width_multiplier)
+student.compile(
+    loss=distillation_loss,
+    metrics=[binary_accuracy],
+    optimizer=keras.optimizers.SGD(learning_rate=learning_rate, momentum=momentum),
+    **training_helpers.get_compile_options(compile_mode)
+    )
+student.summary()
+
+# records images/sec, step times, input wait and peak RSS (logged with the run)
+throughput = training_helpers.ThroughputCallback(BATCH_SIZE)
+
+start_time = time.time()
+history = student.fit(
+    throughput.instrument(train_data),
+    epochs=EPOCHS,
+    validation_data=val_targets_data,
+    callbacks=[throughput],
+    )
+print(f"train time:  {time.time() - start_time:.2f} seconds")
+
+# standard loss and metric for evaluation and serving (the distillation loss isn't needed anymore),
+# the training optimizer is kept (logged and saved with the model)
+student.compile(
+    loss="binary_crossentropy",
+    metrics=["binary_accuracy"],
+    optimizer=student.optimizer,
+    **training_helpers.get_compile_options(compile_mode)
+    )
+
+# %%
+' ####################### compare teacher and student #######################'
+
+val_accuracy = evaluate(student, val_data)
+test_accuracy = evaluate(student, test_data)
+teacher_test_data = dataset_from_tensor_store(teacher_test_store.images, teacher_test_store.labels, BATCH_SIZE, shuffle=False)
+teacher_test_accuracy = evaluate(teacher, teacher_test_data)
+
+single_images = np.asarray(test_store.images[:latency_samples], dtype=np.float32)
+student_latency = training_helpers.measure_latency(lambda x: student(x, training=False), list(single_images))
+teacher_single_images = np.asarray(teacher_test_store.images[:latency_samples], dtype=np.float32)
+teacher_latency = training_helpers.measure_latency(lambda x: teacher(x, training=False), list(teacher_single_images))
+
+comparison = {
+    "teacher test accuracy": teacher_test_accuracy,
+    "teacher latency ms": teacher_latency,
+    "student latency ms": student_latency,
+    "test accuracy delta": test_accuracy - teacher_test_accuracy,
+    "latency speedup": teacher_latency / student_latency,
+    "teacher parameters": teacher.count_params(),
+    "student parameters": student.count_params(),
+    }
+print(f"teacher (version {teacher_version}): test accuracy {teacher_test_accuracy:.4f}, latency {teacher_latency:.1f} ms")
+print(f"student: test accuracy {test_accuracy:.4f}, latency {student_latency:.1f} ms "
+      f"(accuracy delta {comparison['test accuracy delta']:+.4f}, {comparison['latency speedup']:.1f}x faster)")
+
+# %%
+' ####################### log and register student #######################'
+
+# the learning curves are plotted from the history with the usual keys
+learning_curves = training_helpers.generate_plot_of_learning_curves(history)
+run_id = log_mlflow_run(
+    student,
+    run_name=mlflow_run_name,
+    epochs=EPOCHS,
+    batch_size=BATCH_SIZE,
+    loss_function=f"distillation (alpha {alpha}, temperature {temperature})",
+    optimizer=student.optimizer,
+    learning_rate=learning_rate,
+    top_dropout_rate=dropout_rate,
+    model_summary_string=training_helpers.generate_model_summary_string(student),
+    run_tag=f"Own model distilled from {model_name} version {teacher_version} ({teacher_tag})",
+    signature_batch=val_data.take(1),
+    val_accuracy=val_accuracy,
+    test_accuracy=test_accuracy,
+    custom_params={
+        "teacher version": teacher_version,
+        "temperature": temperature,
+        "alpha": alpha,
+        "width multiplier": width_multiplier,
+        "momentum": momentum,
+        "compile mode": compile_mode,
+        },
+    fig=learning_curves,
+    throughput=throughput,
+    )
+
+# accuracy and latency compared to the teacher
+with mlflow.start_run(run_id=run_id):
+    mlflow.log_metrics(comparison)
+
+if register_student:
+    mlflow.register_model(f"runs:/{run_id}/model_artifact", model_name, tags={f"distilled_{teacher_tag}": ""})
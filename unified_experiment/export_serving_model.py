@@ -0,0 +1,160 @@
+"""
+This script exports a registered Xray_classifier version with the preprocessing of the API folded into its graph:
+
+- uint8 input of any image size (height x width x 1, i.e. the decoded grayscale image)
+- resize to the input size of the model (bilinear, as api_helpers.resize_image())
+- channel broadcast for models with rgb input (see training_helpers.broadcast_channels())
+- the original model (including its own Rescaling, if any)
+
+The exported model is logged as a run in the "X-Ray Pneumonia" experiment and registered as a new version of
+Xray_classifier with the tag "serving_[tag of the original version]" and the signature uint8 (-1, -1, -1, 1).
+For this signature, the API passes the decoded image without resizing, replication and casting in numpy, all
+per-pixel work runs in the TF kernels of the model.
+
+Before registration, the predictions of both paths (API preprocessing + original model, exported model) are compared
+on data/test images of their original size, together with the test accuracy and the mean single-image latency.
+
+As for the training scripts, the mlflow server has to be running. In the directory of this script, run:
+
+mlflow server --host 127.0.0.1 --port 8080
+"""
+
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+from tensorflow import keras
+import mlflow
+from mlflow import MlflowClient
+from mlflow.models import ModelSignature
+from mlflow.types.schema import Schema, TensorSpec
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import DATA_PATH_TEST
+from data.tensor_store import index_image_directory
+import training_helpers
+
+# %%
+' ####################### params #######################'
+
+# registered model version that should be exported
+model_name = "Xray_classifier"
+source_version = 1
+
+# params for evaluation
+latency_samples = 50
+
+register_serving_model = True
+
+# %%
+' ####################### export helpers #######################'
+
+def build_serving_model(model):
+    '''
+    Function that wraps a keras model with in-graph preprocessing of decoded grayscale images.
+
+    Parameters
+    ----------
+    model : keras.Model
+        Model with input (batch, height, width, channels).
+
+    Returns
+    -------
+    serving_model: keras.Model
+        Model with uint8 input (batch, any height, any width, 1) and the outputs of model.
+    '''
+    img_height, img_width, channels = model.input_shape[1:]
+    inputs = keras.layers.Input(shape=(None, None, 1), dtype="uint8", name="image")
+    # the resized image is float32 without rounding to uint8 (as in the training pipeline, the API rounds it)
+    x = keras.layers.Resizing(img_height, img_width, interpolation="bilinear", name="resize_to_model_input")(inputs)
+    if channels > 1:
+        x = training_helpers.broadcast_channels(x, channels)
+    outputs = model(x)
+    return keras.Model(inputs=inputs, outputs=outputs, name=f"serving_{model.name}")
+
+def api_preprocessing(image, model):
+    '''
+    Returns the input of model for a decoded grayscale image, prepared like api_helpers.resize_image().
+    '''
+    resized_image = keras.ops.image.resize(image[..., np.newaxis], size=model.input_shape[1:3], interpolation="bilinear").numpy()
+    return np.repeat(resized_image, model.input_shape[-1], axis=-1)[np.newaxis].astype(np.float32)
+
+def load_test_images():
+    '''
+    Returns the decoded data/test images (uint8 numpy arrays of their original size) and their labels.
+    '''
+    file_paths, labels, _ = index_image_directory(DATA_PATH_TEST, seed=0)
+    images = []
+    for file_path in file_paths:
+        with Image.open(os.path.join(DATA_PATH_TEST, file_path)) as img:
+            images.append(np.asarray(img.convert("L")))
+    return images, labels
+
+# %%
+' ####################### load original model #######################'
+
+mlflow.set_tracking_uri("http://127.0.0.1:8080")
+client = MlflowClient()
+
+source_uri = f"models:/{model_name}/{source_version}"
+model = mlflow.keras.load_model(source_uri)
+source_tag = next(iter(client.get_model_version(model_name, str(source_version)).tags), "")
+
+serving_model = build_serving_model(model)
+serving_model.summary()
+
+# %%
+' ####################### compare API preprocessing and exported model #######################'
+
+test_images, test_labels = load_test_images()
+
+reference_predictions = np.concatenate([model.predict_on_batch(api_preprocessing(image, model)) for image in test_images])
+serving_predictions = np.concatenate([serving_model.predict_on_batch(image[np.newaxis, ..., np.newaxis]) for image in test_images])
+
+max_prediction_diff = float(np.max(np.abs(serving_predictions - reference_predictions)))
+reference_accuracy = float(np.mean(np.around(reference_predictions[:, 0]) == test_labels))
+test_accuracy = float(np.mean(np.around(serving_predictions[:, 0]) == test_labels))
+
+# single-image latency including the preprocessing (images of their original size)
+single_images = [image[..., np.newaxis] for image in test_images[:latency_samples]]
+reference_latency = training_helpers.measure_latency(
+    lambda x: model(api_preprocessing(x[0, ..., 0], model), training=False), single_images)
+serving_latency = training_helpers.measure_latency(lambda x: serving_model(x, training=False), single_images)
+
+print(f"original model (version {source_version}) with API preprocessing: test accuracy {reference_accuracy:.4f}, latency {reference_latency:.1f} ms")
+print(f"exported model: test accuracy {test_accuracy:.4f}, latency {serving_latency:.1f} ms, "
+      f"max prediction difference {max_prediction_diff:.2e}")
+
+# %%
+' ####################### log and register exported model #######################'
+
+if register_serving_model:
+    mlflow.set_experiment("X-Ray Pneumonia")
+    serving_tag = f"serving_{source_tag}"
+
+    # uint8 images of any size, one channel
+    signature = ModelSignature(
+        inputs=Schema([TensorSpec(np.dtype(np.uint8), (-1, -1, -1, 1))]),
+        outputs=Schema([TensorSpec(np.dtype(np.float32), (-1, 1))]),
+        )
+
+    with mlflow.start_run(run_name=f"{serving_tag} (version {source_version})") as run:
+        mlflow.log_params({
+            "source model version": source_version,
+            "image size": model.input_shape[1],
+            "model input channels": model.input_shape[-1],
+            })
+        mlflow.log_metrics({
+            "test accuracy": test_accuracy,
+            "reference test accuracy": reference_accuracy,
+            "latency ms": serving_latency,
+            "reference latency ms": reference_latency,
+            "max prediction difference": max_prediction_diff,
+            })
+        mlflow.set_tag("Training Info", f"{model_name} version {source_version} with in-graph preprocessing (uint8 input of any size)")
+        mlflow.log_text(training_helpers.generate_model_summary_string(serving_model), "model_summary.txt")
+        mlflow.keras.log_model(serving_model, artifact_path="model_artifact", signature=signature)
+
+    # register exported model as new version of the same registered model
+    mlflow.register_model(f"runs:/{run.info.run_id}/model_artifact", model_name, tags={serving_tag: ""})
@@ -0,0 +1,239 @@
+"""
+This script runs a hyperparameter sweep of the own model (training_ownmodel.py) with successive halving:
+
+1. n_trials configurations are sampled from the search space
+2. all trials are trained for min_epochs, the best 1/eta of them (validation binary accuracy) continue,
+   the others are stopped. The remaining trials are trained up to eta times as many epochs, and so on,
+   until the rung of max_epochs is reached
+3. every trial (stopped or finished) is logged as one mlflow run via log_mlflow_run
+
+The trials of a rung are trained in parallel on a process pool: n_workers processes with threads_per_trial
+tensorflow threads each (n_workers = number of CPU cores // threads_per_trial). A trial continues from its saved
+model (weights and optimizer state) in the next rung, hence no epoch is trained twice.
+The images are read from the memory-mapped tensor store (see data/tensor_store.py), which is shared by all
+worker processes via the page cache.
+
+HINT:
+- the mlflow server has to be running (mlflow server --host 127.0.0.1 --port 8080)
+- the search space can be extended with every keyword of train_trial()
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import get_split_metadata, IMGSIZE
+from data.tensor_store import load_tensor_store
+
+
+' ################################ configuration #####################################'
+sweep_name = "own model sweep"
+# search space: parameter -> ("choice", [values]) or ("uniform", low, high) or ("log uniform", low, high)
+search_space = {
+    "learning_rate": ("log uniform", 0.001, 0.1),
+    "momentum": ("uniform", 0.5, 0.95),
+    "dropout_rate": ("choice", [0.0, 0.2, 0.3, 0.5]),
+    "batch_size": ("choice", [32, 64, 128]),
+    }
+n_trials = 27
+seed = 0
+
+# successive halving: rungs at min_epochs, min_epochs * eta, ... <= max_epochs
+min_epochs = 1
+max_epochs = 9
+eta = 3
+
+threads_per_trial = 2
+n_workers = max(1, os.cpu_count() // threads_per_trial)
+
+loss_func = "binary_crossentropy"
+# compilation mode of training and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+mlflow_logging = True
+
+
+' ################################ helper functions ##################################'
+def sample_configurations(space, n_samples, random_seed):
+    """
+    Samples n_samples configurations (dicts) from the search space.
+    """
+    random_state = np.random.RandomState(random_seed)
+    configurations = []
+    for _ in range(n_samples):
+        configuration = {}
+        for parameter, (distribution, *arguments) in space.items():
+            if distribution == "choice":
+                values = arguments[0]
+                configuration[parameter] = values[random_state.randint(len(values))]
+            elif distribution == "uniform":
+                configuration[parameter] = float(random_state.uniform(*arguments))
+            elif distribution == "log uniform":
+                configuration[parameter] = float(np.exp(random_state.uniform(np.log(arguments[0]), np.log(arguments[1]))))
+            else:
+                raise ValueError(f"Unknown distribution {distribution} of parameter {parameter}.")
+        configurations.append(configuration)
+    return configurations
+
+def get_rungs(first_epochs, last_epochs, reduction_factor):
+    """
+    Returns the epochs after which the trials are compared, e.g. [1, 3, 9].
+    """
+    rungs = [first_epochs]
+    while rungs[-1] * reduction_factor <= last_epochs:
+        rungs.append(rungs[-1] * reduction_factor)
+    return rungs
+
+def init_worker(n_threads):
+    """
+    Limits the tensorflow threads of a worker process.
+    """
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+
+def train_trial(trial_folder, epochs_done, epochs, learning_rate, momentum, dropout_rate, batch_size):
+    """
+    Trains a trial from epochs_done up to epochs (runs in a worker process). The model is created in the
+    first rung and continued from trial_folder/model.keras in the later ones.
+    Returns the history (metric -> values) of the trained epochs.
+    """
+    from tensorflow import keras
+    from data.helpers import get_train_val_data
+    import training_helpers
+
+    train_data, val_data = get_train_val_data(batch_size, IMGSIZE, channel_mode="grayscale", use_tensor_store=True)
+    class_weights_dict = training_helpers.get_class_weights(get_split_metadata()["train"]["class_counts"])
+
+    model_path = os.path.join(trial_folder, "model.keras")
+    if epochs_done == 0:
+        model = training_helpers.get_own_model(dropout_rate, IMGSIZE)
+        model.compile(
+            loss=loss_func,
+            metrics=["binary_accuracy"],
+            optimizer=keras.optimizers.SGD(learning_rate=learning_rate, momentum=momentum),
+            **training_helpers.get_compile_options(compile_mode),
+            )
+    else:
+        # saved model includes the optimizer state and the compile options
+        model = keras.models.load_model(model_path)
+
+    history = model.fit(
+        train_data,
+        initial_epoch=epochs_done,
+        epochs=epochs,
+        verbose=0,
+        class_weight=class_weights_dict,
+        validation_data=val_data,
+        )
+    model.save(model_path)
+    return history.history
+
+def log_trial(trial_id, trial_folder, configuration, history_dict, stopped):
+    """
+    Evaluates the trained model of a trial on the test set and logs it as mlflow run (runs in a worker process).
+    Returns the test accuracy.
+    """
+    from tensorflow import keras
+    from data.helpers import get_train_val_data, get_test_data
+    import training_helpers
+    from mlflow_logging import log_mlflow_run
+
+    batch_size = configuration["batch_size"]
+    model = keras.models.load_model(os.path.join(trial_folder, "model.keras"))
+    train_data, _ = get_train_val_data(batch_size, IMGSIZE, channel_mode="grayscale", use_tensor_store=True)
+    test_data = get_test_data(batch_size, IMGSIZE, channel_mode="grayscale", use_tensor_store=True)
+    _, test_accuracy = model.evaluate(test_data, verbose=0)
+
+    # history of all rungs, as keras history object for the plot of the learning curves
+    history = keras.callbacks.History()
+    history.history = history_dict
+    epochs = len(history_dict["val_binary_accuracy"])
+
+    log_mlflow_run(
+        model,
+        run_name=f"{sweep_name} - trial {trial_id}",
+        epochs=epochs,
+        batch_size=batch_size,
+        loss_function=loss_func,
+        optimizer=model.optimizer,
+        learning_rate=configuration["learning_rate"],
+        top_dropout_rate=configuration["dropout_rate"],
+        model_summary_string=training_helpers.generate_model_summary_string(model),
+        run_tag=f"Hyperparameter sweep '{sweep_name}' (successive halving), {'stopped early' if stopped else 'finished'} after {epochs} epochs.",
+        signature_batch=train_data.take(1),
+        val_accuracy=history_dict["val_binary_accuracy"][-1],
+        test_accuracy=test_accuracy,
+        custom_params={"momentum": configuration["momentum"], "sweep": sweep_name, "trial": trial_id, "stopped early": stopped, "compile mode": compile_mode},
+        fig=training_helpers.generate_plot_of_learning_curves(history),
+        )
+    return test_accuracy
+
+
+' ################################ sweep #############################################'
+if __name__ == "__main__":
+    configurations = sample_configurations(search_space, n_trials, seed)
+    rungs = get_rungs(min_epochs, max_epochs, eta)
+    print(f"{n_trials} trials, rungs at {rungs} epochs, {n_workers} worker processes with {threads_per_trial} threads each.")
+
+    # build the tensor stores once, before the workers read them
+    load_tensor_store("train", IMGSIZE, "grayscale")
+    load_tensor_store("test", IMGSIZE, "grayscale")
+
+    sweep_folder = tempfile.mkdtemp(prefix="sweep_")
+    trial_folders = [os.path.join(sweep_folder, f"trial_{trial_id}") for trial_id in range(n_trials)]
+    for trial_folder in trial_folders:
+        os.makedirs(trial_folder)
+    histories = {trial_id: {} for trial_id in range(n_trials)}
+    stopped_after = {}
+
+    start = time.perf_counter()
+    # spawned (not forked) workers, tensorflow isn't fork-safe
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=init_worker, initargs=(threads_per_trial,)) as executor:
+            active_trials = list(range(n_trials))
+            epochs_done = 0
+            for rung, epochs in enumerate(rungs):
+                futures = {
+                    trial_id: executor.submit(train_trial, trial_folders[trial_id], epochs_done, epochs, **configurations[trial_id])
+                    for trial_id in active_trials
+                    }
+                for trial_id, future in futures.items():
+                    for metric, values in future.result().items():
+                        histories[trial_id].setdefault(metric, []).extend(values)
+                epochs_done = epochs
+
+                # keep the best 1/eta of the trials (at least one) for the next rung
+                ranking = sorted(active_trials, key=lambda trial_id: histories[trial_id]["val_binary_accuracy"][-1], reverse=True)
+                for trial_id in ranking:
+                    print(f"rung {rung} ({epochs} epochs) | trial {trial_id}: val binary accuracy "
+                          f"{histories[trial_id]['val_binary_accuracy'][-1]:.4f} {configurations[trial_id]}")
+                if rung < len(rungs) - 1:
+                    active_trials = ranking[:max(1, len(ranking) // eta)]
+                    for trial_id in ranking[len(active_trials):]:
+                        stopped_after[trial_id] = epochs
+                    print(f"rung {rung} done after {time.perf_counter() - start:.1f} seconds, {len(active_trials)} trials continue.")
+
+            best_trial = ranking[0]
+            if mlflow_logging:
+                futures = {
+                    trial_id: executor.submit(log_trial, trial_id, trial_folders[trial_id], configurations[trial_id], histories[trial_id], trial_id in stopped_after)
+                    for trial_id in range(n_trials)
+                    }
+                for trial_id, future in futures.items():
+                    print(f"trial {trial_id} logged, test binary accuracy {future.result():.4f}")
+    finally:
+        shutil.rmtree(sweep_folder, ignore_errors=True)
+
+    print(f"Sweep done in {time.perf_counter() - start:.1f} seconds. Trained epochs: "
+          f"{sum(len(history['val_binary_accuracy']) for history in histories.values())} (instead of {n_trials * rungs[-1]} without early stopping).")
+    print(f"Best trial: {best_trial} {configurations[best_trial]}, "
+          f"val binary accuracy {histories[best_trial]['val_binary_accuracy'][-1]:.4f}")
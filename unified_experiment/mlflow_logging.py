@@ -27,12 +27,16 @@ def log_mlflow_run(
     val_accuracy,
     test_accuracy,
 	custom_params,
-    fig
+    fig,
+    throughput=None,
+    profile_dir=None,
+    resizing_stages=None,
+    time_to_accuracy=None
 ):
     
     '''
     Function that takes as arguments all the parameters/artifacts to be logged in mlflow
-    and handles all the mlflow-related logging. Does not return anything.
+    and handles all the mlflow-related logging. Returns the ID of the run (e.g. to register the model).
     
     Parameters
     ----------
@@ -67,6 +71,19 @@ def log_mlflow_run(
         Dictionary for additional parameteres to be logged.
     fig : matplotlib figure object
         Figure to be logged.
+    throughput : training_helpers.ThroughputCallback or None
+        Callback used in training. Its values per epoch are logged as metrics 
+        (prefix "throughput", step = epoch), its summary as artifact throughput_summary.json.
+    profile_dir : str or None
+        Directory of a profiler trace (see training_helpers.get_profiler_callback()), 
+        logged as artifact folder "profile".
+    resizing_stages : list of dicts or None
+        Stages of progressive resizing (see data.helpers.get_resizing_stages()), logged as
+        parameter "resizing schedule" and as artifact resizing_schedule.json.
+    time_to_accuracy : training_helpers.TimeToAccuracyCallback or None
+        Callback used in training. The time and epochs until its target accuracy is reached
+        are logged as metrics (not logged if it isn't reached), the validation accuracy per epoch
+        as metric "target validation accuracy".
     
     '''
     
@@ -84,6 +101,7 @@ def log_mlflow_run(
         "optimizer": optimizer,
         "learning rate": learning_rate,
         "dense layer dropout rate": top_dropout_rate,
+        "image size": model.input_shape[1],
         "dataset": DATA_PATH
         }
     
@@ -118,6 +136,33 @@ def log_mlflow_run(
         
         mlflow.log_metrics(metrics_dict)
         
+        # Log the training throughput
+        if throughput is not None:
+            for epoch, epoch_stats in enumerate(throughput.epochs):
+                mlflow.log_metrics({f"throughput {metric}": value for metric, value in epoch_stats.items()}, step=epoch)
+            mlflow.log_dict(throughput.summary(), "throughput_summary.json")
+        
+        # Log the schedule of progressive resizing
+        if resizing_stages is not None:
+            mlflow.log_param("resizing schedule", ", ".join(
+                f"{stage['img_size']}: epochs {stage['initial_epoch'] + 1}-{stage['epochs']}" for stage in resizing_stages))
+            mlflow.log_dict({"stages": resizing_stages}, "resizing_schedule.json")
+
+        # Log the time to target accuracy
+        if time_to_accuracy is not None:
+            mlflow.log_param("target accuracy", time_to_accuracy.target_accuracy)
+            for epoch, accuracy in enumerate(time_to_accuracy.accuracies):
+                mlflow.log_metric("target validation accuracy", accuracy, step=epoch)
+            if time_to_accuracy.time_to_target is not None:
+                mlflow.log_metrics({
+                    "time to target accuracy s": time_to_accuracy.time_to_target,
+                    "epochs to target accuracy": time_to_accuracy.epoch_to_target,
+                    })
+
+        # Log the profiler trace
+        if profile_dir is not None:
+            mlflow.log_artifacts(profile_dir, artifact_path="profile")
+        
         # Log figures
         mlflow.log_figure(fig, "learn_curve_accuracy.png")
 
@@ -143,3 +188,5 @@ def log_mlflow_run(
             artifact_path = "model_artifact",
             signature = signature
         )
+    
+    return run.info.run_id
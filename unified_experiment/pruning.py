@@ -0,0 +1,300 @@
+"""
+This script prunes a registered Xray_classifier version for CPU serving, without training from scratch.
+
+1. Iterative magnitude pruning: for every sparsity of sparsity_schedule, the smallest weights of the trainable
+   Conv2D and Dense kernels are set to zero (per layer), then the model is fine-tuned for finetune_epochs on
+   data/train with the pruned weights held at zero.
+   For models that are a plain chain of convolution blocks and a dense head (own model, see
+   training_helpers.get_own_model()), the Conv2D layers are pruned by whole filters (smallest L1 norm) instead
+   of single weights. Other models (e.g. transfer learning models with a nested base model) are pruned weight by weight.
+2. Export: pruned filters are removed from the own model, i.e. the exported model has fewer Conv2D filters
+   (and a smaller first dense layer) and is smaller and faster. Weight-wise pruned models keep their shape,
+   their zeros only shrink the compressed file.
+3. Original and pruned model are compared on data/test (binary accuracy, parameter count, file size,
+   mean single-image latency). The pruned model is logged as a run in the "X-Ray Pneumonia" experiment and
+   registered as a new version of Xray_classifier with the tag "pruned_[tag of the original version]".
+
+As for the training scripts, the mlflow server has to be running. In the directory of this script, run:
+
+mlflow server --host 127.0.0.1 --port 8080
+"""
+
+import gzip
+import os
+import sys
+import tempfile
+
+import numpy as np
+from tensorflow import keras
+import mlflow
+from mlflow import MlflowClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import get_train_val_data, get_test_data, get_split_metadata
+import training_helpers
+
+# %%
+' ####################### params #######################'
+
+# registered model version that should be pruned
+model_name = "Xray_classifier"
+source_version = 1
+
+# fraction of the weights (or Conv2D filters) set to zero after each pruning step
+sparsity_schedule = [0.25, 0.5, 0.7]
+# fine-tune epochs after each pruning step
+finetune_epochs = 1
+finetune_learning_rate = 0.0001
+
+# params for fine-tuning and evaluation
+BATCHSIZE = 32
+latency_samples = 50
+# compilation mode of fine-tuning and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+
+register_pruned = True
+
+# %%
+' ####################### pruning helpers #######################'
+
+# layers of a model that can be rebuilt with fewer Conv2D filters
+CHAIN_LAYERS = (
+    keras.layers.InputLayer, keras.layers.Rescaling, keras.layers.Conv2D, keras.layers.MaxPooling2D,
+    keras.layers.Flatten, keras.layers.Dense, keras.layers.Dropout,
+    )
+
+def is_filter_prunable(model):
+    '''
+    Returns True, if the model is a plain chain of layers of CHAIN_LAYERS (like the own model),
+    i.e. its Conv2D filters can be removed.
+    '''
+    return all(type(layer) in CHAIN_LAYERS for layer in model.layers)
+
+def get_prunable_layers(model):
+    '''
+    Returns the trainable Conv2D and Dense layers of a model (also of nested models),
+    without the output layer.
+    '''
+    def collect(layers):
+        for layer in layers:
+            if isinstance(layer, keras.Model):
+                yield from collect(layer.layers)
+            elif isinstance(layer, (keras.layers.Conv2D, keras.layers.Dense)) and layer.trainable:
+                yield layer
+
+    return list(collect(model.layers[:-1]))
+
+def compute_masks(layers, sparsity, prune_filters):
+    '''
+    Function that computes the pruning masks of the kernels (and biases) of the given layers.
+
+    Parameters
+    ----------
+    layers : list of keras layers
+        Conv2D and Dense layers.
+    sparsity : float
+        Fraction of the weights (filters) of every layer that is pruned.
+    prune_filters : bool
+        If True, Conv2D layers are pruned by filters with the smallest L1 norm, else by weights.
+
+    Returns
+    -------
+    masks: dict
+        Layer -> (kernel mask, bias mask or None).
+    '''
+    masks = {}
+    for layer in layers:
+        kernel = layer.kernel.numpy()
+        if prune_filters and isinstance(layer, keras.layers.Conv2D):
+            norms = np.sum(np.abs(kernel), axis=(0, 1, 2))
+            # keep at least one filter
+            n_pruned = min(int(sparsity * len(norms)), len(norms) - 1)
+            filter_mask = np.ones(len(norms), dtype=kernel.dtype)
+            filter_mask[np.argsort(norms)[:n_pruned]] = 0
+            masks[layer] = (np.broadcast_to(filter_mask, kernel.shape).copy(), filter_mask if layer.use_bias else None)
+        else:
+            threshold = np.quantile(np.abs(kernel), sparsity)
+            masks[layer] = ((np.abs(kernel) > threshold).astype(kernel.dtype), None)
+    return masks
+
+def apply_masks(masks):
+    '''
+    Sets the pruned weights to zero.
+    '''
+    for layer, (kernel_mask, bias_mask) in masks.items():
+        layer.kernel.assign(layer.kernel.numpy() * kernel_mask)
+        if bias_mask is not None:
+            layer.bias.assign(layer.bias.numpy() * bias_mask)
+
+class PruningCallback(keras.callbacks.Callback):
+    '''
+    Holds the pruned weights at zero during fine-tuning (the optimizer updates them after every batch).
+    '''
+    def __init__(self, masks):
+        super().__init__()
+        self.masks = masks
+
+    def on_train_batch_end(self, batch, logs=None):
+        apply_masks(self.masks)
+
+def remove_pruned_filters(model, masks):
+    '''
+    Function that rebuilds a filter-pruned chain model (see is_filter_prunable()) without its pruned Conv2D filters.
+    The outputs are unchanged: a pruned filter (zero kernel and bias) has the output relu(0) = 0.
+
+    Parameters
+    ----------
+    model : keras.Model
+        Filter-pruned model.
+    masks : dict
+        Pruning masks of compute_masks().
+
+    Returns
+    -------
+    compact_model: keras.Model
+    '''
+    kept_filters = {
+        layer.name: np.flatnonzero(bias_mask)
+        for layer, (_, bias_mask) in masks.items()
+        if isinstance(layer, keras.layers.Conv2D)
+        }
+
+    def clone_layer(layer):
+        config = layer.get_config()
+        if layer.name in kept_filters:
+            config["filters"] = len(kept_filters[layer.name])
+        return layer.__class__.from_config(config)
+
+    compact_model = keras.models.clone_model(model, clone_function=clone_layer)
+
+    # channels of the current tensor that are kept (None: all)
+    kept_channels = None
+    for layer, compact_layer in zip(model.layers, compact_model.layers):
+        weights = layer.get_weights()
+        if isinstance(layer, keras.layers.Conv2D):
+            kernel, *bias = weights
+            if kept_channels is not None:
+                kernel = kernel[:, :, kept_channels, :]
+            kept_channels = kept_filters.get(layer.name, np.arange(kernel.shape[-1]))
+            weights = [kernel[..., kept_channels]] + [b[kept_channels] for b in bias]
+        elif isinstance(layer, keras.layers.Flatten) and kept_channels is not None:
+            # flattened index = (row * width + column) * channels + channel
+            height, width, channels = layer.input.shape[1:]
+            kept_channels = np.arange(height * width * channels).reshape(height, width, channels)[:, :, kept_channels].ravel()
+        elif isinstance(layer, keras.layers.Dense):
+            kernel, *bias = weights
+            if kept_channels is not None:
+                kernel = kernel[kept_channels]
+            kept_channels = None
+            weights = [kernel] + bias
+        compact_layer.set_weights(weights)
+    return compact_model
+
+def get_model_stats(model, folder, name, test_data, single_images):
+    '''
+    Function that saves a model and returns its test accuracy, parameter count, number of nonzero weights,
+    file size (.keras and gzip compressed) and mean single-image latency.
+    '''
+    path = os.path.join(folder, f"{name}.keras")
+    model.save(path)
+    with open(path, "rb") as file:
+        compressed_size = len(gzip.compress(file.read()))
+    _, test_accuracy = model.evaluate(test_data, verbose=0)
+    return {
+        "test accuracy": test_accuracy,
+        "parameters": model.count_params(),
+        "nonzero weights": int(sum(np.count_nonzero(weights) for weights in model.get_weights())),
+        "model size bytes": os.path.getsize(path),
+        "compressed size bytes": compressed_size,
+        "latency ms": training_helpers.measure_latency(lambda x: model(x, training=False), single_images),
+        }
+
+# %%
+' ####################### load original model #######################'
+
+mlflow.set_tracking_uri("http://127.0.0.1:8080")
+client = MlflowClient()
+
+source_uri = f"models:/{model_name}/{source_version}"
+model = mlflow.keras.load_model(source_uri)
+signature = mlflow.models.get_model_info(source_uri).signature
+source_tag = next(iter(client.get_model_version(model_name, str(source_version)).tags), "")
+
+# get image size and channel mode of the model input
+img_size = model.input_shape[1]
+channel_mode = "grayscale" if model.input_shape[-1] == 1 else "rgb"
+
+# get fine-tune and test data
+train_data, val_data = get_train_val_data(BATCHSIZE, img_size, channel_mode=channel_mode, cache="memory")
+test_data = get_test_data(BATCHSIZE, img_size, channel_mode=channel_mode, cache="memory")
+class_weights_dict = training_helpers.get_class_weights(get_split_metadata()["train"]["class_counts"])
+single_images = [image for image in next(iter(test_data))[0].numpy()][:latency_samples]
+
+model.compile(
+    loss="binary_crossentropy",
+    metrics=["binary_accuracy"],
+    optimizer=keras.optimizers.Adam(learning_rate=finetune_learning_rate),
+    **training_helpers.get_compile_options(compile_mode)
+    )
+
+# %%
+' ####################### iterative pruning #######################'
+
+prune_filters = is_filter_prunable(model)
+prunable_layers = get_prunable_layers(model)
+print(f"pruning {len(prunable_layers)} layers by {'filters (Conv2D) and weights (Dense)' if prune_filters else 'weights'}")
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    # reference values of the original model
+    reference_stats = get_model_stats(model, temp_dir, "original", test_data, single_images)
+
+    for sparsity in sparsity_schedule:
+        # pruned weights are zero, hence they stay pruned at the next (higher) sparsity
+        masks = compute_masks(prunable_layers, sparsity, prune_filters)
+        apply_masks(masks)
+        model.fit(
+            train_data,
+            epochs=finetune_epochs,
+            class_weight=class_weights_dict,
+            callbacks=[PruningCallback(masks)],
+            verbose=0,
+            )
+        _, val_accuracy = model.evaluate(val_data, verbose=0)
+        print(f"sparsity {sparsity:.2f}: val accuracy after {finetune_epochs} fine-tune epoch(s) {val_accuracy:.4f}")
+
+    # %%
+    ' ####################### export #######################'
+
+    if prune_filters:
+        pruned_model = remove_pruned_filters(model, masks)
+        pruned_model.compile(loss="binary_crossentropy", metrics=["binary_accuracy"], **training_helpers.get_compile_options(compile_mode))
+    else:
+        pruned_model = model
+    pruned_stats = get_model_stats(pruned_model, temp_dir, "pruned", test_data, single_images)
+
+    print(f"{'':<10} {'test accuracy':>13} {'parameters':>10} {'nonzero':>10} {'size (MB)':>9} {'gzip (MB)':>9} {'latency (ms)':>12}")
+    for name, stats in [("original", reference_stats), ("pruned", pruned_stats)]:
+        print(f"{name:<10} {stats['test accuracy']:>13.4f} {stats['parameters']:>10} {stats['nonzero weights']:>10} "
+              f"{stats['model size bytes']/1e6:>9.2f} {stats['compressed size bytes']/1e6:>9.2f} {stats['latency ms']:>12.1f}")
+
+    if register_pruned:
+        mlflow.set_experiment("X-Ray Pneumonia")
+        pruned_tag = f"pruned_{source_tag}"
+        with mlflow.start_run(run_name=f"{pruned_tag} (version {source_version})") as run:
+            mlflow.log_params({
+                "source model version": source_version,
+                "sparsity schedule": sparsity_schedule,
+                "pruning": "filters" if prune_filters else "weights",
+                "fine-tune epochs": finetune_epochs,
+                "fine-tune learning rate": finetune_learning_rate,
+                "batch size": BATCHSIZE,
+                "compile mode": compile_mode,
+                })
+            mlflow.log_metrics(pruned_stats)
+            mlflow.log_metrics({f"reference {metric}": value for metric, value in reference_stats.items()})
+            mlflow.set_tag("Training Info", f"Magnitude pruning of {model_name} version {source_version}")
+            # the signature is taken over from the original
+            mlflow.keras.log_model(pruned_model, artifact_path="model_artifact", signature=signature)
+
+        # register pruned model as new version of the same registered model
+        mlflow.register_model(f"runs:/{run.info.run_id}/model_artifact", model_name, tags={pruned_tag: ""})
@@ -0,0 +1,205 @@
+"""
+This script converts a registered Xray_classifier version into quantized TFLite models for CPU serving.
+Supported variants: dynamic range quantization, float16 quantization, and full int8 quantization
+(calibrated on a slice of data/train).
+
+Every variant is evaluated on data/test, logged as a run in the "X-Ray Pneumonia" experiment and
+registered as a new version of the Xray_classifier model (next to the original version). The registered
+version carries the tag "tflite_[mode]_[tag of the original version]". The API recognizes this tag and
+serves the version through the TFLite interpreter (thread count via env variable TFLITE_NUM_THREADS).
+
+As for the training scripts, the mlflow server has to be running. In the directory of this script, run:
+
+mlflow server --host 127.0.0.1 --port 8080
+"""
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+import mlflow
+from mlflow import MlflowClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import get_train_val_data, get_test_data
+from tflite_model import TFLiteClassifier, TFLiteRunner
+from training_helpers import measure_latency
+
+# %%
+' ####################### params #######################'
+
+# registered model version that should be quantized
+model_name = "Xray_classifier"
+source_version = 1
+
+# quantization variants: "dynamic_range", "float16", "int8"
+quantization_modes = ["dynamic_range", "float16", "int8"]
+
+# calibration slice of data/train for full int8 quantization (number of batches)
+calibration_batches = 10
+
+# params for evaluation
+BATCHSIZE = 32
+num_threads = os.cpu_count()
+latency_samples = 50
+
+register_variants = True
+
+# %%
+' ####################### conversion and evaluation helpers #######################'
+
+def convert_to_tflite(model, mode, calibration_data=None):
+    '''
+    Function that converts a keras model into a TFLite flatbuffer.
+
+    Parameters
+    ----------
+    model : keras.Model
+        Model to be converted.
+    mode : {dynamic_range, float16, int8}
+        Quantization variant.
+    calibration_data : tf.data.Dataset
+        Batched images used as representative dataset. Only needed for mode "int8".
+
+    Returns
+    -------
+    tflite_model: bytes
+        Serialized TFLite model.
+    '''
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif mode == "int8":
+        if calibration_data is None:
+            raise ValueError("Full int8 quantization requires calibration data.")
+
+        def representative_dataset():
+            for images, _ in calibration_data:
+                for image in images:
+                    yield [tf.expand_dims(tf.cast(image, tf.float32), axis=0)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+        converter.inference_output_type = tf.uint8
+
+    elif mode != "dynamic_range":
+        raise ValueError(f"Unknown quantization mode: {mode}")
+
+    return converter.convert()
+
+def evaluate_tflite(model_path, test_data):
+    '''
+    Function that returns the binary accuracy of a TFLite model on the test dataset
+    and its mean single-image latency.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the .tflite file.
+    test_data : tf.data.Dataset
+        Batched test images and labels.
+
+    Returns
+    -------
+    test_accuracy: float
+    latency_ms: float
+        Mean latency of a single-image prediction in milliseconds.
+    '''
+    runner = TFLiteRunner(model_path, num_threads=num_threads)
+
+    correct = 0
+    total = 0
+    single_images = []
+    for images, labels in test_data:
+        images = images.numpy()
+        prediction = runner(images)
+        correct += np.sum(np.around(prediction) == labels.numpy())
+        total += len(labels)
+        if len(single_images) < latency_samples:
+            single_images.extend(images[:latency_samples - len(single_images)])
+
+    return correct / total, measure_latency(runner, single_images)
+
+# %%
+' ####################### load original model #######################'
+
+mlflow.set_tracking_uri("http://127.0.0.1:8080")
+client = MlflowClient()
+
+source_uri = f"models:/{model_name}/{source_version}"
+model = mlflow.keras.load_model(source_uri)
+signature = mlflow.models.get_model_info(source_uri).signature
+source_tag = next(iter(client.get_model_version(model_name, str(source_version)).tags), "")
+
+# get image size and channel mode of the model input
+img_size = model.input_shape[1]
+channel_mode = "grayscale" if model.input_shape[-1] == 1 else "rgb"
+
+# get calibration and test data
+train_data, _ = get_train_val_data(BATCHSIZE, img_size, channel_mode=channel_mode)
+calibration_data = train_data.take(calibration_batches)
+test_data = get_test_data(BATCHSIZE, img_size, channel_mode=channel_mode)
+
+# reference values of the original model
+model.compile(loss="binary_crossentropy", metrics=["binary_accuracy"])
+_, reference_accuracy = model.evaluate(test_data, verbose=1)
+single_images = [image for image in next(iter(test_data))[0].numpy()][:latency_samples]
+reference_latency = measure_latency(lambda x: model(x, training=False), single_images)
+print(f"original model (version {source_version}): test accuracy {reference_accuracy:.4f}, latency {reference_latency:.1f} ms")
+
+# %%
+' ####################### convert, evaluate, log and register variants #######################'
+
+mlflow.set_experiment("X-Ray Pneumonia")
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    for mode in quantization_modes:
+
+        # conversion
+        tflite_model = convert_to_tflite(model, mode, calibration_data)
+        tflite_path = os.path.join(temp_dir, f"model_{mode}.tflite")
+        with open(tflite_path, "wb") as file:
+            file.write(tflite_model)
+
+        # evaluation
+        test_accuracy, latency = evaluate_tflite(tflite_path, test_data)
+        print(f"{mode}: test accuracy {test_accuracy:.4f}, latency {latency:.1f} ms, size {len(tflite_model)/1e6:.1f} MB")
+
+        if not register_variants:
+            continue
+
+        variant_tag = f"tflite_{mode}_{source_tag}"
+        with mlflow.start_run(run_name=f"{variant_tag} (version {source_version})") as run:
+            mlflow.log_params({
+                "source model version": source_version,
+                "quantization mode": mode,
+                "calibration batches": calibration_batches if mode == "int8" else 0,
+                "batch size": BATCHSIZE,
+                })
+            mlflow.log_metrics({
+                "test accuracy": test_accuracy,
+                "reference test accuracy": reference_accuracy,
+                "latency ms": latency,
+                "reference latency ms": reference_latency,
+                "model size bytes": len(tflite_model),
+                })
+            mlflow.set_tag("Training Info", f"TFLite {mode} quantization of {model_name} version {source_version}")
+
+            # log TFLite artifact together with its pyfunc wrapper; the signature is taken over from the original
+            mlflow.pyfunc.log_model(
+                artifact_path="model_artifact",
+                python_model=TFLiteClassifier(),
+                artifacts={"tflite_model": tflite_path},
+                code_paths=[os.path.join(os.path.dirname(os.path.realpath(__file__)), "tflite_model.py")],
+                signature=signature,
+                model_config={"num_threads": 1},
+                )
+
+        # register variant as new version of the same registered model
+        mlflow.register_model(f"runs:/{run.info.run_id}/model_artifact", model_name, tags={variant_tag: ""})
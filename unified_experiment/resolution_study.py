@@ -0,0 +1,162 @@
+"""
+This script measures the trade-off between input resolution, test accuracy and CPU latency for the model families
+of the training scripts:
+- own model: small CNN on grayscale images (training_ownmodel.py), trained from scratch
+- transfer learning: frozen MobileNet with dense top layers on grayscale images (channel broadcast in the model) (training_transferlearning.py)
+
+For every family and image size of img_sizes, the model is trained for the epochs of the family and evaluated:
+- test accuracy (data/test)
+- single-image latency: mean over latency_samples predictions of one image
+- batched latency: median time of a batch of latency_batch_size images, per image
+- parameter count
+
+The report (printed and written to report_path) marks the Pareto-optimal points, i.e. the (family, size)
+combinations without any other combination that is at least as accurate and faster (single-image latency).
+
+The images are read from the memory-mapped tensor stores (see data/tensor_store.py), one store per image size
+and channel mode is built at the first run. To train and serve a model at a chosen size, set the environment
+variable IMGSIZE (see data/helpers.py) for the training script. The size is logged as run parameter "image size",
+the API resizes the images to the input size of every served model.
+"""
+
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+from tensorflow import keras
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data.helpers import get_train_val_data, get_test_data, get_split_metadata
+import training_helpers
+
+
+' ################################ configuration #####################################'
+img_sizes = [128, 160, 192, 224, 256]
+latency_samples = 50
+latency_batch_size = 32
+# weights of the MobileNet base: "imagenet" or None (random weights, no download)
+base_weights = "imagenet"
+# compilation mode of training and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+report_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resolution_study.csv")
+
+
+' ################################ model families ####################################'
+def get_own_model_family(img_size):
+    """
+    Returns the own model for the image size and its training arguments.
+    """
+    model = training_helpers.get_own_model(dropout_rate=0.3, img_size=img_size)
+    return model, {"channel_mode": "grayscale", "batch_size": 128, "epochs": 10,
+                   "optimizer": keras.optimizers.SGD(learning_rate=0.01, momentum=0.8)}
+
+def get_transfer_learning_family(img_size):
+    """
+    Returns the transfer learning model (frozen MobileNet + top layers) for the image size and its training arguments.
+    """
+    base_model = keras.applications.MobileNet(input_shape=(img_size, img_size, 3), include_top=False, weights=base_weights)
+    base_model.trainable = False
+    inputs = keras.layers.Input(shape=(img_size, img_size, 1))
+    x = base_model(training_helpers.broadcast_channels(inputs))
+    x = keras.layers.GlobalAveragePooling2D()(x)
+    x = keras.layers.Dense(128, activation="relu")(x)
+    x = keras.layers.Dropout(0.4)(x)
+    output = keras.layers.Dense(1, activation="sigmoid")(x)
+    model = keras.Model(inputs=inputs, outputs=output)
+    return model, {"channel_mode": "grayscale", "batch_size": 10, "epochs": 3,
+                   "optimizer": keras.optimizers.Adam(learning_rate=0.001)}
+
+model_families = {
+    "own model": get_own_model_family,
+    "transfer learning": get_transfer_learning_family,
+    }
+
+
+' ################################ helper functions ##################################'
+def measure_batched_latency(model, images, repeats=5):
+    """
+    Returns the median latency (in milliseconds) per image of predicting the batch of images.
+    """
+    model.predict_on_batch(images)  # warm up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict_on_batch(images)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times)) / len(images)
+
+def run_configuration(get_family, img_size, class_weights_dict):
+    """
+    Trains and evaluates a model family at an image size. Returns the measured values.
+    """
+    model, settings = get_family(img_size)
+    model.compile(
+        loss="binary_crossentropy",
+        metrics=["binary_accuracy"],
+        optimizer=settings["optimizer"],
+        **training_helpers.get_compile_options(compile_mode),
+        )
+    train_data, val_data = get_train_val_data(settings["batch_size"], img_size, settings["channel_mode"], use_tensor_store=True)
+    test_data = get_test_data(settings["batch_size"], img_size, settings["channel_mode"], use_tensor_store=True)
+
+    start = time.perf_counter()
+    history = model.fit(train_data, epochs=settings["epochs"], class_weight=class_weights_dict, validation_data=val_data, verbose=0)
+    train_seconds = time.perf_counter() - start
+    _, test_accuracy = model.evaluate(test_data, verbose=0)
+
+    test_images = np.concatenate([images for images, _ in test_data.as_numpy_iterator()]).astype(np.float32)
+    single_latency = training_helpers.measure_latency(lambda x: model(x, training=False), list(test_images[:latency_samples]))
+    batched_latency = measure_batched_latency(model, test_images[:latency_batch_size])
+
+    return {
+        "val accuracy": history.history["val_binary_accuracy"][-1],
+        "test accuracy": test_accuracy,
+        "single latency ms": single_latency,
+        "batched latency ms": batched_latency,
+        "parameters": model.count_params(),
+        "train seconds": train_seconds,
+        }
+
+def mark_pareto_front(results):
+    """
+    Sets "pareto" of every result: True, if no other result is at least as accurate and faster (or more
+    accurate and as fast).
+    """
+    for result in results:
+        result["pareto"] = not any(
+            other["test accuracy"] >= result["test accuracy"]
+            and other["single latency ms"] <= result["single latency ms"]
+            and (other["test accuracy"] > result["test accuracy"] or other["single latency ms"] < result["single latency ms"])
+            for other in results
+            )
+
+
+' ################################ study #############################################'
+if __name__ == "__main__":
+    class_weights_dict = training_helpers.get_class_weights(get_split_metadata()["train"]["class_counts"])
+
+    results = []
+    for family, get_family in model_families.items():
+        for img_size in img_sizes:
+            result = {"model family": family, "image size": img_size}
+            result.update(run_configuration(get_family, img_size, class_weights_dict))
+            results.append(result)
+            print(f"{family} | {img_size}: {result}")
+            keras.backend.clear_session()
+    mark_pareto_front(results)
+
+    with open(report_path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f"\nResolution study (latency on {os.cpu_count()} CPU cores, * = Pareto-optimal in test accuracy "
+          f"and single-image latency, report: {report_path}):")
+    print(f"{'model family':<18} {'size':>5} {'test accuracy':>13} {'single (ms)':>11} {'batched (ms/img)':>16} "
+          f"{'parameters':>10} {'train (s)':>9}")
+    for result in sorted(results, key=lambda result: result["single latency ms"]):
+        print(f"{result['model family']:<18} {result['image size']:>5} {result['test accuracy']:>13.4f} "
+              f"{result['single latency ms']:>11.1f} {result['batched latency ms']:>16.2f} {result['parameters']:>10} "
+              f"{result['train seconds']:>9.0f} {'*' if result['pareto'] else ''}")
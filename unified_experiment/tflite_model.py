@@ -0,0 +1,84 @@
+"""
+This module contains the mlflow wrapper for TFLite artifacts (see quantization.py).
+It is shipped together with every logged TFLite model (via code_paths), such that
+mlflow.pyfunc.load_model() can restore the interpreter on any machine, e.g. inside the API.
+"""
+
+import threading
+
+import numpy as np
+import mlflow
+
+
+class TFLiteRunner:
+    """
+    Callable that feeds batches of images through a TFLite interpreter and returns
+    the (dequantized) float32 predictions. Handles quantized (int8/uint8) input and
+    output tensors. The runner is not thread-safe.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the .tflite file.
+    num_threads : int or None
+        Number of interpreter threads (None = TFLite default).
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.interpreter = None
+        self.batch_shape = None
+
+    def _build_interpreter(self, batch_shape):
+        import tensorflow as tf
+
+        # the tensors have to be resized BEFORE the first allocation, the XNNPACK delegate
+        # does not support resizing of dynamic range models once it has been applied
+        self.interpreter = tf.lite.Interpreter(model_path=self.model_path, num_threads=self.num_threads)
+        self.interpreter.resize_tensor_input(self.interpreter.get_input_details()[0]["index"], batch_shape)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.batch_shape = batch_shape
+
+    def __call__(self, input_batch):
+        input_batch = np.asarray(input_batch, dtype=np.float32)
+        if input_batch.shape != self.batch_shape:
+            self._build_interpreter(input_batch.shape)
+
+        # quantize input, if the model expects integer input (full int8 quantization)
+        input_dtype = self.input_details["dtype"]
+        if np.issubdtype(input_dtype, np.integer):
+            scale, zero_point = self.input_details["quantization"]
+            input_batch = np.round(input_batch / scale + zero_point)
+            input_batch = np.clip(input_batch, np.iinfo(input_dtype).min, np.iinfo(input_dtype).max)
+
+        self.interpreter.set_tensor(self.input_details["index"], input_batch.astype(input_dtype))
+        self.interpreter.invoke()
+        prediction = self.interpreter.get_tensor(self.output_details["index"])
+
+        # dequantize output, if the model returns integer output (full int8 quantization)
+        if np.issubdtype(self.output_details["dtype"], np.integer):
+            scale, zero_point = self.output_details["quantization"]
+            prediction = (prediction.astype(np.float32) - zero_point) * scale
+
+        return prediction.astype(np.float32)
+
+
+class TFLiteClassifier(mlflow.pyfunc.PythonModel):
+    """
+    Mlflow pyfunc model serving a .tflite artifact through the TFLite interpreter.
+    The number of interpreter threads is read from the model config key "num_threads",
+    which can be overridden at load time: mlflow.pyfunc.load_model(uri, model_config={"num_threads": 4}).
+    """
+
+    def load_context(self, context):
+        num_threads = (context.model_config or {}).get("num_threads")
+        self.runner = TFLiteRunner(context.artifacts["tflite_model"], num_threads=num_threads)
+        # the interpreter is not thread-safe, invocations are serialized
+        self.lock = threading.Lock()
+
+    def predict(self, context, model_input, params=None):
+        with self.lock:
+            return self.runner(model_input)
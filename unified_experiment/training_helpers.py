@@ -1,7 +1,31 @@
 import io
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 import matplotlib.pyplot as plt
 
+# keyword arguments of model.compile() per compilation mode of the training and evaluation steps
+COMPILE_MODES = {
+    "eager": {"run_eagerly": True, "jit_compile": False},   # op by op in python (debugging)
+    "graph": {"run_eagerly": False, "jit_compile": False},  # tf.function graph (keras default with tensorflow)
+    "xla": {"run_eagerly": False, "jit_compile": True},     # tf.function graph compiled with XLA (fused kernels)
+}
+
+def get_compile_options(compile_mode):
+    """This function returns the keyword arguments of model.compile() for a compilation mode (see COMPILE_MODES).
+    The mode also applies to model.evaluate() and model.predict() of the compiled model.
+    
+    params: compile_mode -> "eager", "graph" or "xla"
+    return: compile_options -> dict"""
+
+    if compile_mode not in COMPILE_MODES:
+        raise ValueError(f"Unknown compile mode {compile_mode}, expected one of {list(COMPILE_MODES)}.")
+    return COMPILE_MODES[compile_mode]
+
 def generate_model_summary_string(model) -> str:
     """this function receives a keras model as input, 
     extracts model summary (object) and turns it into a string (suitable for logging).
@@ -40,4 +64,374 @@ def generate_plot_of_learning_curves(history_in):
     ax.set_ylabel('binary accuracy')
     ax.legend()
     ax.set_title("Training and Validation binary accuracy")
-    return fig
\ No newline at end of file
+    return fig
+
+def get_cached_features(feature_model, dataset, cache_file):
+    """This function returns the outputs of a (frozen) feature model for all images of a dataset, together with their labels.
+    The features are computed in one pass over the dataset and stored in cache_file (.npz), later calls load them from there.
+    The cache file has to be specific to the feature model and the images, it is not invalidated by this function.
+    
+    params: feature_model -> keras model, e.g. frozen base model with pooling
+            dataset -> tf.data.Dataset of (image batch, label batch)
+            cache_file -> path of the .npz file
+    return: features -> numpy array (n_images, n_features)
+            labels -> numpy array (n_images, 1)"""
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return cached["features"], cached["labels"]
+
+    features = []
+    labels = []
+    for images, batch_labels in dataset:
+        features.append(feature_model.predict_on_batch(images))
+        labels.append(batch_labels.numpy())
+    features = np.concatenate(features)
+    labels = np.concatenate(labels)
+
+    # write via temp file, an interrupted run doesn't leave an incomplete cache behind
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = cache_file + ".tmp.npz"
+    np.savez(temp_file, features=features, labels=labels)
+    os.replace(temp_file, cache_file)
+    return features, labels
+
+def split_model_at_layer(model_in, split_layer):
+    """This function splits a functional keras model behind one of its layers into a prefix and a tail model.
+    The tail model takes the outputs of the split layer as input and shares its layers (and weights) with model_in,
+    hence training the tail model trains model_in. tail_model(prefix_model(x)) equals model_in(x).
+    
+    params: model_in -> functional keras model
+            split_layer -> layer of model_in
+    return: prefix_model -> keras model from the inputs of model_in to the outputs of split_layer
+            tail_model -> keras model from the outputs of split_layer to the outputs of model_in"""
+
+    prefix_model = keras.Model(inputs=model_in.input, outputs=split_layer.output)
+    try:
+        tail_model = keras.Model(inputs=split_layer.output, outputs=model_in.output)
+    except ValueError as e:
+        # e.g. a residual connection that bypasses the split layer
+        raise ValueError(
+            f"Model {model_in.name} can't be split behind layer {split_layer.name}: "
+            f"not all paths to the outputs pass through it."
+        ) from e
+    return prefix_model, tail_model
+
+def broadcast_channels(inputs, channels=3):
+    """This function repeats the single channel of grayscale inputs in the graph, e.g. for backbones pretrained on rgb images
+    (MobileNet, ResNet). Training data, cached tensors and API payloads stay single-channel. The Concatenate layer is saved
+    with the model, no custom object is needed to load it.
+    
+    params: inputs -> keras tensor (batch, height, width, 1)
+            channels -> number of channels of the output
+    return: outputs -> keras tensor (batch, height, width, channels)"""
+
+    return keras.layers.Concatenate(axis=-1, name="channel_broadcast")([inputs] * channels)
+
+def get_stage_model(model_in, img_size):
+    """This function returns a model for a stage of progressive resizing (see data.helpers.get_resizing_stages()): the layers
+    of model_in, called on inputs of size img_size * img_size. The stage model shares its layers (and weights) with model_in,
+    hence training it trains model_in. It is compiled like model_in (same optimizer object, i.e. the optimizer state carries over).
+    model_in has to be a chain of layers (each layer takes the output of the previous one) that accepts other spatial sizes
+    up to its pooling: e.g. global pooling, or Flatten, in front of which the feature maps are resized to the shape of model_in.
+    Nested models need an input shape (None, None, channels).
+
+    params: model_in -> compiled functional keras model
+            img_size -> image size of the stage
+    return: stage_model -> compiled keras model (model_in itself for its own input size)"""
+
+    if model_in.input_shape[1:3] == (img_size, img_size):
+        return model_in
+
+    inputs = keras.layers.Input(shape=(img_size, img_size, model_in.input_shape[-1]))
+    x = inputs
+    for layer in model_in.layers[1:]:
+        if isinstance(layer, keras.layers.Flatten) and tuple(x.shape[1:3]) != tuple(layer.input.shape[1:3]):
+            # the dense layer behind Flatten expects the number of features of the full image size
+            x = keras.layers.Resizing(*layer.input.shape[1:3])(x)
+        if isinstance(layer, keras.layers.Concatenate):
+            # channel broadcast (see broadcast_channels())
+            x = layer([x] * len(layer.input))
+        else:
+            x = layer(x)
+    stage_model = keras.Model(inputs=inputs, outputs=x)
+
+    stage_model.compile(
+        loss=model_in.loss,
+        optimizer=model_in.optimizer,
+        metrics=model_in.get_compile_config()["metrics"],
+        run_eagerly=model_in.run_eagerly,
+        jit_compile=model_in.jit_compile,
+        )
+    return stage_model
+
+def merge_histories(histories):
+    """This function concatenates the histories of several model.fit() calls, e.g. the stages of progressive resizing.
+
+    params: histories -> list of keras.callbacks.History
+    return: history -> keras.callbacks.History"""
+
+    history = keras.callbacks.History()
+    history.history = {}
+    history.epoch = []
+    for stage_history in histories:
+        history.epoch.extend(stage_history.epoch)
+        for metric, values in stage_history.history.items():
+            history.history.setdefault(metric, []).extend(values)
+    return history
+
+def get_class_weights(label_counts):
+    """This function returns class weights that balance the classes in the loss (weight 0.5 * n_images / n_images of the class).
+    
+    params: label_counts -> number of images per class index, e.g. from data.helpers.get_split_metadata()
+    return: class_weights_dict -> dict (class index -> weight, rounded to 2 decimals)"""
+
+    class_weights = 0.5 * np.sum(label_counts) / label_counts
+    class_weights = np.around(class_weights,2)
+
+    class_weights_dict = dict(enumerate(class_weights))
+    
+    return class_weights_dict
+
+def get_own_model(dropout_rate, img_size, width_multiplier=1):
+    """This function returns the own CNN architecture (three convolution blocks and a small dense head) for grayscale images.
+    Used by training_ownmodel.py, hyperparameter_sweep.py and distillation.py.
+    
+    params: dropout_rate -> dropout rate of the dense head (no dropout layer if 0)
+            img_size -> images have the size img_size * img_size
+            width_multiplier -> scales the number of filters of the convolution blocks (8, 16, 32 for 1)
+    return: model -> keras model (not compiled)"""
+
+    def width(filters):
+        return max(1, int(round(filters * width_multiplier)))
+
+    inputs = keras.layers.Input(shape=(img_size, img_size, 1))
+    
+    # Rescaling
+    x = keras.layers.Rescaling(scale = 1./255)(inputs)
+    
+    # First block
+    x = keras.layers.Conv2D(
+        filters=width(8),
+        kernel_size = (3,3),
+        strides = (1,1),
+        padding = 'same', # such that the output has the same size as the input
+        activation = 'relu',
+        kernel_regularizer = None
+        )(x) # output shape = (img_size, img_size, 8) (filters of all blocks times width_multiplier)
+    
+    x = keras.layers.MaxPooling2D(pool_size=(4, 4))(x) # output shape = (img_size/4, img_size/4, 8) 
+    
+    # Second block 
+    x = keras.layers.Conv2D(
+        filters=width(16),
+        kernel_size = (3,3),
+        strides = (1,1),
+        padding = 'same',
+        activation = 'relu',
+        kernel_regularizer = None
+        )(x) # output shape = (img_size/4, img_size/4, 16)
+    
+    x = keras.layers.MaxPooling2D(pool_size=(4, 4))(x) # output shape = (img_size/16, img_size/16, 16) 
+    
+    # Third block 
+    x = keras.layers.Conv2D(
+        filters=width(32),
+        kernel_size = (3,3),
+        strides = (1,1),
+        padding = 'same',
+        activation = 'relu',
+        kernel_regularizer = None
+        )(x) # output shape = (img_size/16, img_size/16, 32)
+    
+    x = keras.layers.MaxPooling2D(pool_size=(4, 4))(x) # output shape = (img_size/64, img_size/64, 32)
+    
+    # Head (Flatten + Dense Layer)
+    
+    x = keras.layers.Flatten()(x) # output shape = (img_size/64)**2 * 32
+    x = keras.layers.Dense(10, activation="relu", kernel_regularizer = None)(x)
+    
+    if dropout_rate > 0:
+        x = keras.layers.Dropout(dropout_rate)(x)
+
+    #Final Layer (Output)
+    output = keras.layers.Dense(1, activation='sigmoid')(x)
+    
+    model = keras.Model(inputs=inputs, outputs=output)
+    
+    return model
+
+def measure_latency(predict, images):
+    """This function returns the mean latency (in milliseconds) of predict() for single images.
+    
+    params: predict -> function, takes a batch of images
+            images -> list of images (without batch dimension)
+    return: latency_ms -> float"""
+
+    # warm up (tensor allocation, first invocation)
+    predict(np.expand_dims(images[0], axis=0))
+
+    start = time.perf_counter()
+    for image in images:
+        predict(np.expand_dims(image, axis=0))
+    return 1000 * (time.perf_counter() - start) / len(images)
+
+def get_profiler_callback(profile_steps):
+    """This function returns a TensorBoard callback that captures a profiler trace (op-level timings, input pipeline analysis)
+    over a range of training steps, and the directory of the trace. The steps are counted from the start of the training.
+    The trace can be viewed with tensorboard --logdir [directory] (profile tab, needs the package tensorboard-plugin-profile).
+    
+    params: profile_steps -> (first step, last step) of the trace, e.g. (10, 20)
+    return: callback -> keras.callbacks.TensorBoard
+            profile_dir -> directory (temporary) of the trace"""
+
+    profile_dir = tempfile.mkdtemp(prefix="profile_")
+    callback = keras.callbacks.TensorBoard(
+        log_dir=profile_dir,
+        histogram_freq=0,
+        write_graph=False,
+        profile_batch=profile_steps
+    )
+    return callback, profile_dir
+
+def get_peak_rss_mb():
+    """This function returns the peak resident memory (RSS) of the process in MB, None where it isn't available (Windows).
+    
+    return: peak_rss_mb -> float or None"""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS, in KB on Linux
+    return peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024
+
+class ThroughputCallback(keras.callbacks.Callback):
+    """This keras callback records the training throughput per epoch:
+    - images/sec of the training steps (validation excluded)
+    - step time percentiles (p50, p90, p99, milliseconds)
+    - input wait: time a step waits for its batch from the input pipeline, as fraction of the step time
+      (only for datasets wrapped with instrument(), otherwise the wait is part of the step time)
+    - peak RSS of the process (MB, not available on Windows)
+    The results are logged through log_mlflow_run(throughput = callback): metrics per epoch and a summary artifact.
+    
+    params: batch_size -> images per step (used if the dataset isn't instrumented)"""
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self.epochs = []
+        self._arrivals = []
+
+    def instrument(self, dataset):
+        """This function returns the dataset with a timestamp per batch, taken when the training step receives the batch.
+        The batch is otherwise unchanged. It has to be the last transformation, the dataset is passed to model.fit().
+        
+        params: dataset -> tf.data.Dataset of (image batch, label batch)
+        return: dataset -> tf.data.Dataset"""
+
+        def record_arrival(n_images):
+            self._arrivals.append((time.perf_counter(), int(n_images)))
+            return np.int64(0)
+
+        def mark_batch(images, labels):
+            marker = tf.py_function(record_arrival, [tf.shape(images)[0]], tf.int64)
+            with tf.control_dependencies([marker]):
+                return tf.identity(images), tf.identity(labels)
+
+        # runs in the thread of the training step (no prefetch behind the timestamp)
+        options = tf.data.Options()
+        options.experimental_optimization.inject_prefetch = False
+        return dataset.map(mark_batch).with_options(options)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._step_times = []
+        self._input_waits = []
+        self._n_images = 0
+        self._arrivals.clear()
+        self._train_seconds = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_end = time.perf_counter()
+        step_time = step_end - self._step_start
+        self._step_times.append(step_time)
+        self._train_seconds += step_time
+        if self._arrivals:
+            arrival, n_images = self._arrivals.pop()
+            self._arrivals.clear()
+            self._input_waits.append(min(max(arrival - self._step_start, 0.0), step_time))
+            self._n_images += n_images
+        else:
+            self._n_images += self.batch_size
+
+    def on_epoch_end(self, epoch, logs=None):
+        step_times_ms = 1000 * np.array(self._step_times)
+        stats = {
+            "images per sec": self._n_images / self._train_seconds,
+            "step time p50 ms": float(np.percentile(step_times_ms, 50)),
+            "step time p90 ms": float(np.percentile(step_times_ms, 90)),
+            "step time p99 ms": float(np.percentile(step_times_ms, 99)),
+            }
+        peak_rss_mb = get_peak_rss_mb()
+        if peak_rss_mb is not None:
+            stats["peak rss MB"] = peak_rss_mb
+        if self._input_waits:
+            stats["input wait fraction"] = float(np.sum(self._input_waits) / self._train_seconds)
+        self.epochs.append(stats)
+
+    def summary(self):
+        """This function returns the throughput over all epochs as dict (mean of the epoch values, peak RSS: maximum),
+        together with the values per epoch."""
+
+        summary = {}
+        for metric in self.epochs[0]:
+            values = [epoch_stats[metric] for epoch_stats in self.epochs]
+            summary[metric] = max(values) if metric == "peak rss MB" else float(np.mean(values))
+        # the first epoch includes tracing of the train function (and filling of caches)
+        if len(self.epochs) > 1:
+            summary["images per sec without first epoch"] = float(np.mean([epoch_stats["images per sec"] for epoch_stats in self.epochs[1:]]))
+        return {"summary": summary, "epochs": self.epochs}
+
+class TimeToAccuracyCallback(keras.callbacks.Callback):
+    """This keras callback records the wall-clock time from the start of the training until the validation accuracy reaches
+    target_accuracy for the first time (e.g. to compare progressive resizing with training at a fixed image size).
+    It can be passed to several model.fit() calls (stages of progressive resizing), the time runs from the first one.
+    By default the accuracy of the validation data of fit() is used. With model and validation_data, the accuracy of model
+    on validation_data is evaluated at the end of every epoch in which another model is trained (e.g. the full-size model
+    during a low-resolution stage), the time of this evaluation isn't counted.
+
+    params: target_accuracy -> validation binary accuracy to reach
+            model -> compiled keras model to evaluate (optional)
+            validation_data -> tf.data.Dataset of (image batch, label batch) (optional, together with model)"""
+
+    def __init__(self, target_accuracy, model=None, validation_data=None):
+        super().__init__()
+        self.target_accuracy = target_accuracy
+        self.evaluated_model = model
+        self.validation_data = validation_data
+        self.time_to_target = None
+        self.epoch_to_target = None
+        self.accuracies = []
+        self._start = None
+        self.evaluation_seconds = 0.0
+
+    def on_train_begin(self, logs=None):
+        if self._start is None:
+            self._start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        # the validation data of fit() is used, while model itself is trained (e.g. final stage of progressive resizing)
+        if self.validation_data is not None and (self.model is not self.evaluated_model or "val_binary_accuracy" not in logs):
+            evaluation_start = time.perf_counter()
+            _, accuracy = self.evaluated_model.evaluate(self.validation_data, verbose=0)
+            self.evaluation_seconds += time.perf_counter() - evaluation_start
+        else:
+            accuracy = logs["val_binary_accuracy"]
+        self.accuracies.append(accuracy)
+        if self.time_to_target is None and accuracy >= self.target_accuracy:
+            self.time_to_target = time.perf_counter() - self._start - self.evaluation_seconds
+            self.epoch_to_target = epoch + 1
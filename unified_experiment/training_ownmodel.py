@@ -2,12 +2,11 @@ import time
 import os
 import sys
 
-import numpy as np
 from tensorflow import keras
 
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from data.helpers import get_train_val_data, get_test_data, IMGSIZE
+from data.helpers import get_train_val_data, get_progressive_train_val_data, get_resizing_stages, get_test_data, get_split_metadata, IMGSIZE
 import training_helpers
 from mlflow_logging import log_mlflow_run
 
@@ -21,97 +20,36 @@ learning_rate = 0.01
 momentum = 0.8
 optimizer = keras.optimizers.SGD(learning_rate = learning_rate, momentum = momentum)
 dropout_rate = 0.3
+# compilation mode of training and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+# cache of the decoded images: None, "memory", "disk" or "snapshot" (see data/helpers.py)
+pipeline_cache = "memory"
+# progressive resizing: (image size, epochs) of the stages before the remaining epochs at IMGSIZE, e.g. [(128, 2)]
+# (see data/helpers.py), None: all epochs at IMGSIZE
+resizing_schedule = None
+# validation accuracy (at IMGSIZE) for the logged wall-clock time to target accuracy
+target_accuracy = 0.9
 
 mlflow_logging = True
+# capture a TensorBoard profiler trace of the training steps profile_steps (first, last), logged with the run
+profiling = False
+profile_steps = (10, 20)
 
-train_data, val_data = get_train_val_data(BATCH_SIZE, IMGSIZE, channel_mode = "grayscale")
+train_data, val_data = get_train_val_data(BATCH_SIZE, IMGSIZE, channel_mode = "grayscale", cache = pipeline_cache)
 
-# compute class weights
+# compute class weights (from the file index of the training subset, no image has to be decoded)
+class_weights_dict = training_helpers.get_class_weights(get_split_metadata()["train"]["class_counts"])
 
-def get_class_weights():
-
-    all_labels = np.array([])
-    
-    for _, y in train_data:
-        y_flat = y.numpy().flatten()
-        all_labels = np.concatenate((all_labels,y_flat))
-
-    label_counts = [np.sum(all_labels == i) for i in range(2)]
-
-    class_weights = 0.5 * np.sum(label_counts) / label_counts
-    class_weights = np.around(class_weights,2)
-
-    class_weights_dict = dict(enumerate(class_weights))
-    
-    return class_weights_dict
-class_weights_dict = get_class_weights()
-
-# construct the neural net
-def get_model(dropout_rate): 
-    
-    inputs = keras.layers.Input(shape=(IMGSIZE, IMGSIZE, 1))
-    
-    # Rescaling
-    x = keras.layers.Rescaling(scale = 1./255)(inputs)
-    
-    # First block
-    x = keras.layers.Conv2D(
-        filters=8,
-        kernel_size = (3,3),
-        strides = (1,1),
-        padding = 'same', # such that the output has the same size as the input
-        activation = 'relu',
-        kernel_regularizer = None
-        )(x) # output shape = (IMGSIZE, IMGSIZE, 8)
-    
-    x = keras.layers.MaxPooling2D(pool_size=(4, 4))(x) # output shape = (IMGSIZE/4, IMGSIZE/4, 8) 
-    
-    # Second block 
-    x = keras.layers.Conv2D(
-        filters=16,
-        kernel_size = (3,3),
-        strides = (1,1),
-        padding = 'same',
-        activation = 'relu',
-        kernel_regularizer = None
-        )(x) # output shape = (IMGSIZE/4, IMGSIZE/4, 16)
-    
-    x = keras.layers.MaxPooling2D(pool_size=(4, 4))(x) # output shape = (IMGSIZE/16, IMGSIZE/16, 16) 
-    
-    # Third block 
-    x = keras.layers.Conv2D(
-        filters=32,
-        kernel_size = (3,3),
-        strides = (1,1),
-        padding = 'same',
-        activation = 'relu',
-        kernel_regularizer = None
-        )(x) # output shape = (IMGSIZE/16, IMGSIZE/16, 32)
-    
-    x = keras.layers.MaxPooling2D(pool_size=(4, 4))(x) # output shape = (IMGSIZE/64, IMGSIZE/64, 32) = (4,4,32)
-    
-    # Head (Flatten + Dense Layer)
-    
-    x = keras.layers.Flatten()(x) # output shape = 512
-    x = keras.layers.Dense(10, activation="relu", kernel_regularizer = None)(x)
-    
-    if dropout_rate > 0:
-        x = keras.layers.Dropout(dropout_rate)(x)
-
-    #Final Layer (Output)
-    output = keras.layers.Dense(1, activation='sigmoid')(x)
-    
-    model = keras.Model(inputs=inputs, outputs=output)
-    
-    return model
-model = get_model(dropout_rate)
+# construct the neural net (see training_helpers.py, shared with hyperparameter_sweep.py)
+model = training_helpers.get_own_model(dropout_rate, IMGSIZE)
 
 metrics = ["binary_accuracy"]
 
 model.compile(
     loss=loss_func, 
     metrics = metrics,
-    optimizer = optimizer
+    optimizer = optimizer,
+    **training_helpers.get_compile_options(compile_mode)
     )
 
 # print model summary
@@ -120,14 +58,35 @@ model.summary()
 
 start = time.time()
 
-history = model.fit(
-    train_data, 
-    epochs = EPOCHS, 
-    verbose = True,
-    class_weight = class_weights_dict,
-    validation_data = val_data,
-    # callbacks = [lr_reduction, model_checkpoint_callback]
-    )
+# records images/sec, step times, input wait and peak RSS (logged with the run)
+throughput = training_helpers.ThroughputCallback(BATCH_SIZE)
+chosen_callbacks = [throughput]
+profile_dir = None
+if profiling:
+    profiler, profile_dir = training_helpers.get_profiler_callback(profile_steps)
+    chosen_callbacks.append(profiler)
+
+# wall-clock time until the validation accuracy at IMGSIZE reaches target_accuracy
+# (lower resolution stages are validated at their image size, the full-size model is evaluated in addition)
+time_to_accuracy = training_helpers.TimeToAccuracyCallback(target_accuracy, model, val_data if resizing_schedule else None)
+chosen_callbacks.append(time_to_accuracy)
+
+# one stage at IMGSIZE without resizing schedule, the lower resolution stages train the layers of model
+histories = []
+for stage in get_progressive_train_val_data(BATCH_SIZE, resizing_schedule, EPOCHS, channel_mode = "grayscale", cache = pipeline_cache, final_stage_data = (train_data, val_data)):
+    print(f"stage: image size {stage['img_size']}, epochs {stage['initial_epoch'] + 1} to {stage['epochs']}")
+    stage_model = training_helpers.get_stage_model(model, stage["img_size"])
+    histories.append(stage_model.fit(
+        throughput.instrument(stage["train_data"]), 
+        initial_epoch = stage["initial_epoch"],
+        epochs = stage["epochs"], 
+        verbose = True,
+        class_weight = class_weights_dict,
+        validation_data = stage["val_data"],
+        callbacks = chosen_callbacks,
+        # callbacks = [lr_reduction, model_checkpoint_callback]
+        ))
+history = training_helpers.merge_histories(histories)
 
 
 print(f'Training time = {time.time() - start} sec')
@@ -141,7 +100,7 @@ if mlflow_logging:
 
     # val & test accuracy
     val_accuracy =  history.history['val_binary_accuracy'][-1]
-    test_data = get_test_data(BATCH_SIZE, IMGSIZE, channel_mode = "grayscale")
+    test_data = get_test_data(BATCH_SIZE, IMGSIZE, channel_mode = "grayscale", cache = pipeline_cache)
     _, test_accuracy = model.evaluate(test_data) ###### need to define test data and test the code line
 
 
@@ -155,7 +114,7 @@ if mlflow_logging:
     batch = train_data.take(1)
     
     # log custom parameters 
-    custom_params_dict = {'momentum': momentum, 'class weights': class_weights_dict}
+    custom_params_dict = {'momentum': momentum, 'class weights': class_weights_dict, 'compile mode': compile_mode}
 
     
     # First step: run "mlflow server --host 127.0.0.1 --port 8080" in a different terminal to open the server; 
@@ -177,5 +136,9 @@ if mlflow_logging:
     val_accuracy = val_accuracy,
     test_accuracy = test_accuracy,
 	custom_params = custom_params_dict, # must be a dictionary (eg for momentum, activation functions in the top layer)
-    fig = learning_curves # takes a figure object as input
+    fig = learning_curves, # takes a figure object as input
+    throughput = throughput, # training throughput per epoch
+    profile_dir = profile_dir, # profiler trace (None if profiling is off)
+    resizing_stages = get_resizing_stages(resizing_schedule, EPOCHS), # progressive resizing (one stage without schedule)
+    time_to_accuracy = time_to_accuracy # time to target accuracy
     )
@@ -8,6 +8,18 @@ To do so, in the directory of this script (i.e. folder transfer_learning), run t
 mlflow server --host 127.0.0.1 --port 8080
 
 Then check the localhost port to access the MLFlow GUI for tracking!
+
+The model takes single-channel (grayscale) images and repeats the channel in the graph for the rgb input of the base
+model (training_helpers.broadcast_channels()), hence images, cached tensors and API payloads stay single-channel.
+
+Feature cache mode (feature_cache = True): the base model is frozen, hence its pooled outputs don't change during training.
+They are computed once per image of train/val/test and stored in data/feature_cache/, the top layers are trained on them
+(with the same callbacks). The top layers are shared with the complete model, which is logged as usual.
+The cached training features are reshuffled in every epoch, like the images without cache.
+
+Progressive resizing (resizing_schedule, only without feature cache): the first epochs are trained at lower image sizes,
+the remaining ones at IMGSIZE (see data.helpers.get_resizing_stages()). The base model takes variable input sizes, the
+stage models share all layers with the complete model. The schedule and the time to target_accuracy are logged.
 Run this script to conduct training experiments (runs). If mlflow server is running, the experiment will be tracked as a run.
 You will find the result in the mlflow tracking server ("backend-store"), i.e. unified_experiment/mlartifacts/[...newly generated run id...]
 """
@@ -23,7 +35,7 @@ import time
 import training_helpers
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from data.helpers import get_train_val_data, get_test_data, IMGSIZE
+from data.helpers import get_train_val_data, get_progressive_train_val_data, get_resizing_stages, get_test_data, get_cache_name, IMGSIZE, PROJECT_PATH, DATA_PATH_TRAIN, DATA_PATH_TEST
 from mlflow_logging import log_mlflow_run
 
 
@@ -40,56 +52,101 @@ chosen_loss = "binary_crossentropy"
 chosen_optimizer = "adam"
 chosen_learning_rate = 0.001
 early_stopping = True
+# compilation mode of training and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+# cache of the decoded images: None, "memory", "disk" or "snapshot" (see data/helpers.py)
+pipeline_cache = "disk"
+# train the top layers on cached features of the frozen base model (see docstring)
+feature_cache = True
+feature_cache_path = os.path.join(PROJECT_PATH, "data/feature_cache")
+# progressive resizing (only with feature_cache = False): (image size, epochs) of the stages before the remaining
+# epochs at IMGSIZE, e.g. [(128, 5), (192, 5)] (see data/helpers.py), None: all epochs at IMGSIZE
+resizing_schedule = None
+# validation accuracy (at IMGSIZE) for the logged wall-clock time to target accuracy
+target_accuracy = 0.9
 
 # param for base model selection
 selected_model = "MobileNet" # MobileNet or ResNet
 
+# capture a TensorBoard profiler trace of the training steps profile_steps (first, last), logged with the run
+profiling = False
+profile_steps = (10, 20)
+
 # custom params for mlflow logging
 mlflow_run_name = "optimized params"
-custom_params = {"top dense layer activation": dense_layer_top_activation}
+custom_params = {"top dense layer activation": dense_layer_top_activation, "feature cache": feature_cache, "compile mode": compile_mode}
 mlflow_tracking = True
 
 # %%
 ' ######################################### getting training and validation data ################################'
 
-train_data, val_data = get_train_val_data(BATCHSIZE, IMGSIZE, channel_mode="rgb")
+if feature_cache and resizing_schedule:
+    raise ValueError("Progressive resizing trains on the images, set feature_cache = False.")
+
+# the images are read once in feature cache mode, a pipeline cache isn't needed
+if feature_cache:
+    pipeline_cache = None
+# grayscale images, the model broadcasts the channel to the rgb input of the base model
+train_data, val_data = get_train_val_data(BATCHSIZE, IMGSIZE, channel_mode="grayscale", cache=pipeline_cache)
+test_data = get_test_data(BATCHSIZE, IMGSIZE, channel_mode="grayscale", cache=pipeline_cache)
 
  # %%
 ' ################################################## defining the model #########################'
-# base model
+# base model (variable input size for the stages of progressive resizing)
+base_input_shape = (None, None, 3) if resizing_schedule else (IMGSIZE, IMGSIZE, 3)
 if selected_model == "ResNet":
     tag = "ResNet152V2 with Dense top"
     # ResNet
     base_model = keras.applications.ResNet152V2(
-        input_shape = (IMGSIZE,IMGSIZE, 3),
+        input_shape = base_input_shape,
         include_top = False,
         weights = "imagenet",)
 elif selected_model == "MobileNet":
     tag = "MobileNet"
     # MobileNet
     base_model = keras.applications.MobileNet(
-        input_shape = (IMGSIZE,IMGSIZE, 3),
+        input_shape = base_input_shape,
         include_top=False,
         weights="imagenet")
 
 base_model.trainable = False
 
-# complete model setup
-inputs = tf.keras.layers.Input(shape = (IMGSIZE, IMGSIZE, 3))
-x = keras.layers.Rescaling(scale = 1./255)(inputs)
-x = base_model(inputs)
-x = layers.GlobalAveragePooling2D()(x)
-x = layers.Dense(dense_layer_top_neurons, activation=dense_layer_top_activation)(x)
-x = layers.Dropout(dropout_rate_top)(x)
-output = layers.Dense(1, activation='sigmoid')(x)
+# top layers (shared by the complete model and the model trained on cached features)
+top_layers = [
+    layers.Dense(dense_layer_top_neurons, activation=dense_layer_top_activation),
+    layers.Dropout(dropout_rate_top),
+    layers.Dense(1, activation='sigmoid'),
+]
+def add_top_layers(x):
+    for layer in top_layers:
+        x = layer(x)
+    return x
+
+# complete model setup (single-channel input, broadcast to the three channels of the base model in the graph)
+inputs = tf.keras.layers.Input(shape = (IMGSIZE, IMGSIZE, 1))
+x = training_helpers.broadcast_channels(inputs)
+x = base_model(x)
+features = layers.GlobalAveragePooling2D()(x)
+output = add_top_layers(features)
 model = Model(inputs=inputs, outputs=output)
 
+# frozen part (base model + pooling) and top layers on its outputs
+feature_model = Model(inputs=inputs, outputs=features)
+feature_inputs = tf.keras.layers.Input(shape = features.shape[1:])
+top_model = Model(inputs=feature_inputs, outputs=add_top_layers(feature_inputs))
+
 # %%
 ' ######################################### compile and summary #######################################'
 # compile model
 model.compile(loss=chosen_loss, 
               optimizer = keras.optimizers.Adam(learning_rate=chosen_learning_rate), 
-              metrics=['binary_accuracy'])
+              metrics=['binary_accuracy'],
+              **training_helpers.get_compile_options(compile_mode))
+if feature_cache:
+    top_model.compile(loss=chosen_loss, 
+                      optimizer = keras.optimizers.Adam(learning_rate=chosen_learning_rate), 
+                      metrics=['binary_accuracy'],
+                      **training_helpers.get_compile_options(compile_mode))
 
 # print model summary
 model.summary()
@@ -104,6 +161,12 @@ chosen_callbacks = []
 # model checkpoint: create temp path for temp storage of best model
 current_dir = os.getcwd()
 checkpoint_path = os.path.join(current_dir, "temp_model.keras")
+if feature_cache:
+    # weights of the top layers (they are shared with the complete model)
+    checkpoint_path = os.path.join(current_dir, "temp_top_model.weights.h5")
+elif resizing_schedule:
+    # weights of the layers shared by the stage models (best epoch by the validation accuracy of its stage)
+    checkpoint_path = os.path.join(current_dir, "temp_model.weights.h5")
 
 # define checkpoint callback
 checkpoint = keras.callbacks.ModelCheckpoint(
@@ -111,7 +174,7 @@ checkpoint = keras.callbacks.ModelCheckpoint(
     monitor="val_binary_accuracy",
     mode = "max",
     save_best_only=True,
-    save_weights_only=False
+    save_weights_only=feature_cache or bool(resizing_schedule)
 )
 
 chosen_callbacks.append(checkpoint)
@@ -130,36 +193,89 @@ if early_stopping:
     )
     chosen_callbacks.append(early_stopping)
 
+# records images/sec, step times, input wait and peak RSS (logged with the run)
+throughput = training_helpers.ThroughputCallback(BATCHSIZE)
+chosen_callbacks.append(throughput)
+
+# profiler trace (opt-in)
+profile_dir = None
+if profiling:
+    profiler, profile_dir = training_helpers.get_profiler_callback(profile_steps)
+    chosen_callbacks.append(profiler)
+
+# wall-clock time until the validation accuracy at IMGSIZE reaches target_accuracy
+# (lower resolution stages are validated at their image size, the full-size model is evaluated in addition)
+time_to_accuracy = training_helpers.TimeToAccuracyCallback(target_accuracy, model, val_data if resizing_schedule else None)
+chosen_callbacks.append(time_to_accuracy)
+
+# %% 
+' ############################################ feature cache #########################'
+
+if feature_cache:
+    start_time = time.time()
+    # cached features are specific to base model, image size and source images
+    cache_folder = os.path.join(feature_cache_path, f"{selected_model}_{get_cache_name(DATA_PATH_TRAIN, IMGSIZE, 'grayscale')}")
+    train_features, train_labels = training_helpers.get_cached_features(feature_model, train_data, os.path.join(cache_folder, "train.npz"))
+    val_features, val_labels = training_helpers.get_cached_features(feature_model, val_data, os.path.join(cache_folder, "val.npz"))
+    # the folder name covers data/train (train and val), the test file is named by the fingerprint of data/test
+    test_cache_file = os.path.join(cache_folder, f"test_{get_cache_name(DATA_PATH_TEST, IMGSIZE, 'grayscale')}.npz")
+    test_features, test_labels = training_helpers.get_cached_features(feature_model, test_data, test_cache_file)
+    print(f"features ready in {time.time() - start_time:.2f} seconds ({cache_folder})")
+
+    train_features_data = tf.data.Dataset.from_tensor_slices((train_features, train_labels)).shuffle(
+        len(train_labels), seed=0, reshuffle_each_iteration=True).batch(BATCHSIZE).prefetch(tf.data.AUTOTUNE)
+    val_features_data = tf.data.Dataset.from_tensor_slices((val_features, val_labels)).batch(BATCHSIZE)
+    test_features_data = tf.data.Dataset.from_tensor_slices((test_features, test_labels)).batch(BATCHSIZE)
+
 # %% 
 ' ############################################ training #########################'
 
 start_time = time.time()
 
-history = model.fit(train_data,
-          batch_size = BATCHSIZE, epochs = CHOSEN_EPOCHS,
-          validation_data=val_data,
-          callbacks = chosen_callbacks
-          );
+if feature_cache:
+    history = top_model.fit(throughput.instrument(train_features_data),
+            epochs = CHOSEN_EPOCHS,
+            validation_data=val_features_data,
+            callbacks = chosen_callbacks
+            );
+else:
+    # one stage at IMGSIZE without resizing schedule, the lower resolution stages train the layers of model
+    histories = []
+    for stage in get_progressive_train_val_data(BATCHSIZE, resizing_schedule, CHOSEN_EPOCHS, channel_mode="grayscale", cache=pipeline_cache, final_stage_data=(train_data, val_data)):
+        print(f"stage: image size {stage['img_size']}, epochs {stage['initial_epoch'] + 1} to {stage['epochs']}")
+        stage_model = training_helpers.get_stage_model(model, stage["img_size"])
+        histories.append(stage_model.fit(throughput.instrument(stage["train_data"]),
+                batch_size = BATCHSIZE, initial_epoch = stage["initial_epoch"], epochs = stage["epochs"],
+                validation_data=stage["val_data"],
+                callbacks = chosen_callbacks
+                ))
+    history = training_helpers.merge_histories(histories)
 
 end_time = time.time()
 training_time = end_time - start_time
 print(f"train time:  {training_time:.2f} seconds = {training_time/60:.1f} minutes")
 
-# Load the best model
-model = keras.models.load_model(checkpoint_path)
+# Load the best model (feature cache: best top layers, which are part of the complete model)
+if feature_cache:
+    top_model.load_weights(checkpoint_path)
+elif resizing_schedule:
+    model.load_weights(checkpoint_path)
+else:
+    model = keras.models.load_model(checkpoint_path)
 # delete temp path of model checkpoint
 if os.path.exists(checkpoint_path):
         os.remove(checkpoint_path)
         
 # %%
 ' ########################################## prediction on validation and test set ########'
-# get training data again (generators have been consumed during training and need to be reconstructed)
-train_data, val_data = get_train_val_data(BATCHSIZE, IMGSIZE, channel_mode="rgb")
-val_loss, val_binary_accuracy = model.evaluate(val_data, verbose = 1)
-
-# get test data
-test_data = get_test_data(BATCHSIZE, IMGSIZE, channel_mode="rgb")
-test_loss, test_binary_accuracy = model.evaluate(test_data, verbose = 1)
+# datasets are re-iterable, the validation data of the training is evaluated again
+# (feature cache: the top layers on the cached features give the predictions of the complete model)
+if feature_cache:
+    val_loss, val_binary_accuracy = top_model.evaluate(val_features_data, verbose = 1)
+    test_loss, test_binary_accuracy = top_model.evaluate(test_features_data, verbose = 1)
+else:
+    val_loss, val_binary_accuracy = model.evaluate(val_data, verbose = 1)
+    test_loss, test_binary_accuracy = model.evaluate(test_data, verbose = 1)
 
 print('Val loss:', val_loss)
 print('Val binary accuracy:', val_binary_accuracy)
@@ -189,4 +305,8 @@ log_mlflow_run(model,
                val_accuracy = val_binary_accuracy, 
                test_accuracy = test_binary_accuracy, 
                custom_params = custom_params, 
-               fig = learning_curves)
+               fig = learning_curves, 
+               throughput = throughput, 
+               profile_dir = profile_dir,
+               resizing_stages = get_resizing_stages(resizing_schedule, CHOSEN_EPOCHS),
+               time_to_accuracy = time_to_accuracy)
@@ -9,6 +9,15 @@ mlflow server --host 127.0.0.1 --port 8080
 Then check the localhost port 8080 to access the MLFlow GUI for tracking!
 Run this script to conduct training experiments (runs). If mlflow server is running, the experiment will be tracked as a run.
 You will find the result in the mlflow tracking server ("backend-store"), i.e. unified_experiment/mlartifacts/[...newly generated run id...]
+
+Activation cache mode (activation_cache = True): the layers of the base model before the last unfrozen_last_layers are
+frozen, hence their outputs don't change during finetuning. The base model is split behind the last frozen layer, the
+outputs of the frozen part are computed once per image of train/val/test and stored in data/feature_cache/. Only the
+unfrozen tail of the base model and the top layers are trained on them. They share their layers with the loaded model,
+which is logged as usual. Frozen layers in inference mode (e.g. BatchNormalization) give the same outputs as without cache.
+If a residual connection bypasses the split layer (e.g. ResNet), the model can't be split: the script prints a notice
+and fine-tunes on full images.
+Memory: the cached activations are held in RAM, e.g. 256 KB per image for MobileNet (8x8x1024 float32 at image size 256).
 """
 
 
@@ -29,7 +38,7 @@ import time
 import training_helpers
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from data.helpers import get_train_val_data, get_test_data, IMGSIZE
+from data.helpers import get_train_val_data, get_test_data, get_cache_name, IMGSIZE, PROJECT_PATH, DATA_PATH_TRAIN, DATA_PATH_TEST
 from mlflow_logging import log_mlflow_run
 
 # %%
@@ -82,6 +91,13 @@ chosen_learning_rate = 0.00001
 chosen_loss = params["loss function"]
 unfrozen_last_layers = 5
 early_stopping = True
+# compilation mode of training and evaluation: "eager", "graph" or "xla" (see training_helpers.py)
+compile_mode = "graph"
+# cache of the decoded images: None, "memory", "disk" or "snapshot" (see data/helpers.py)
+pipeline_cache = "disk"
+# train the unfrozen layers on cached activations of the frozen layers (see docstring)
+activation_cache = True
+activation_cache_path = os.path.join(PROJECT_PATH, "data/feature_cache")
 # update params dictionary to override old epochs and learning rate, and batch size
 try:
     params["learning rate"] = chosen_learning_rate
@@ -91,9 +107,13 @@ except:
     raise ValueError("learning rate and epochs parameter not found in extracted params of old run!" 
                      "Check spelling and old run params!")
 
+# capture a TensorBoard profiler trace of the training steps profile_steps (first, last), logged with the run
+profiling = False
+profile_steps = (10, 20)
+
 # custom params for mlflow logging
 tag = "finetuning"
-custom_params = {"unfrozen last layers": unfrozen_last_layers}
+custom_params = {"unfrozen last layers": unfrozen_last_layers, "activation cache": activation_cache, "compile mode": compile_mode}
 mlflow_tracking = True
 
 # %%
@@ -110,8 +130,11 @@ except:
 # load model
 model = load_model(model_path, compile=False, safe_mode=True)
 
-# extract base_model
-base_model = model.layers[1]
+# extract base_model (nested model behind the input layer, or behind the channel broadcast of single-channel models)
+base_index = next(index for index, layer in enumerate(model.layers) if isinstance(layer, keras.Model))
+base_model = model.layers[base_index]
+# single-channel models take grayscale images, models of older runs rgb images (3 identical channels)
+channel_mode = "grayscale" if model.input_shape[-1] == 1 else "rgb"
 
 # unfreeze base model, but keep only last fex layers unfrozen (MobileNet gast 85 layers!)
 base_model.trainable = True
@@ -121,12 +144,42 @@ for layer in base_model.layers[:-unfrozen_last_layers]:
 for layer_number, layer in enumerate(model.layers):
     print(layer_number, layer.name, layer.trainable)
 
+# split the base model behind the last frozen layer: frozen part (prefix) and trained part (tail + top layers)
+if activation_cache:
+    split_layer = base_model.layers[-unfrozen_last_layers - 1]
+    try:
+        base_prefix_model, tail_model = training_helpers.split_model_at_layer(base_model, split_layer)
+    except ValueError as e:
+        # e.g. ResNet: a residual connection bypasses the split layer, the tail can't take its outputs as input
+        print(f"{e} Activation cache not possible, fine-tuning on full images.")
+        activation_cache = False
+        custom_params["activation cache"] = activation_cache
+if activation_cache:
+    # frozen part of the loaded model: layers in front of the base model (channel broadcast) and frozen part of the base model
+    prefix_inputs = keras.layers.Input(shape = model.input_shape[1:])
+    x = prefix_inputs
+    for layer in model.layers[1:base_index]:
+        x = layer([x] * len(layer.input)) if isinstance(layer, keras.layers.Concatenate) else layer(x)
+    prefix_model = Model(inputs=prefix_inputs, outputs=base_prefix_model(x))
+    activation_inputs = keras.layers.Input(shape = split_layer.output.shape[1:])
+    x = tail_model(activation_inputs)
+    # top layers of the loaded model (input layer, [channel broadcast,] base model, top layers)
+    for layer in model.layers[base_index + 1:]:
+        x = layer(x)
+    trained_model = Model(inputs=activation_inputs, outputs=x)
+
 # %%
 ' ################################ compile again, create summary ##################################'
 
 model.compile(loss=chosen_loss, 
               optimizer = keras.optimizers.Adam(learning_rate=chosen_learning_rate), 
-              metrics=['binary_accuracy'])
+              metrics=['binary_accuracy'],
+              **training_helpers.get_compile_options(compile_mode))
+if activation_cache:
+    trained_model.compile(loss=chosen_loss, 
+                          optimizer = keras.optimizers.Adam(learning_rate=chosen_learning_rate), 
+                          metrics=['binary_accuracy'],
+                          **training_helpers.get_compile_options(compile_mode))
 
 # print model summary
 model.summary()
@@ -136,8 +189,30 @@ model_summary_str = training_helpers.generate_model_summary_string(model)
 # %%
 ' ######################################### getting training and validation data ################################'
 
-# get the data
-train_data, val_data = get_train_val_data(BATCHSIZE, IMGSIZE, channel_mode = "rgb")
+# get the data (the images are read once in activation cache mode, a pipeline cache isn't needed)
+if activation_cache:
+    pipeline_cache = None
+train_data, val_data = get_train_val_data(BATCHSIZE, IMGSIZE, channel_mode = channel_mode, cache = pipeline_cache)
+test_data = get_test_data(BATCHSIZE, IMGSIZE, channel_mode= channel_mode, cache = pipeline_cache)
+
+# %%
+' ######################################### activation cache ################################'
+
+if activation_cache:
+    start_time = time.time()
+    # cached activations are specific to the loaded model, the split layer, image size and source images
+    cache_folder = os.path.join(activation_cache_path, f"{mlflow_run_ID}_{split_layer.name}_{get_cache_name(DATA_PATH_TRAIN, IMGSIZE, channel_mode)}")
+    train_activations, train_labels = training_helpers.get_cached_features(prefix_model, train_data, os.path.join(cache_folder, "train.npz"))
+    val_activations, val_labels = training_helpers.get_cached_features(prefix_model, val_data, os.path.join(cache_folder, "val.npz"))
+    # the folder name covers data/train (train and val), the test file is named by the fingerprint of data/test
+    test_cache_file = os.path.join(cache_folder, f"test_{get_cache_name(DATA_PATH_TEST, IMGSIZE, channel_mode)}.npz")
+    test_activations, test_labels = training_helpers.get_cached_features(prefix_model, test_data, test_cache_file)
+    print(f"activations ready in {time.time() - start_time:.2f} seconds ({cache_folder})")
+
+    train_activation_data = tf.data.Dataset.from_tensor_slices((train_activations, train_labels)).shuffle(
+        len(train_labels), seed=0, reshuffle_each_iteration=True).batch(BATCHSIZE).prefetch(tf.data.AUTOTUNE)
+    val_activation_data = tf.data.Dataset.from_tensor_slices((val_activations, val_labels)).batch(BATCHSIZE)
+    test_activation_data = tf.data.Dataset.from_tensor_slices((test_activations, test_labels)).batch(BATCHSIZE)
 
 # %%
 ' ########################################## callbacks #######################'
@@ -175,16 +250,33 @@ if early_stopping:
     )
     chosen_callbacks.append(early_stopping)
 
+# records images/sec, step times, input wait and peak RSS (logged with the run)
+throughput = training_helpers.ThroughputCallback(BATCHSIZE)
+chosen_callbacks.append(throughput)
+
+# profiler trace (opt-in)
+profile_dir = None
+if profiling:
+    profiler, profile_dir = training_helpers.get_profiler_callback(profile_steps)
+    chosen_callbacks.append(profiler)
+
 # %% 
 ' ################################### training ####################################'
 # training
 start_time = time.time()
 
-history = model.fit(train_data,
-          batch_size = BATCHSIZE, epochs = CHOSEN_EPOCHS,
-          validation_data=val_data,
-          callbacks = chosen_callbacks
-          );
+if activation_cache:
+    history = trained_model.fit(throughput.instrument(train_activation_data),
+            epochs = CHOSEN_EPOCHS,
+            validation_data=val_activation_data,
+            callbacks = chosen_callbacks
+            );
+else:
+    history = model.fit(throughput.instrument(train_data),
+            batch_size = BATCHSIZE, epochs = CHOSEN_EPOCHS,
+            validation_data=val_data,
+            callbacks = chosen_callbacks
+            );
 
 end_time = time.time()
 training_time = end_time - start_time
@@ -197,13 +289,14 @@ if os.path.exists(checkpoint_path):
 # %%
 ' ########################################## prediction on validation and test set ########'
 
-# get training data again (generators have been consumed during training and need to be reconstructed)
-train_data, val_data = get_train_val_data(BATCHSIZE, IMGSIZE, channel_mode= "rgb")
-val_loss, val_binary_accuracy = model.evaluate(val_data, verbose = 1)
-
-# get test data
-test_data = get_test_data(BATCHSIZE, IMGSIZE, channel_mode= "rgb")
-test_loss, test_binary_accuracy = model.evaluate(test_data, verbose = 1)
+# datasets are re-iterable, the validation data of the training is evaluated again
+# (activation cache: the trained part on the cached activations gives the predictions of the complete model)
+if activation_cache:
+    val_loss, val_binary_accuracy = trained_model.evaluate(val_activation_data, verbose = 1)
+    test_loss, test_binary_accuracy = trained_model.evaluate(test_activation_data, verbose = 1)
+else:
+    val_loss, val_binary_accuracy = model.evaluate(val_data, verbose = 1)
+    test_loss, test_binary_accuracy = model.evaluate(test_data, verbose = 1)
 print('Val loss:', val_loss)
 print('Val binary accuracy:', val_binary_accuracy)
 print('test loss:', test_loss)
@@ -233,4 +326,6 @@ log_mlflow_run(model,
                val_accuracy = val_binary_accuracy, 
                test_accuracy = test_binary_accuracy, 
                custom_params = custom_params, 
-               fig = learning_curves)
\ No newline at end of file
+               fig = learning_curves, 
+               throughput = throughput, 
+               profile_dir = profile_dir)
\ No newline at end of file